@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+
+# Benchmark for the check_bareos.py checks
+#
+# Creates a synthetic Bareos catalog (Job, Media, Pool, Storage, Client) with a configurable
+# size in its own schema of a PostgreSQL database and measures every check end to end
+# and at the query level. With --startup it measures the import and argument parsing
+# time of the plugin in fresh interpreters instead, without a database.
+#
+# This program is free software; you can redistribute it or modify
+# it under the terms of the GNU General Public License version 3.0
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import check_bareos
+
+
+SCHEMA = 'check_bareos_benchmark'
+
+TABLES = """
+CREATE TABLE Pool (PoolId integer PRIMARY KEY, Name text NOT NULL);
+CREATE TABLE Storage (StorageId integer PRIMARY KEY, Name text NOT NULL);
+CREATE TABLE Client (ClientId integer PRIMARY KEY, Name text NOT NULL);
+CREATE TABLE Media (
+    MediaId integer PRIMARY KEY,
+    VolumeName text NOT NULL,
+    PoolId integer,
+    StorageId integer,
+    Slot integer DEFAULT 0,
+    InChanger smallint DEFAULT 0,
+    VolStatus text NOT NULL,
+    VolErrors integer DEFAULT 0,
+    VolMounts integer DEFAULT 0,
+    LastWritten timestamp without time zone,
+    VolRetention bigint DEFAULT 0
+);
+CREATE TABLE Job (
+    JobId integer PRIMARY KEY,
+    Job text NOT NULL,
+    Name text NOT NULL,
+    Type char(1) NOT NULL,
+    Level char(1) NOT NULL,
+    ClientId integer,
+    JobStatus char(1) NOT NULL,
+    StartTime timestamp without time zone,
+    EndTime timestamp without time zone,
+    JobBytes bigint DEFAULT 0,
+    JobFiles integer DEFAULT 0,
+    PoolId integer
+);
+"""
+
+# The indexes of the Bareos catalog schema on these tables
+INDEXES = """
+CREATE INDEX job_name_idx ON Job (Name);
+CREATE INDEX media_poolid_idx ON Media (PoolId);
+CREATE INDEX media_storageid_idx ON Media (StorageId);
+"""
+
+DATA = """
+INSERT INTO Pool SELECT i, 'Pool-' || i FROM generate_series(1, %(pools)s) i;
+INSERT INTO Storage SELECT i, 'Storage-' || i FROM generate_series(1, %(storages)s) i;
+INSERT INTO Client SELECT i, 'client-' || i || '-fd' FROM generate_series(1, %(clients)s) i;
+INSERT INTO Media
+SELECT i, 'Vol-' || i, 1 + i %% %(pools)s, 1 + i %% %(storages)s,
+       CASE WHEN i %% 3 = 0 THEN 0 ELSE 1 + i %% 500 END, (i %% 4 <> 0)::int,
+       (ARRAY['Append','Full','Used','Purged','Recycle','Error','Disabled','Full'])[1 + i %% 8],
+       (i %% 97 = 0)::int, i %% 300,
+       now() - (i %% 400) * '1 day'::INTERVAL, (30 + i %% 335) * 86400
+FROM generate_series(1, %(tapes)s) i;
+INSERT INTO Job
+SELECT i, 'backup-' || i, 'backup-client-' || (1 + i %% %(clients)s), 'B',
+       (ARRAY['F','I','I','I','I','I','D'])[1 + i %% 7], 1 + i %% %(clients)s,
+       (ARRAY['T','T','T','T','T','T','T','T','T','W','E','f','A','R','C'])[1 + i %% 15],
+       now() - ((%(jobs)s - i)::float8 / %(jobs)s) * %(days)s * '1 day'::INTERVAL,
+       now() - ((%(jobs)s - i)::float8 / %(jobs)s) * %(days)s * '1 day'::INTERVAL + (i %% 7200) * '1 second'::INTERVAL,
+       CASE WHEN i %% 50 = 0 THEN 0 ELSE (i::bigint * 2654435761) %% 4398046511104 END,
+       i %% 100000, 1 + i %% %(pools)s
+FROM generate_series(1, %(jobs)s) i;
+"""
+
+
+class TimingCursor:
+    """
+    Wraps a cursor and records the time spent in execute() and the number of rows fetched
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.queries = 0
+        self.queryTime = 0.0
+        self.rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, query, params=None):
+        start = time.monotonic()
+        self._cursor.execute(query, params)
+        self.queryTime += time.monotonic() - start
+        self.queries += 1
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self.rows += 1 if row is not None else 0
+        return row
+
+    def fetchmany(self, size):
+        rows = self._cursor.fetchmany(size)
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.rows += len(rows)
+        return rows
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values (nearest rank)
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+# The checks to measure, as on the command line
+CHECKS = [
+    ('failed-backups', 'status -fb -t 7'),
+    ('empty-backups', 'status -e -f -t 7'),
+    ('oversized-backups', 'status -o -s 2 -t 7'),
+    ('total-backup-size', 'status -b -t 7'),
+    ('queued-jobs', 'job -js -st C'),
+    ('single-job', 'job -j -n backup-client-1 -st T'),
+    ('runtime-jobs', 'job -rt -st R'),
+    ('tapes-in-storage', 'tape -ts'),
+    ('expired-tapes', 'tape -ex'),
+    ('will-expire-tapes', 'tape -wex'),
+    ('replace-tapes', 'tape -r -m 200'),
+    ('empty-tapes', 'tape -e'),
+]
+
+
+def benchmarkChecks():
+    """
+    Returns the checks to measure, each a function that runs the check on a cursor.
+    The batch runs all checks with the job counters fetched in a single query,
+    the tape inventory runs all tape checks from one query over the volumes.
+    """
+    _, subParser = check_bareos.createParser()
+
+    checks = []
+    for name, check in CHECKS:
+        checkArgs = subParser.choices[check.split()[0]].parse_args(check.split()[1:])
+        checks.append((name, lambda cursor, checkArgs=checkArgs: checkArgs.evaluate(cursor, checkArgs)))
+
+    batch = [(name, check.split()) for name, check in CHECKS]
+    checks.append(('batch', lambda cursor: check_bareos.evaluateBatch(cursor, subParser, batch)))
+
+    inventory = [(name, check.split() + ['--inventory']) for name, check in CHECKS if check.startswith('tape')]
+    checks.append(('tape-inventory', lambda cursor: check_bareos.evaluateBatch(cursor, subParser, inventory)))
+
+    return checks
+
+
+# Run in a fresh interpreter for every measurement of the startup
+STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+import check_bareos
+imported = time.perf_counter()
+check_bareos.commandline(sys.argv[1:])
+parsed = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'parse_ms': (parsed - imported) * 1000}))
+"""
+
+
+def measureStartup(check, repeat):
+    """
+    Returns the import, parse and process times in ms of repeat fresh interpreters parsing the check
+    """
+    argv = ['-U', 'bareos'] + check.split()
+    samples = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        output = subprocess.run([sys.executable, '-c', STARTUP] + argv, check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        sample = json.loads(output)
+        sample['process_ms'] = (time.monotonic() - start) * 1000
+        samples.append(sample)
+    return samples
+
+
+def runStartupBenchmark(checks, repeat):
+    """
+    Measures the startup of every check and returns the latencies per check
+    """
+    results = []
+    for name, check in checks:
+        samples = measureStartup(check, repeat)
+        result = {'check': name, 'runs': repeat}
+        for key in ['import_ms', 'parse_ms', 'process_ms']:
+            result[key.replace('_ms', '') + '_p50_ms'] = round(percentile([s[key] for s in samples], 50), 3)
+            result[key.replace('_ms', '') + '_p95_ms'] = round(percentile([s[key] for s in samples], 95), 3)
+        results.append(result)
+
+    return results
+
+
+def formatStartupResults(results):
+    lines = ["{0:<30} {1:>5} {2:>10} {3:>10} {4:>10} {5:>10} {6:>11} {7:>11}".format(
+        'check', 'runs', 'import p50', 'import p95', 'parse p50', 'parse p95', 'process p50', 'process p95')]
+    for r in results:
+        lines.append(("{check:<30} {runs:>5} {import_p50_ms:>10.3f} {import_p95_ms:>10.3f} {parse_p50_ms:>10.3f} "
+                      "{parse_p95_ms:>10.3f} {process_p50_ms:>11.3f} {process_p95_ms:>11.3f}").format(**r))
+    return "\n".join(lines)
+
+
+def setupCatalog(connection, args):
+    """
+    Creates the synthetic catalog in its own schema, an existing one is replaced
+    """
+    cursor = connection.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS " + SCHEMA + " CASCADE;")
+    cursor.execute("CREATE SCHEMA " + SCHEMA + ";")
+    cursor.execute("SET search_path TO " + SCHEMA + ";")
+    cursor.execute(TABLES)
+    cursor.execute(DATA, {'jobs': args.jobs, 'tapes': args.tapes, 'pools': args.pools,
+                          'storages': args.storages, 'clients': args.clients, 'days': args.days})
+    cursor.execute(INDEXES)
+    connection.commit()
+    cursor.execute("ANALYZE;")
+    connection.commit()
+
+
+def runBenchmark(cursor, checks, repeat):
+    """
+    Runs every check repeat times and returns the latency and query statistics per check
+    """
+    results = []
+    for name, check in checks:
+        total = []
+        queryTimes = []
+        timing = None
+        for _ in range(repeat):
+            timing = TimingCursor(cursor)
+            start = time.monotonic()
+            check(timing)
+            total.append((time.monotonic() - start) * 1000)
+            queryTimes.append(timing.queryTime * 1000)
+            cursor.connection.rollback()
+
+        results.append({
+            'check': name,
+            'runs': repeat,
+            'p50_ms': round(percentile(total, 50), 3),
+            'p95_ms': round(percentile(total, 95), 3),
+            'query_p50_ms': round(percentile(queryTimes, 50), 3),
+            'query_p95_ms': round(percentile(queryTimes, 95), 3),
+            'queries': timing.queries,
+            'rows': timing.rows,
+        })
+
+    return results
+
+
+def formatResults(results):
+    lines = ["{0:<30} {1:>5} {2:>10} {3:>10} {4:>12} {5:>12} {6:>8} {7:>6}".format(
+        'check', 'runs', 'p50 ms', 'p95 ms', 'query p50', 'query p95', 'queries', 'rows')]
+    for r in results:
+        lines.append("{check:<30} {runs:>5} {p50_ms:>10.3f} {p95_ms:>10.3f} {query_p50_ms:>12.3f} {query_p95_ms:>12.3f} {queries:>8} {rows:>6}".format(**r))
+    return "\n".join(lines)
+
+
+def commandline(args):
+    parser = argparse.ArgumentParser(description='Benchmark the check_bareos checks against a synthetic Bareos catalog')
+    parser.add_argument('-U', '--user', dest='user', action='store', help='user name for the database connections [required without --startup]')
+    parser.add_argument('-p', '--password', dest='password', action='store', default=os.environ.get('CHECK_BAREOS_DATABASE_PASSWORD', ''),
+                        help='password for the database connections (CHECK_BAREOS_DATABASE_PASSWORD)')
+    parser.add_argument('-H', '--Host', dest='host', action='store', help='database host', default="127.0.0.1")
+    parser.add_argument('-P', '--port', dest='port', action='store', help='database port', default=5432, type=int)
+    parser.add_argument('-d', '--database', dest='database', default='bareos_benchmark', help='database name [default=bareos_benchmark]')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1000, help='number of rows in the Job table [default=1000]')
+    parser.add_argument('--tapes', dest='tapes', type=int, default=10000, help='number of rows in the Media table [default=10000]')
+    parser.add_argument('--pools', dest='pools', type=int, default=10, help='number of pools [default=10]')
+    parser.add_argument('--storages', dest='storages', type=int, default=4, help='number of storages [default=4]')
+    parser.add_argument('--clients', dest='clients', type=int, default=200, help='number of clients and job names [default=200]')
+    parser.add_argument('--days', dest='days', type=int, default=365, help='days covered by the jobs [default=365]')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=10, help='runs per check [default=10]')
+    parser.add_argument('--no-setup', dest='setup', action='store_false', help='reuse the catalog of the last run')
+    parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--startup', dest='startup', action='store_true', help='measure the import and argument parsing time instead of the checks')
+    parser.add_argument('--budget', dest='budget', action='store', type=float,
+                        help='exit with 1 if the p95 of import and parsing of a check exceeds n ms [used for --startup]')
+
+    parsed = parser.parse_args(args)
+    if not parsed.startup and not parsed.user:
+        parser.error('the following arguments are required: -U/--user')
+
+    return parsed
+
+
+def startup(args):
+    results = runStartupBenchmark(CHECKS, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(formatStartupResults(results))
+
+    if args.budget is not None:
+        exceeded = [r['check'] for r in results if r['import_p95_ms'] + r['parse_p95_ms'] > args.budget]
+        if exceeded:
+            print("Startup budget of {0} ms exceeded by: {1}".format(args.budget, ", ".join(exceeded)), file=sys.stderr)
+            sys.exit(1)
+
+
+def main(argv):
+    args = commandline(argv)
+
+    if args.startup:
+        startup(args)
+        return
+
+    connection = check_bareos.createConnection(args.user, args.password, args.host, args.database, args.port)
+
+    if args.setup:
+        start = time.monotonic()
+        setupCatalog(connection, args)
+        print("Created catalog with {0} jobs and {1} tapes in {2:.1f}s".format(args.jobs, args.tapes, time.monotonic() - start), file=sys.stderr)
+
+    cursor = connection.cursor()
+    cursor.execute("SET search_path TO " + SCHEMA + ";")
+    connection.commit()
+
+    results = runBenchmark(cursor, benchmarkChecks(), args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(formatResults(results))
+
+    connection.close()
+
+
+if __name__ == '__main__': # pragma: no cover
+    main(sys.argv[1:])
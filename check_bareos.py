@@ -12,22 +12,107 @@
 # This program is free software; you can redistribute it or modify
 # it under the terms of the GNU General Public License version 3.0
 
+# The plugin is installed as a single file, so all checks and modes are kept in this module
+# pylint: disable=too-many-lines
+
 import argparse
+import array
+import atexit
+import contextlib
+import datetime
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import importlib
+import itertools
+import json
+import math
 import sys
 import re
 import os
-import psycopg2
-import psycopg2.extras
+import queue
+import resource
+import shlex
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+
+class LazyModule:
+    """
+    Imports a module on the first access to one of its attributes, so a check
+    only pays for the imports it needs. Submodules are imported as attributes.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        module = importlib.import_module(self._name)
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            try:
+                return importlib.import_module(self._name + '.' + attr)
+            except ImportError:
+                raise AttributeError(attr) # pylint: disable=raise-missing-from
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self._name)
+
+
+# Heavy modules only some of the checks use
+asyncio = LazyModule('asyncio')
+concurrent = LazyModule('concurrent')
+csv = LazyModule('csv')
+http = LazyModule('http')
+psycopg2 = LazyModule('psycopg2')
+
+
+@functools.lru_cache(maxsize=None)
+def loadNumpy():
+    """
+    Returns NumPy, None if it is not installed. It is only imported when many values are evaluated at once,
+    see bulkNumpy().
+    """
+    try:
+        import numpy # pylint: disable=import-outside-toplevel
+    except ImportError: # pragma: no cover
+        return None
+    return numpy
+
+
+# Below this number of values the pure Python evaluation is faster than importing NumPy
+NUMPY_MIN_VALUES = 10000
+
+
+def bulkNumpy(values):
+    """
+    Returns NumPy for evaluating many values at once, None for few values or if it is not installed
+    """
+    if len(values) < NUMPY_MIN_VALUES:
+        return None
+    return loadNumpy()
 
 
 # Constants
 __version__ = '2.0.0'
 
+DEFAULT_SOCKET = '/run/check_bareos/check_bareos.sock'
+DEFAULT_CACHE_DIR = '/var/tmp/check_bareos'
+DEFAULT_LISTEN = '127.0.0.1:9625'
+
 OK = 0
 WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+STATE_NAMES = {OK: 'OK', WARNING: 'WARNING', CRITICAL: 'CRITICAL', UNKNOWN: 'UNKNOWN'}
+
 JOBSTATES = {
     'A': 'Job canceled by user',
     'B': 'Job blocked',
@@ -57,6 +142,122 @@ JOBSTATES = {
     't': 'Waiting for start time'
 }
 
+# Catalog queries with a fixed text, parameters are passed to execute()
+QUERIES = {
+    'tapesInStorage': """
+    SELECT count(MediaId)
+    FROM Media,Pool,Storage
+    WHERE Media.PoolId=Pool.PoolId
+    AND Slot>0 AND InChanger=1
+    AND Media.StorageId=Storage.StorageId;
+    """,
+    'expiredTapes': """
+    SELECT Count(MediaId)
+    FROM Media
+    WHERE lastwritten+(media.volretention * '1 second'::INTERVAL)<now() AND volstatus not like 'Error';
+    """,
+    'willExpireTapes': """
+    SELECT Count(MediaId)
+    FROM Media
+    WHERE lastwritten+(media.volretention * '1 second'::INTERVAL)<now()+(%s * '1 day'::INTERVAL) AND lastwritten+(media.volretention * '1 second'::INTERVAL)>now() AND volstatus not like 'Error';
+    """,
+    'replaceTapes': """
+    SELECT COUNT(VolumeName)
+    FROM Media
+    WHERE (VolErrors>0) OR (VolStatus='Error') OR (VolMounts>%s) OR (VolStatus='Disabled');
+    """,
+    'emptyTapes': """
+    SELECT Count(MediaId)
+    FROM Media,Pool,Storage
+    WHERE Media.PoolId=Pool.PoolId
+    AND Slot>0 AND InChanger=1
+    AND Media.StorageId=Storage.StorageId
+    AND (VolStatus like 'Purged' OR VolStatus like 'Recycle' OR lastwritten+(media.volretention * '1 second'::INTERVAL)<now() AND VolStatus not like 'Error');
+    """,
+    'incrementalJobs': """
+    SELECT JobId, starttime::date, Level, JobStatus, JobBytes
+    FROM Job
+    WHERE (JobId>%s AND (starttime IS NULL OR starttime>=CURRENT_DATE-%s::integer)) OR JobId = ANY(%s::integer[]);
+    """,
+    'trendJobs': """
+    SELECT starttime::date, Level, COALESCE(Client.Name, 'none'), SUM(JobBytes)
+    FROM Job
+    LEFT JOIN Client ON Job.ClientId=Client.ClientId
+    WHERE starttime>=%s::date AND JobStatus IN ('T', 'W')
+    GROUP BY 1, 2, 3;
+    """,
+    'baselineJobs': """
+    SELECT JobId, Name, Level, JobStatus, JobBytes, JobFiles,
+           EXTRACT(EPOCH FROM EndTime-StartTime), EXTRACT(EPOCH FROM now()-EndTime)
+    FROM Job
+    WHERE (JobId>%s OR JobId = ANY(%s::integer[])) AND Type='B'
+    ORDER BY JobId;
+    """,
+    'tapeInventory': """
+    SELECT MediaId, VolStatus,
+           (Slot>0 AND InChanger=1 AND Pool.PoolId IS NOT NULL AND Storage.StorageId IS NOT NULL),
+           VolErrors, VolMounts,
+           EXTRACT(EPOCH FROM lastwritten+(media.volretention * '1 second'::INTERVAL)-now()),
+           Pool.Name, Storage.Name
+    FROM Media
+    LEFT JOIN Pool ON Media.PoolId=Pool.PoolId
+    LEFT JOIN Storage ON Media.StorageId=Storage.StorageId;
+    """,
+    'expiredTapesView': """
+    SELECT Count(MediaId)
+    FROM check_bareos_media_expiry
+    WHERE Expiry<now();
+    """,
+    'willExpireTapesView': """
+    SELECT Count(MediaId)
+    FROM check_bareos_media_expiry
+    WHERE Expiry>now() AND Expiry<now()+(%s * '1 day'::INTERVAL);
+    """,
+    'emptyTapesView': """
+    SELECT Count(MediaId)
+    FROM check_bareos_media_expiry
+    WHERE InStorage AND (VolStatus IN ('Purged', 'Recycle') OR Expiry<now());
+    """,
+    'createExpiryView': """
+    CREATE MATERIALIZED VIEW check_bareos_media_expiry AS
+    SELECT MediaId, VolStatus,
+           (Slot>0 AND InChanger=1
+            AND EXISTS (SELECT 1 FROM Pool WHERE Pool.PoolId=Media.PoolId)
+            AND EXISTS (SELECT 1 FROM Storage WHERE Storage.StorageId=Media.StorageId)) AS InStorage,
+           CASE WHEN volstatus not like 'Error' THEN lastwritten+(media.volretention * '1 second'::INTERVAL) END AS Expiry,
+           now() AS Refreshed
+    FROM Media;
+    CREATE UNIQUE INDEX check_bareos_media_expiry_mediaid_idx ON check_bareos_media_expiry (MediaId);
+    CREATE INDEX check_bareos_media_expiry_expiry_idx ON check_bareos_media_expiry (Expiry);
+    """,
+    'refreshExpiryView': """
+    REFRESH MATERIALIZED VIEW CONCURRENTLY check_bareos_media_expiry;
+    """,
+    'dropExpiryView': """
+    DROP MATERIALIZED VIEW IF EXISTS check_bareos_media_expiry;
+    """,
+    'expiryViewAge': """
+    SELECT EXTRACT(EPOCH FROM now()-(SELECT Refreshed FROM check_bareos_media_expiry LIMIT 1));
+    """,
+    'indexes': """
+    SELECT indexname, indexdef
+    FROM pg_indexes
+    WHERE schemaname = ANY(current_schemas(false)) AND tablename IN ('job', 'media');
+    """,
+    'lastSuccessfulJobs': """
+    SELECT DISTINCT ON (Name, Level) Name, Level, GREATEST(EXTRACT(EPOCH FROM now() - EndTime) / 3600, 0)
+    FROM Job
+    WHERE Type = 'B' AND JobStatus IN ('T', 'W') AND EndTime IS NOT NULL
+    ORDER BY Name, Level, EndTime DESC;
+    """,
+    'replicationLag': """
+    SELECT pg_is_in_recovery(),
+           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                     AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END;
+    """
+}
+
 
 def read_password_from_file(fp):
     """
@@ -93,37 +294,119 @@ def check_threshold(value, warning, critical):
     return OK
 
 
-class Threshold:
-    def __init__(self, threshold):
-        self._threshold = str(threshold)
-        self._min = 0
-        self._max = 0
-        self._inclusive = False
-        self._parse(str(threshold))
+def thresholdState(value, warning, critical):
+    """
+    Returns the state of a value and its label for the output of a check
+    """
+    with phase('threshold'):
+        state = check_threshold(value, warning=warning, critical=critical)
+    return state, "[" + STATE_NAMES[state] + "]"
+
+
+def evaluateThresholds(values, warning, critical):
+    """
+    Evaluates many values against the same thresholds at once.
+    Returns the state of each value, the worst state and the number of values per state.
+    """
+    with phase('threshold'):
+        return _evaluateThresholds(values, warning, critical)
+
+
+def _evaluateThresholds(values, warning, critical):
+    numpy = bulkNumpy(values)
+    if numpy is not None:
+        states = numpy.zeros(len(values), dtype=numpy.int8)
+        if warning is not None:
+            states[warning.violated(values)] = WARNING
+        if critical is not None:
+            states[critical.violated(values)] = CRITICAL
+        counts = {state: int(numpy.count_nonzero(states == state)) for state in (OK, WARNING, CRITICAL)}
+    else:
+        none = array.array('b', bytes(len(values)))
+        warned = warning.violated(values) if warning is not None else none
+        failed = critical.violated(values) if critical is not None else none
+        states = array.array('b', (CRITICAL if c else WARNING if w else OK for w, c in zip(warned, failed)))
+        counts = {state: states.count(state) for state in (OK, WARNING, CRITICAL)}
 
-    def _parse(self, threshold):
-        match = re.search(r'^(@?)((~|\d*):)?(\d*)$', threshold)
+    worst = CRITICAL if counts[CRITICAL] else WARNING if counts[WARNING] else OK
+    return states, worst, counts
 
-        if not match:
-            raise ValueError('Error parsing Threshold: {0}'.format(threshold))
 
-        if match.group(1) == '@':
-            self._inclusive = True
+# Range of a threshold as in the Nagios plugin guidelines: [@][start:][end], each bound
+# a decimal number with an optional unit suffix, ~ as start for negative infinity
+THRESHOLD_NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)'
+THRESHOLD_UNITS = r'(KB|MB|GB|TB|PB|EB)?'
+THRESHOLD_PATTERN = re.compile(r'^(@?)(?:(~|' + THRESHOLD_NUMBER + r')?' + THRESHOLD_UNITS + r':)?(' + THRESHOLD_NUMBER + r')?' + THRESHOLD_UNITS + r'$')
 
-        if match.group(3) == '~':
-            self._min = float('-inf')
-        elif match.group(3):
-            self._min = float(match.group(3))
-        else:
-            self._min = float(0)
 
-        if match.group(4):
-            self._max = float(match.group(4))
-        else:
-            self._max = float('inf')
+def rangeNumber(value):
+    """
+    Formats a bound of a converted range without losing precision and
+    without exponent, which the range syntax does not allow
+    """
+    text = repr(float(value))
+    if 'e' in text:
+        decimals = max(0, 16 - math.floor(math.log10(abs(value))))
+        return '{0:.{1}f}'.format(value, decimals).rstrip('0').rstrip('.')
+    return text[:-2] if text.endswith('.0') else text
+
+
+@functools.lru_cache(maxsize=1024)
+def compileRange(threshold, unit=None):
+    """
+    Parses a threshold range into (min, max, inclusive, converted).
+    Values with a unit suffix are converted into the given unit, into bytes without one.
+    The ranges are cached, so identical thresholds of a batch or the daemon are parsed once.
+    """
+    match = THRESHOLD_PATTERN.match(threshold.strip())
+
+    if not match or (match.group(3) and not match.group(2)) or (match.group(5) and not match.group(4)):
+        raise ValueError('Error parsing Threshold: {0}'.format(threshold))
+
+    def bound(value, suffix):
+        if suffix:
+            return float(value) * createFactor(suffix) / (createFactor(unit) if unit else 1)
+        return float(value)
 
-        if self._max < self._min:
-            raise ValueError('max must be superior to min')
+    inclusive = match.group(1) == '@'
+
+    if match.group(2) == '~':
+        low = float('-inf')
+    elif match.group(2):
+        low = bound(match.group(2), match.group(3))
+    else:
+        low = float(0)
+
+    if match.group(4):
+        high = bound(match.group(4), match.group(5))
+    else:
+        high = float('inf')
+
+    if high < low:
+        raise ValueError('max must be superior to min')
+
+    return low, high, inclusive, bool(match.group(3) or match.group(5))
+
+
+class Threshold:
+    def __init__(self, threshold, unit=None):
+        self._threshold = str(threshold)
+        self._min, self._max, self._inclusive, self._converted = compileRange(self._threshold, unit)
+
+    def violated(self, values):
+        """
+        Returns for each value whether it is outside of the threshold, as NumPy array for
+        many values if NumPy is installed and as array of 0 and 1 otherwise
+        """
+        numpy = bulkNumpy(values)
+        if numpy is not None:
+            values = numpy.asarray(values, dtype=float)
+            inside = (values >= self._min) & (values <= self._max)
+            return inside if self._inclusive else ~inside
+
+        if self._inclusive:
+            return array.array('b', (self._min <= float(value) <= self._max for value in values))
+        return array.array('b', (not self._min <= float(value) <= self._max for value in values))
 
     def check(self, value):
         # check if a value is correct according to threshold
@@ -136,7 +419,18 @@ class Threshold:
         return '{0}({1})'.format(self.__class__.__name__, self._threshold)
 
     def __str__(self) -> str:
-        return self._threshold
+        if not self._converted:
+            return self._threshold
+
+        # The perfdata needs the converted range without unit suffixes
+        output = "@" if self._inclusive else ""
+        if self._min == float('-inf'):
+            output += "~:"
+        elif self._min != 0:
+            output += rangeNumber(self._min) + ":"
+        if self._max != float('inf'):
+            output += rangeNumber(self._max)
+        return output
 
 
 def createBackupKindString(full, inc, diff):
@@ -158,90 +452,798 @@ def createFactor(unit):
                'PB': 2 ** 50,
                'TB': 2 ** 40,
                'GB': 2 ** 30,
-               'MB': 10 ** 20}
+               'MB': 2 ** 20,
+               'KB': 2 ** 10}
     return options[unit]
 
+# Upper bounds in days of the buckets of the expiry histogram
+EXPIRY_BUCKETS = [1, 7, 30, 90, 365]
+
+# Length in days of the buckets of the backup trend and the number of days it is forecast
+TREND_BUCKETS = {'day': 1, 'week': 7}
+TREND_HORIZON = 365
+
+# Indexes that let the checks avoid sequential scans over the catalog.
+# Each entry lists the checks it serves as (subcommand, option), None for every check of the subcommand, and a pattern
+# matching the definition of an equivalent index as shown in pg_indexes.
+INDEXES = [
+    {
+        "name": "check_bareos_job_status_idx",
+        "definition": "CREATE INDEX check_bareos_job_status_idx ON Job (JobStatus, StartTime) INCLUDE (Level, JobBytes);",
+        "pattern": r"\(jobstatus, starttime\)",
+        "checks": [('job', 'checkJobs'), ('job', 'runTimeJobs'), ('status', 'totalBackupsSize'), ('status', 'oversizedBackups')],
+        "reason": "index-only scans for the job counts and sizes by state and start time",
+    },
+    {
+        "name": "check_bareos_job_failed_idx",
+        "definition": "CREATE INDEX check_bareos_job_failed_idx ON Job (StartTime) WHERE JobStatus IN ('E', 'f');",
+        "pattern": r"\(starttime\).*where.*jobstatus",
+        "checks": [('status', 'failedBackups')],
+        "reason": "partial index over the few failed jobs",
+    },
+    {
+        "name": "check_bareos_job_empty_idx",
+        "definition": "CREATE INDEX check_bareos_job_empty_idx ON Job (StartTime) INCLUDE (JobStatus, Level) WHERE JobBytes = 0;",
+        "pattern": r"\(starttime\).*where.*jobbytes = 0",
+        "checks": [('status', 'emptyBackups')],
+        "reason": "partial index over the jobs without data",
+    },
+    {
+        "name": "check_bareos_job_name_idx",
+        "definition": "CREATE INDEX check_bareos_job_name_idx ON Job USING gin (Name gin_trgm_ops);",
+        "pattern": r"gin \(name gin_trgm_ops\)",
+        "checks": [('job', 'checkJob')],
+        "reason": "substring search on the job name, requires CREATE EXTENSION pg_trgm",
+    },
+    {
+        "name": "check_bareos_job_freshness_idx",
+        "definition": "CREATE INDEX check_bareos_job_freshness_idx ON Job (Name, Level, EndTime DESC) WHERE Type = 'B' AND JobStatus IN ('T', 'W');",
+        "pattern": r"\(name, level, endtime desc\)",
+        "checks": [('freshness', None)],
+        "reason": "the last successful backup per job name and level in index order",
+    },
+    {
+        "name": "check_bareos_media_expiry_idx",
+        "definition": "CREATE INDEX check_bareos_media_expiry_idx ON Media ((lastwritten+(volretention * '1 second'::INTERVAL)));",
+        "pattern": r"\(\(?lastwritten \+",
+        "checks": [('tape', 'expiredTapes'), ('tape', 'willExpire'), ('tape', 'emptyTapes')],
+        "reason": "range scans on the expiry time of the volumes",
+    },
+    {
+        "name": "check_bareos_media_inchanger_idx",
+        "definition": "CREATE INDEX check_bareos_media_inchanger_idx ON Media (PoolId, StorageId) WHERE Slot > 0 AND InChanger = 1;",
+        "pattern": r"where.*slot > 0.*inchanger = 1",
+        "checks": [('tape', 'tapesInStorage'), ('tape', 'emptyTapes')],
+        "reason": "partial index over the volumes in the changer",
+    },
+]
+
+# Conditions of the tape checks over Media joined with Pool and Storage, used by the grouped queries
+MEDIA_JOINS = "LEFT JOIN Pool ON Media.PoolId=Pool.PoolId LEFT JOIN Storage ON Media.StorageId=Storage.StorageId"
+TAPE_CONDITIONS = {
+    'tapesInStorage': "Slot>0 AND InChanger=1 AND Pool.PoolId IS NOT NULL AND Storage.StorageId IS NOT NULL",
+    'expiredTapes': "lastwritten+(media.volretention * '1 second'::INTERVAL)<now() AND volstatus not like 'Error'",
+    'willExpireTapes': "lastwritten+(media.volretention * '1 second'::INTERVAL)<now()+(%s * '1 day'::INTERVAL) "
+                       "AND lastwritten+(media.volretention * '1 second'::INTERVAL)>now() AND volstatus not like 'Error'",
+    'replaceTapes': "(VolErrors>0) OR (VolStatus='Error') OR (VolMounts>%s) OR (VolStatus='Disabled')",
+    'emptyTapes': "Slot>0 AND InChanger=1 AND Pool.PoolId IS NOT NULL AND Storage.StorageId IS NOT NULL "
+                  "AND (VolStatus like 'Purged' OR VolStatus like 'Recycle' OR lastwritten+(media.volretention * '1 second'::INTERVAL)<now() AND VolStatus not like 'Error')",
+}
 
-def checkFailedBackups(cursor, time, warning, critical):
-    checkState = {}
+# Columns the perfdata can be grouped by and the joins they need, per table
+GROUPS = {
+    'Job': {
+        'pool': ("Pool.Name", "LEFT JOIN Pool ON Job.PoolId=Pool.PoolId"),
+        'client': ("Client.Name", "LEFT JOIN Client ON Job.ClientId=Client.ClientId"),
+        'jobname': ("Job.Name", ""),
+    },
+    'Media': {
+        'pool': ("Pool.Name", MEDIA_JOINS),
+        'storage': ("Storage.Name", MEDIA_JOINS),
+    },
+}
 
-    if time is None:
-        time = 7
 
-    query = """
-    SELECT Job.Name,Level,starttime, JobStatus
-    FROM Job
-    WHERE JobStatus in ('E','f') AND starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL);
+class JobFilter: # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    """
+    Selects rows of the Job table for the job and status checks.
+    Builds the WHERE condition of a single check and the conditional
+    aggregates of the JobStatistics.
+    """
+    def __init__(self, states=None, kind=None, time=None, before=False, midnight=True, unstarted=False, name=None, empty=False, size=None):
+        self.states = states
+        self.kind = kind
+        self.time = time
+        self.before = before
+        self.midnight = midnight
+        self.unstarted = unstarted
+        self.name = name
+        self.empty = empty
+        self.size = size
+
+    def condition(self):
+        """
+        Returns the WHERE condition with placeholders and the list of its parameters
+        """
+        conditions = []
+        params = []
+
+        if self.name is not None:
+            conditions.append("Job.Name like %s")
+            params.append('%' + self.name + '%')
+        if self.states is not None:
+            # JobStatus and Level are char(1) columns, comparing them with text would prevent index scans
+            conditions.append("JobStatus = ANY(%s::bpchar[])")
+            params.append(list(self.states))
+        if self.time is not None:
+            start = "starttime " + ("<" if self.before else ">") + " (" + ("now()::date" if self.midnight else "now()") + "-%s * '1 day'::INTERVAL)"
+            if self.unstarted:
+                start = "(" + start + " OR starttime IS NULL)"
+            conditions.append(start)
+            params.append(float(self.time))
+        if self.kind is not None:
+            conditions.append("Level = ANY(%s::bpchar[])")
+            params.append([k.strip("' ") for k in self.kind.split(',')])
+        if self.empty:
+            conditions.append("JobBytes=0")
+        if self.size is not None:
+            conditions.append("JobBytes>%s")
+            params.append(float(self.size))
+
+        return (" AND ".join(conditions) if conditions else "TRUE"), params
+
+
+AGGREGATE_PATTERN = re.compile(r"\b(COUNT|SUM|AVG|MIN|MAX)\(", re.IGNORECASE)
+
+
+def filterAggregate(aggregate, condition):
     """
+    Adds the FILTER clause to the aggregate function call in the expression,
+    e.g. ROUND(SUM(JobBytes),3) becomes ROUND(SUM(JobBytes) FILTER (WHERE ...),3)
+    """
+    match = AGGREGATE_PATTERN.search(aggregate)
+    if match is None:
+        raise ValueError('No aggregate function in {0}'.format(aggregate))
 
-    cursor.execute(query)
-    results = cursor.fetchall()
-    result = len(results)
+    depth = 0
+    for end in range(match.end() - 1, len(aggregate)):
+        depth += {'(': 1, ')': -1}.get(aggregate[end], 0)
+        if depth == 0:
+            break
+    return aggregate[:end + 1] + " FILTER (WHERE " + condition + ")" + aggregate[end + 1:]
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
 
-    checkState["returnMessage"] +=  " - " + str(result) + " Backups failed/canceled in the last " + str(time) + " days"
+class JobStatistics:
+    """
+    Computes the counters of many job checks with one query over the Job table.
+    The checks are evaluated twice: the first pass registers the aggregates they need,
+    collect() fetches all of them with conditional aggregates and the second pass reads the results.
+    """
+    def __init__(self):
+        # Maps each aggregate to its expression, condition and parameters
+        self._aggregates = {}
+        self._values = None
 
-    checkState["performanceData"] = "bareos.backup.failed=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    def value(self, aggregate, jobFilter):
+        condition, params = jobFilter.condition()
+        expression = filterAggregate(aggregate, condition)
+        key = expression + repr(params)
 
-    return checkState
+        if self._values is not None:
+            return self._values[key]
 
+        self._aggregates.setdefault(key, (expression, condition, params))
+        return 0
 
-def checkBackupSize(cursor, time, kind, factor):
-    query = """
-    SELECT ROUND(SUM(JobBytes/""" + str(float(factor)) + """),3)
-    FROM Job
-    Where Level in (""" + kind + """);
+    def query(self):
+        """
+        Returns the query over all registered aggregates and its parameters
+        """
+        expressions = []
+        params = []
+        for expression, _, aggregateParams in self._aggregates.values():
+            expressions.append(expression)
+            params.extend(aggregateParams)
+
+        # Only rows matching at least one of the filters need to be aggregated
+        conditions = {}
+        for _, condition, conditionParams in self._aggregates.values():
+            conditions.setdefault(condition + repr(conditionParams), (condition, conditionParams))
+        for _, conditionParams in conditions.values():
+            params.extend(conditionParams)
+
+        query = "SELECT " + ", ".join(expressions) + " FROM Job WHERE (" + ") OR (".join(c for c, _ in conditions.values()) + ");"
+        return query, params
+
+    def collect(self, cursor):
+        values = []
+        if self._aggregates:
+            cursor.execute(*self.query())
+            values = cursor.fetchone()
+        self._values = dict(zip(self._aggregates, values))
+
+
+def queryJobAggregate(cursor, aggregate, jobFilter, stats=None):
+    """
+    Returns an aggregate over the Job rows matching the filter,
+    read from the JobStatistics if given or with its own query
     """
+    if stats is not None:
+        return stats.value(aggregate, jobFilter)
+
+    condition, params = jobFilter.condition()
+    cursor.execute("SELECT " + aggregate + " FROM Job WHERE " + condition + ";", params)
+    return cursor.fetchone()[0]
+
 
-    if time is not None:
-        query = """
-        SELECT ROUND(SUM(JobBytes/""" + str(float(factor)) + """),3)
-        FROM Job
-        Where Level in (""" + kind + """) and starttime > (now()-""" + str(time) + """ * '1 day'::INTERVAL) ;
+# Name of the series summing up the groups without their own series
+OTHER_GROUP = '__other__'
+
+
+class PerfGroups:
+    """
+    Splits the value of a check into one perfdata series per pool, storage, client or job name.
+    The values of all groups are fetched with one GROUP BY query. Only the limit largest groups
+    get their own series, the others are summed up in an '__other__' series to bound the number of labels.
+    """
+    def __init__(self, kind, limit=10, warning=None, critical=None):
+        self.kind = kind
+        self.limit = limit
+        self.warning = warning
+        self.critical = critical
+        # Number of groups per state after the last performanceData()
+        self.counts = {}
+
+    def query(self, cursor, table, aggregate, condition, params):
         """
+        Returns the aggregate of the rows matching the condition per group as (name, value)
+        """
+        if self.kind not in GROUPS[table]:
+            raise ValueError('Grouping by ' + self.kind + ' is not supported for this check')
+
+        column, joins = GROUPS[table][self.kind]
+        cursor.execute("SELECT COALESCE(" + column + ", 'none'), " + aggregate + " FROM " + table + " " + joins +
+                       " WHERE " + condition + " GROUP BY 1;", params)
+        return cursor.fetchall()
+
+    def performanceData(self, label, groups):
+        """
+        Returns the values of the largest groups and the sum of the others as perfdata
+        """
+        groups = sorted(((str(name), value or 0) for name, value in groups), key=lambda group: (-group[1], group[0]))
+        shown = groups[:self.limit] if self.limit else groups
+
+        if self.warning is not None or self.critical is not None:
+            # Every group is evaluated against the thresholds of the check
+            _, _, self.counts = evaluateThresholds([value for _, value in groups], self.warning, self.critical)
+
+        output = ""
+        for name, value in shown:
+            output += " " + perfLabel(label + "." + self.kind + "." + name) + "=" + str(value)
+        if len(groups) > len(shown):
+            # Group names come from the catalog, the reserved name cannot collide with a pool named other
+            output += " " + perfLabel(label + "." + self.kind + "." + OTHER_GROUP) + "=" + str(sum(value for _, value in groups[len(shown):]))
+
+        return output
+
+    def summary(self):
+        """
+        Returns the number of groups exceeding the thresholds for the output of the check
+        """
+        exceeding = [str(self.counts[state]) + " " + STATE_NAMES[state] for state in (CRITICAL, WARNING) if self.counts.get(state)]
+        if not exceeding:
+            return ""
+        return " (" + self.kind + ": " + ", ".join(exceeding) + ")"
+
+
+def aggregateJobs(cursor, aggregate, jobFilter, label, stats=None, groups=None):
+    """
+    Returns an aggregate over the Job rows matching the filter and the perfdata of its groups
+    """
+    if groups is None:
+        return queryJobAggregate(cursor, aggregate, jobFilter, stats), ""
+
+    condition, params = jobFilter.condition()
+    rows = groups.query(cursor, 'Job', aggregate, condition, params)
+
+    return sum(value or 0 for _, value in rows), groups.performanceData(label, rows)
+
+
+@contextlib.contextmanager
+def lockedState(path):
+    """
+    Holds the lock of a state file, concurrent runs must not update the state file at the same time
+    """
+    with open(path + '.lock', 'a', encoding='utf-8') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+
+
+class StateFile:
+    """
+    Base of the checks keeping their state between runs in a local JSON file.
+    The attributes named in FIELDS are saved, a missing file leaves them at their defaults.
+    """
+    FIELDS = ()
+
+    def __init__(self, path):
+        self.path = path
+
+    def accepts(self, state): # pylint: disable=unused-argument
+        # Returns if the state read from the file can be used, otherwise it is rebuilt
+        return True
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as statefile:
+                state = json.load(statefile)
+        except FileNotFoundError:
+            return
+        if not self.accepts(state):
+            return
+        for field in self.FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
+
+    def save(self):
+        tmp = self.path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as statefile:
+            json.dump({field: getattr(self, field) for field in self.FIELDS}, statefile)
+        os.replace(tmp, self.path)
+
+    def lockedUpdate(self, cursor, *args):
+        """
+        Loads the state, updates it from the catalog and saves it while holding the lock of the state file
+        """
+        with lockedState(self.path):
+            self.load()
+            self.update(cursor, *args)
+            self.save()
+
+    def update(self, cursor, *args):
+        raise NotImplementedError
+
+
+class JobWatermark(StateFile): # pylint: disable=abstract-method
+    """
+    Base of the states reading only the jobs new since the last run. Remembers the highest
+    JobId seen and the unfinished jobs, which are fetched again until they are finished.
+    """
+    # Jobs in these states do not change anymore
+    FINAL_STATES = 'ADEITWef'
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.watermark = 0
+        # Unfinished jobs, fetched again until they are finished
+        self.pending = []
+
+    def finishedJobs(self, rows, stateColumn, endColumn=None):
+        """
+        Yields the rows of the finished jobs and advances the watermark over all rows, the JobId is the first column.
+        Jobs in another state than FINAL_STATES or without a value in endColumn become the pending jobs.
+        """
+        pending = []
+        for row in rows:
+            self.watermark = max(self.watermark, row[0])
+            if row[stateColumn] not in self.FINAL_STATES or (endColumn is not None and row[endColumn] is None):
+                pending.append(row[0])
+                continue
+            yield row
+
+        # Deleted jobs are not returned anymore and dropped from the pending jobs
+        self.pending = pending
+
+
+class IncrementalJobState(JobWatermark): # pylint: disable=too-many-instance-attributes
+    """
+    Keeps per-day aggregates of the finished jobs in a local state file, so the time-windowed
+    status checks only fetch the jobs that are new or unfinished since the last run.
+    Implements the value() interface of the JobStatistics for the supported filters.
+    """
+    FIELDS = ('watermark', 'retention', 'pending', 'sizes', 'counted', 'days')
+    # JobIds below the highest one seen that are fetched again, jobs can be committed after jobs with higher JobIds
+    JOBID_OVERLAP = 100
+
+    def __init__(self, path):
+        super().__init__(path)
+        # Counted jobs within the overlap, they are not counted again
+        self.counted = []
+        self.retention = 0
+        self.today = None
+        # JobBytes limits the jobs larger than them are counted for
+        self.sizes = []
+        # days[day][level][state] = [jobs, empty jobs, [jobs larger than each of the sizes]]
+        self.days = {}
+
+    def accepts(self, state):
+        # State files of older versions are rebuilt
+        return 'sizes' in state
+
+    def update(self, cursor, time, sizes=()): # pylint: disable=arguments-differ
+        """
+        Fetches the new and unfinished jobs and ages out the days older than the time window.
+        The jobs larger than each of the sizes in bytes are counted for the oversized backups.
+        """
+        sizes = [float(size) for size in sizes]
+        if time > self.retention or not set(sizes) <= set(self.sizes):
+            # The state does not cover the requested window or sizes, rebuild it for all checks sharing it
+            self.watermark = 0
+            self.retention = max(self.retention, time)
+            self.pending = []
+            self.counted = []
+            self.sizes = sorted(set(self.sizes) | set(sizes))
+            self.days = {}
+
+        counted = set(self.counted)
+        cursor.execute(QUERIES['incrementalJobs'], (max(0, self.watermark - self.JOBID_OVERLAP), self.retention, self.pending))
+        rows = cursor.fetchall()
+
+        cursor.execute("SELECT CURRENT_DATE;")
+        self.today = cursor.fetchone()[0]
+
+        for jobId, day, level, state, jobBytes in self.finishedJobs(rows, 3, 1):
+            if jobId in counted:
+                continue
+            counted.add(jobId)
+            counters = self.days.setdefault(str(day), {}).setdefault(level, {}).setdefault(state, [0, 0, [0] * len(self.sizes)])
+            counters[0] += 1
+            counters[1] += 1 if not jobBytes else 0
+            for i, size in enumerate(self.sizes):
+                counters[2][i] += 1 if (jobBytes or 0) > size else 0
+
+        self.counted = sorted(jobId for jobId in counted if jobId > self.watermark - self.JOBID_OVERLAP)
+
+        oldest = str(self.today - datetime.timedelta(days=self.retention))
+        self.days = {day: levels for day, levels in self.days.items() if day >= oldest}
+
+    def supports(self, aggregate, jobFilter):
+        # Only counts of finished jobs in the last n days are kept
+        if aggregate != "COUNT(*)" or jobFilter.name is not None or jobFilter.time is None:
+            return False
+        if not float(jobFilter.time).is_integer():
+            # Whole-day buckets cannot represent fractional windows
+            return False
+        if jobFilter.before or not jobFilter.midnight:
+            return False
+        if jobFilter.size is not None and float(jobFilter.size) not in self.sizes:
+            return False
+        return set(jobFilter.states or self.FINAL_STATES) <= set(self.FINAL_STATES)
+
+    def value(self, aggregate, jobFilter):
+        if not self.supports(aggregate, jobFilter):
+            raise ValueError('Check not supported in incremental mode')
+
+        oldest = str(self.today - datetime.timedelta(days=float(jobFilter.time)))
+        levels = [k.strip("' ") for k in jobFilter.kind.split(',')] if jobFilter.kind is not None else None
+
+        result = 0
+        for day, dayLevels in self.days.items():
+            if day < oldest:
+                continue
+            for level, states in dayLevels.items():
+                if levels is not None and level not in levels:
+                    continue
+                for state, (jobs, empty, larger) in states.items():
+                    if jobFilter.states is not None and state not in jobFilter.states:
+                        continue
+                    if jobFilter.size is not None:
+                        result += larger[self.sizes.index(float(jobFilter.size))]
+                    elif jobFilter.empty:
+                        result += empty
+                    else:
+                        result += jobs
+
+        return result
+
+
+class BackupTrend(StateFile):
+    """
+    Keeps the daily JobBytes of the successful jobs per level and client, fetched with one grouped query.
+    With a state file the days are cached locally and only the last days are fetched again on each run.
+    """
+    FIELDS = ('since', 'fetched', 'days')
+    # Jobs started on these last days might still be running
+    REFRESH_DAYS = 2
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.today = None
+        # Oldest day covered by the cached days
+        self.since = None
+        # Day of the last update, the days since then are fetched again
+        self.fetched = None
+        # days[day][level][client] = JobBytes
+        self.days = {}
+
+    def update(self, cursor, days): # pylint: disable=arguments-differ
+        """
+        Fetches the days missing in the cache and the last days, drops the days older than the window.
+        The last days before the previous update are fetched again as well, so no days are missed after a pause.
+        """
+        cursor.execute("SELECT CURRENT_DATE;")
+        self.today = cursor.fetchone()[0]
+
+        oldest = str(self.today - datetime.timedelta(days=days))
+        start = oldest
+        if self.since is not None and self.since <= oldest and self.fetched is not None:
+            fetched = datetime.date.fromisoformat(self.fetched)
+            start = max(oldest, str(min(fetched, self.today) - datetime.timedelta(days=self.REFRESH_DAYS)))
+
+        cursor.execute(QUERIES['trendJobs'], (start,))
+        rows = cursor.fetchall()
+
+        self.days = {day: levels for day, levels in self.days.items() if oldest <= day < start}
+        for day, level, client, jobBytes in rows:
+            self.days.setdefault(str(day), {}).setdefault(level, {})[client] = float(jobBytes or 0)
+        self.since = oldest
+        self.fetched = str(self.today)
+
+    def series(self, bucketDays, days, key=None):
+        """
+        Returns the JobBytes of each complete bucket in the window, oldest first.
+        Without key the total, otherwise a series per level (key=0) or per client (key=1).
+        """
+        count = days // bucketDays
+        first = self.today - datetime.timedelta(days=count * bucketDays)
+
+        series = {}
+        for day, levels in self.days.items():
+            position = (datetime.date.fromisoformat(day) - first).days // bucketDays
+            if not 0 <= position < count:
+                continue
+            for level, clients in levels.items():
+                for client, jobBytes in clients.items():
+                    name = 'total' if key is None else (level, client)[key]
+                    series.setdefault(name, [0.0] * count)[position] += jobBytes
+
+        if key is None:
+            return series.get('total', [0.0] * count)
+        return series
+
+
+def fitTrend(values, model='linear'):
+    """
+    Returns a function predicting the value of a bucket from a least squares fit over the values,
+    for exponential growth the fit is made over the logarithm of the values
+    """
+    points = [(x, math.log(y) if model == 'exponential' else y) for x, y in enumerate(values) if model != 'exponential' or y > 0]
+    if not points:
+        return lambda x: 0.0
+
+    meanX = sum(x for x, _ in points) / len(points)
+    meanY = sum(y for _, y in points) / len(points)
+    variance = sum((x - meanX) ** 2 for x, _ in points)
+    slope = sum((x - meanX) * (y - meanY) for x, y in points) / variance if variance else 0.0
+    intercept = meanY - slope * meanX
+
+    if model == 'exponential':
+        return lambda x: math.exp(min(intercept + slope * x, 700))
+    return lambda x: max(0.0, intercept + slope * x)
+
+
+def forecastDaysLeft(values, predict, capacity, bucketDays, horizon=TREND_HORIZON):
+    """
+    Returns the days until the backups of the window exceed the capacity, None if not within the horizon.
+    The stored size is the sum over the window, which slides forward over the predicted buckets.
+    """
+    window = list(values)
+    stored = sum(window)
+    if stored >= capacity:
+        return 0
+
+    for k in range(1, horizon // bucketDays + 1):
+        predicted = predict(len(values) - 1 + k)
+        stored += predicted - window.pop(0)
+        window.append(predicted)
+        if stored >= capacity:
+            return k * bucketDays
+
+    return None
+
+
+class JobBaselines(JobWatermark): # pylint: disable=too-many-instance-attributes
+    """
+    Keeps an exponentially weighted moving average of JobBytes, JobFiles and the runtime
+    per job name and level in a local state file. Each run only reads the jobs finished since
+    the last run and compares them with their baseline before it is updated.
+    """
+    FIELDS = ('watermark', 'pending', 'jobs', 'anomalies')
+
+    def __init__(self, path, alpha=0.2, minSamples=5, durationFactor=3, sizeFactor=10):
+        super().__init__(path)
+        self.alpha = alpha
+        self.minSamples = minSamples
+        self.durationFactor = durationFactor
+        self.sizeFactor = sizeFactor
+        # jobs[name/level] = [samples, JobBytes, JobFiles, runtime in seconds]
+        self.jobs = {}
+        # Jobs that deviated from their baseline, kept for the time window
+        self.anomalies = []
+
+    def deviations(self, baseline, jobBytes, jobFiles, runtime):
+        """
+        Returns how a job deviates from its baseline, empty if it does not
+        """
+        samples, meanBytes, meanFiles, meanRuntime = baseline
+        if samples < self.minSamples:
+            return []
+
+        reasons = []
+        if meanRuntime > 0 and runtime >= meanRuntime * self.durationFactor:
+            reasons.append("runtime " + str(round(runtime / meanRuntime, 1)) + "x the usual " + str(datetime.timedelta(seconds=round(meanRuntime))))
+        for label, value, mean in (("bytes", jobBytes, meanBytes), ("files", jobFiles, meanFiles)):
+            if mean > 0 and (value * self.sizeFactor <= mean or value >= mean * self.sizeFactor):
+                reasons.append(label + " " + str(round(value)) + " instead of about " + str(round(mean)))
+        return reasons
+
+    def update(self, cursor, time, itersize=1000): # pylint: disable=arguments-differ
+        """
+        Compares the jobs finished since the last run with their baseline and updates it.
+        The jobs are streamed through a server-side cursor, the first run reads the whole history.
+        """
+        now = datetime.datetime.now().timestamp()
+        window = float(time) * 86400
+
+        jobs = cursor.connection.cursor(name='check_bareos_baselines')
+        jobs.itersize = itersize
+        jobs.execute(QUERIES['baselineJobs'], (self.watermark, self.pending))
+
+        for jobId, name, level, state, jobBytes, jobFiles, runtime, age in self.finishedJobs(jobs, 3):
+            if state not in 'TW' or runtime is None:
+                continue
+
+            jobBytes, jobFiles, runtime = float(jobBytes or 0), float(jobFiles or 0), float(runtime)
+            key = name + '/' + level
+            baseline = self.jobs.get(key)
+
+            if baseline is None:
+                self.jobs[key] = [1, jobBytes, jobFiles, runtime]
+                continue
+
+            if age is not None and float(age) < window:
+                reasons = self.deviations(baseline, jobBytes, jobFiles, runtime)
+                if reasons:
+                    self.anomalies.append({'jobid': jobId, 'name': name, 'level': level, 'ended': now - float(age), 'reasons': reasons})
+
+            baseline[0] += 1
+            for i, value in enumerate((jobBytes, jobFiles, runtime), 1):
+                baseline[i] += self.alpha * (value - baseline[i])
+
+        jobs.close()
+
+        self.anomalies = [anomaly for anomaly in self.anomalies if now - anomaly['ended'] < window]
 
-    cursor.execute(query)
-    results = cursor.fetchone()
 
-    return results[0]
+def fetchJobDetails(cursor, jobFilter, limit, order="starttime DESC"):
+    """
+    Returns a line for at most limit Job rows matching the filter.
+    The rows are streamed through a server-side cursor, so only the
+    returned rows are transferred and kept in memory.
+    """
+    details = cursor.connection.cursor(name='check_bareos_details')
+    details.itersize = min(limit, 100)
+
+    condition, params = jobFilter.condition()
+    details.execute("SELECT Job.Name, Level, JobStatus, starttime, JobBytes FROM Job WHERE " + condition + " ORDER BY " + order + " LIMIT %s;", params + [int(limit)])
+
+    lines = []
+    for name, level, state, starttime, jobBytes in details:
+        lines.append(name + " Level: " + str(level) + " State: " + JOBSTATES.get(state, str(state)) + " Start: " + str(starttime) + " Bytes: " + str(jobBytes))
+
+    details.close()
+
+    return lines
+
+
+# Columns of the job report as (field name, expression)
+REPORT_COLUMNS = [
+    ('jobid', "JobId"),
+    ('name', "Job.Name"),
+    ('client', "Client.Name"),
+    ('level', "Level"),
+    ('status', "JobStatus"),
+    ('starttime', "StartTime"),
+    ('endtime', "EndTime"),
+    ('jobfiles', "JobFiles"),
+    ('jobbytes', "JobBytes"),
+]
+
+
+def streamJobReport(cursor, jobFilter, out, outputFormat='ndjson', itersize=1000, limit=0):
+    """
+    Writes the Job rows matching the filter to out as NDJSON or CSV and returns their number.
+    The rows are streamed through a server-side cursor in batches of itersize rows,
+    so the memory use does not depend on the number of jobs.
+    """
+    report = cursor.connection.cursor(name='check_bareos_report')
+    report.itersize = itersize
+
+    condition, params = jobFilter.condition()
+    query = ("SELECT " + ", ".join(expression for _, expression in REPORT_COLUMNS) +
+             " FROM Job LEFT JOIN Client ON Job.ClientId=Client.ClientId WHERE " + condition + " ORDER BY JobId")
+    if limit:
+        query += " LIMIT %s"
+        params = params + [int(limit)]
+    report.execute(query + ";", params)
+
+    fields = [field for field, _ in REPORT_COLUMNS]
+    writer = None
+    if outputFormat == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(fields)
+
+    count = 0
+    for row in report:
+        if writer is not None:
+            writer.writerow(["" if value is None else str(value) for value in row])
+        else:
+            out.write(json.dumps(dict(zip(fields, row)), default=str) + "\n")
+        count += 1
+
+    report.close()
+
+    return count
+
 
+def addJobDetails(checkState, cursor, jobFilter, result, details, order="starttime DESC"):
+    # Lists the matching jobs in the long output
+    if details and result:
+        checkState["longOutput"] = "\n".join(fetchJobDetails(cursor, jobFilter, details, order))
 
-def checkTotalBackupSize(cursor, time, kind, unit, warning, critical):
+
+def checkFailedBackups(cursor, time, warning, critical, stats=None, details=0, groups=None):
     checkState = {}
 
-    result = checkBackupSize(cursor, time, kind, createFactor(unit))
+    if time is None:
+        time = 7
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
+    jobFilter = JobFilter(states=['E', 'f'], time=time)
+    result, groupData = aggregateJobs(cursor, "COUNT(*)", jobFilter, "bareos.backup.failed", stats, groups)
 
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
+
+    checkState["returnMessage"] +=  " - " + str(result) + " Backups failed/canceled in the last " + str(time) + " days"
+
+    checkState["performanceData"] = "bareos.backup.failed=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
+
+    addJobDetails(checkState, cursor, jobFilter, result, details)
+
+    return checkState
+
+
+def checkBackupSize(cursor, time, kind, factor, stats=None):
+    jobFilter = JobFilter(kind=kind, time=time, midnight=False)
+
+    return queryJobAggregate(cursor, "ROUND(SUM(JobBytes/" + str(float(factor)) + "),3)", jobFilter, stats)
+
+
+def checkTotalBackupSize(cursor, time, kind, unit, warning, critical, stats=None, groups=None):
+    checkState = {}
+
+    if groups is not None:
+        jobFilter = JobFilter(kind=kind, time=time, midnight=False)
+        result, groupData = aggregateJobs(cursor, "ROUND(SUM(JobBytes/" + str(float(createFactor(unit))) + "),3)", jobFilter, "bareos.backup.size", groups=groups)
     else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+        result = checkBackupSize(cursor, time, kind, createFactor(unit), stats)
+        # The sum over no jobs is NULL
+        if result is None:
+            result = 0
+        groupData = ""
+
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " " + unit + " Kind:" + kind
 
     if time:
         checkState["returnMessage"] += " Days: " + str(time)
 
-    checkState["performanceData"] = "bareos.backup.size=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.backup.size=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
 
     return checkState
 
 
-def checkOversizedBackups(cursor, time, size, kind, unit, warning, critical):
+def checkOversizedBackups(cursor, time, size, kind, unit, warning, critical, stats=None, details=0, groups=None):
     checkState = {}
 
     if time is None:
@@ -249,89 +1251,56 @@ def checkOversizedBackups(cursor, time, size, kind, unit, warning, critical):
 
     factor = createFactor(unit)
 
-    query = """
-    SELECT Job.Name,Level,starttime, JobBytes/""" + str(float(factor)) + """
-    FROM Job
-    WHERE Level in (""" + kind + """) AND starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL) AND JobBytes/""" + str(float(factor)) + """>""" + str(size) + """;
-    """
-
-    cursor.execute(query)
-    results = cursor.fetchall()
-    result = len(results)
+    # Compare the raw JobBytes so an index on JobBytes can be used
+    jobFilter = JobFilter(kind=kind, time=time, size=float(size) * factor)
+    result, groupData = aggregateJobs(cursor, "COUNT(*)", jobFilter, "bareos.backup.oversized", stats, groups)
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " " + kind + " Backups larger than " + str(size) + " " + unit + " in the last " + str(time) + " days"
 
-    checkState["performanceData"] = "bareos.backup.oversized=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.backup.oversized=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
+
+    addJobDetails(checkState, cursor, jobFilter, result, details, order="JobBytes DESC")
 
     return checkState
 
 
-def checkEmptyBackups(cursor, time, kind, warning, critical):
+def checkEmptyBackups(cursor, time, kind, warning, critical, stats=None, details=0, groups=None):
     checkState = {}
 
     if time is None:
         time = 7
 
-    query = """
-    SELECT Job.Name,Level,starttime
-    FROM Job
-    WHERE Level in (""" + str(kind) + """) AND JobBytes=0 AND starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL) AND JobStatus in ('T');
-    """
+    jobFilter = JobFilter(states=['T'], kind=str(kind), time=time, empty=True)
+    result, groupData = aggregateJobs(cursor, "COUNT(*)", jobFilter, "bareos.backup.empty", stats, groups)
 
-    cursor.execute(query)
-    results = cursor.fetchall()
-    result = len(results)
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL] - " + str(result) + " successful " + str(kind) + " backups are empty"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING] - " + str(result) + " successful " + str(kind) + " backups are empty!"
+    if checkState["returnCode"] == CRITICAL:
+        checkState["returnMessage"] += " - " + str(result) + " successful " + str(kind) + " backups are empty"
+    elif checkState["returnCode"] == WARNING:
+        checkState["returnMessage"] += " - " + str(result) + " successful " + str(kind) + " backups are empty!"
     else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK] - All " + str(kind) + " Backups are fine"
+        checkState["returnMessage"] += " - All " + str(kind) + " Backups are fine"
 
-    checkState["performanceData"] = "bareos.backup.empty=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.backup.empty=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
+
+    addJobDetails(checkState, cursor, jobFilter, result, details)
 
     return checkState
 
 
-def checkJobs(cursor, state, kind, time, warning, critical):
+def checkJobs(cursor, state, kind, time, warning, critical, stats=None):
     checkState = {}
 
     if time is None:
         time = 7
 
-    query = """
-    SELECT count(Job.Name)
-    FROM Job
-    WHERE Job.JobStatus like '""" + str(state) + """' AND (starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL) OR starttime IS NULL) AND Job.Level in (""" + kind + """);
-    """
-
-    cursor.execute(query)
-    results = cursor.fetchone()
-    result = float(results[0])
+    jobFilter = JobFilter(states=[str(state)], kind=kind, time=time, unstarted=True)
+    result = float(queryJobAggregate(cursor, "COUNT(*)", jobFilter, stats))
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Jobs are in the state: " + JOBSTATES.get(state, state)
 
@@ -340,7 +1309,7 @@ def checkJobs(cursor, state, kind, time, warning, critical):
     return checkState
 
 
-def checkSingleJob(cursor, name, state, kind, time, warning, critical):
+def checkSingleJob(cursor, name, state, kind, time, warning, critical, stats=None, details=0):
     checkState = {}
 
     # Return on empty name
@@ -352,58 +1321,30 @@ def checkSingleJob(cursor, name, state, kind, time, warning, critical):
     if time is None:
         time = 7
 
-    query = """
-    SELECT Job.Name,Job.JobStatus, Job.Starttime
-    FROM Job
-    WHERE Job.Name like '%"""+name+"""%' AND Job.JobStatus like '"""+state+"""' AND (starttime > (now()::date-"""+str(time)+""" * '1 day'::INTERVAL) OR starttime IS NULL) AND Job.Level in ("""+kind+""");
-    """
-
-    cursor.execute(query)
-    results = cursor.fetchall()
-    result = len(results)
+    jobFilter = JobFilter(name=name, states=[state], kind=kind, time=time, unstarted=True)
+    result = queryJobAggregate(cursor, "COUNT(*)", jobFilter, stats)
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Jobs are in the state: " + JOBSTATES.get(state, state)
 
     checkState["performanceData"] = "'bareos." + JOBSTATES.get(state, state) + "'=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
 
+    addJobDetails(checkState, cursor, jobFilter, result, details, order="starttime DESC NULLS FIRST")
+
     return checkState
 
 
-def checkRunTimeJobs(cursor, state, time, warning, critical):
+def checkRunTimeJobs(cursor, state, time, warning, critical, stats=None):
     checkState = {}
 
     if time is None:
         time = 7
 
-    query = """
-    SELECT Count(Job.Name)
-    FROM Job
-    WHERE starttime < (now()::date-""" + str(time) + """ * '1 day'::INTERVAL) AND Job.JobStatus like '""" + state + """';
-    """
+    jobFilter = JobFilter(states=[state], time=time, before=True)
+    result = float(queryJobAggregate(cursor, "COUNT(*)", jobFilter, stats))
 
-    cursor.execute(query)
-    results = cursor.fetchone()
-    result = float(results[0])
-
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Jobs in state '" + JOBSTATES.get(state, state) + "' are running longer than " + str(time) + " days"
 
@@ -412,164 +1353,776 @@ def checkRunTimeJobs(cursor, state, time, warning, critical):
     return checkState
 
 
-def checkTapesInStorage(cursor, warning, critical):
-    checkState = {}
+def perfLabel(label):
+    # Labels with spaces, quotes or equal signs have to be quoted
+    if re.search(r"[\s'=]", label):
+        return "'" + label.replace("'", "''") + "'"
+    return label
 
-    query = """
-    SELECT count(MediaId)
-    FROM Media,Pool,Storage
-    WHERE Media.PoolId=Pool.PoolId
-    AND Slot>0 AND InChanger=1
-    AND Media.StorageId=Storage.StorageId;
+
+class TapeInventory: # pylint: disable=too-many-instance-attributes
     """
-    cursor.execute(query)
-    results = cursor.fetchone()
-    result = float(results[0])
+    Keeps the columns of the Media table needed by the tape checks in compact arrays,
+    one entry per volume, so all tape metrics are computed from a single query.
+    Status, pool and storage names are stored as indexes into lists of the distinct names.
+    """
+    def __init__(self):
+        self.mediaIds = array.array('q')
+        self.states = array.array('H')
+        self.inStorage = array.array('B')
+        self.errors = array.array('q')
+        self.mounts = array.array('q')
+        # Seconds until the volume expires, negative if expired and NaN if unknown
+        self.remaining = array.array('d')
+        self.pools = array.array('H')
+        self.storages = array.array('H')
+        self.names = {'state': [], 'pool': [], 'storage': []}
+        self._lookup = {'state': {}, 'pool': {}, 'storage': {}}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def _intern(self, kind, name):
+        name = "none" if name is None else str(name)
+        lookup = self._lookup[kind]
+        if name not in lookup:
+            lookup[name] = len(self.names[kind])
+            self.names[kind].append(name)
+        return lookup[name]
+
+    def _stateIds(self, *names):
+        return {self._lookup['state'][name] for name in names if name in self._lookup['state']}
+
+    def load(self, cursor, fetchSize=1000):
+        """
+        Fetches the inventory once, checks sharing the inventory wait for the first one to load it
+        """
+        with self._lock:
+            if self.loaded:
+                return
+
+            cursor.execute(QUERIES['tapeInventory'])
+            for rows in iter(lambda: cursor.fetchmany(fetchSize), []):
+                for mediaId, state, inStorage, errors, mounts, remaining, pool, storage in rows:
+                    self.mediaIds.append(mediaId)
+                    self.states.append(self._intern('state', state))
+                    self.inStorage.append(1 if inStorage else 0)
+                    self.errors.append(errors or 0)
+                    self.mounts.append(mounts or 0)
+                    self.remaining.append(float('nan') if remaining is None else float(remaining))
+                    self.pools.append(self._intern('pool', pool))
+                    self.storages.append(self._intern('storage', storage))
+
+            self.loaded = True
+
+    def tapesInStorage(self):
+        return [i for i, inStorage in enumerate(self.inStorage) if inStorage]
+
+    def expiredTapes(self):
+        error = self._stateIds('Error')
+        return [i for i, (state, remaining) in enumerate(zip(self.states, self.remaining)) if remaining < 0 and state not in error]
+
+    def willExpireTapes(self, time):
+        error = self._stateIds('Error')
+        limit = float(time) * 86400
+        return [i for i, (state, remaining) in enumerate(zip(self.states, self.remaining)) if 0 < remaining < limit and state not in error]
+
+    def replaceTapes(self, mounts):
+        broken = self._stateIds('Error', 'Disabled')
+        return [i for i, (state, errors, volMounts) in enumerate(zip(self.states, self.errors, self.mounts))
+                if errors > 0 or state in broken or volMounts > float(mounts)]
+
+    def emptyTapes(self):
+        error = self._stateIds('Error')
+        recyclable = self._stateIds('Purged', 'Recycle')
+        return [i for i, (state, inStorage, remaining) in enumerate(zip(self.states, self.inStorage, self.remaining))
+                if inStorage and (state in recyclable or (remaining < 0 and state not in error))]
+
+    def groups(self, kind, selection):
+        """
+        Returns the number of selected volumes per pool or storage as (name, count)
+        """
+        column = self.pools if kind == 'pool' else self.storages
+        counts = [0] * len(self.names[kind])
+        for i in selection:
+            counts[column[i]] += 1
+        return [(name, count) for name, count in zip(self.names[kind], counts) if count]
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
+    def performanceData(self, label, selection, limit=10):
+        """
+        Returns the number of selected volumes per pool and per storage as perfdata,
+        only the limit largest pools and storages get their own series
+        """
+        return "".join(PerfGroups(kind, limit).performanceData(label, self.groups(kind, selection)) for kind in ('pool', 'storage'))
+
+
+def countTapes(cursor, name, label, params=(), view=False, inventory=None, groups=None, groupLimit=10):
+    """
+    Returns the number of tapes selected by a tape check and the perfdata of their groups.
+    The tapes are counted in the inventory, with one GROUP BY query or with the query of the check.
+    """
+    if inventory is not None:
+        selection = getattr(inventory, name)(*params)
+        if groups is not None:
+            return float(len(selection)), groups.performanceData(label, inventory.groups(groups.kind, selection))
+        return float(len(selection)), inventory.performanceData(label, selection, groupLimit)
+
+    if groups is not None:
+        rows = groups.query(cursor, 'Media', "Count(MediaId)", TAPE_CONDITIONS[name], list(params))
+        return float(sum(count for _, count in rows)), groups.performanceData(label, rows)
+
+    query = QUERIES[name + 'View' if view else name]
+    if params:
+        cursor.execute(query, params)
     else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+        cursor.execute(query)
+    results = cursor.fetchone()
+    return float(results[0]), ""
+
+
+def checkTapesInStorage(cursor, warning, critical, inventory=None, groups=None, groupLimit=10):
+    checkState = {}
+
+    result, groupData = countTapes(cursor, 'tapesInStorage', "bareos.tape.instorage", inventory=inventory, groups=groups, groupLimit=groupLimit)
+
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Tapes are in the Storage"
 
-    checkState["performanceData"] = "bareos.tape.instorage=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.tape.instorage=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
 
     return checkState
 
 
-def checkExpiredTapes(cursor, warning, critical):
+def checkExpiredTapes(cursor, warning, critical, view=False, inventory=None, groups=None, groupLimit=10):
     checkState = {}
 
-    query = """
-    SELECT Count(MediaId)
-    FROM Media
-    WHERE lastwritten+(media.volretention * '1 second'::INTERVAL)<now() AND volstatus not like 'Error';
-    """
-    cursor.execute(query)
-    results = cursor.fetchone()
-    result = float(results[0])
+    result, groupData = countTapes(cursor, 'expiredTapes', "bareos.tape.expired", view=view, inventory=inventory, groups=groups, groupLimit=groupLimit)
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Tapes are expired"
 
-    checkState["performanceData"] = "bareos.tape.expired=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.tape.expired=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
 
     return checkState
 
 
-def checkWillExpiredTapes(cursor, time, warning, critical):
+def checkWillExpiredTapes(cursor, time, warning, critical, view=False, inventory=None, groups=None, groupLimit=10):
     checkState = {}
 
-    query = """
-    SELECT Count(MediaId)
-    FROM Media
-    WHERE lastwritten+(media.volretention * '1 second'::INTERVAL)<now()+(""" + str(time) + """ * '1 day'::INTERVAL) AND lastwritten+(media.volretention * '1 second'::INTERVAL)>now() AND volstatus not like 'Error';;
-    """
-    cursor.execute(query)
-    results = cursor.fetchone()
-    result = float(results[0])
+    result, groupData = countTapes(cursor, 'willExpireTapes', "bareos.tape.willexpire", (time,), view, inventory, groups, groupLimit)
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Tapes will expire in " + str(time) + " days"
 
-    checkState["performanceData"] = "bareos.tape.willexpire=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.tape.willexpire=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
 
     return checkState
 
 
-def checkReplaceTapes(cursor, mounts, warning, critical):
+def checkReplaceTapes(cursor, mounts, warning, critical, inventory=None, groups=None, groupLimit=10):
     checkState = {}
 
-    query = """
-    SELECT COUNT(VolumeName)
-    FROM Media
-    WHERE (VolErrors>0) OR (VolStatus='Error') OR (VolMounts>""" + str(mounts) + """) OR (VolStatus='Disabled');
-    """
-    cursor.execute(query)
-    results = cursor.fetchone()
-    result = float(results[0])
+    result, groupData = countTapes(cursor, 'replaceTapes', "bareos.tape.replace", (mounts,), inventory=inventory, groups=groups, groupLimit=groupLimit)
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
     checkState["returnMessage"] += " - " + str(result) + " Tapes might need replacement"
 
-    checkState["performanceData"] = "bareos.tape.replace=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.tape.replace=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
 
     return checkState
 
 
-def checkEmptyTapes(cursor, warning, critical):
+def checkEmptyTapes(cursor, warning, critical, view=False, inventory=None, groups=None, groupLimit=10):
     checkState = {}
 
-    query = """
-    SELECT Count(MediaId)
-    FROM Media,Pool,Storage
-    WHERE Media.PoolId=Pool.PoolId
-    AND Slot>0 AND InChanger=1
-    AND Media.StorageId=Storage.StorageId
-    AND (VolStatus like 'Purged' OR VolStatus like 'Recycle' OR lastwritten+(media.volretention * '1 second'::INTERVAL)<now() AND VolStatus not like 'Error');
+    result, groupData = countTapes(cursor, 'emptyTapes', "bareos.tape.empty", view=view, inventory=inventory, groups=groups, groupLimit=groupLimit)
+
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
+
+    checkState["returnMessage"] += " - " + str(result) + " Tapes are empty"
+
+    checkState["performanceData"] = "bareos.tape.empty=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" + groupData
+
+    return checkState
+
+
+def checkBackupTrend(trend, days, bucket, model, unit, capacity, deviation, warning, critical, groupLimit=10): # pylint: disable=too-many-locals
+    checkState = {}
+
+    bucketDays = TREND_BUCKETS[bucket]
+    factor = createFactor(unit)
+    values = [value / factor for value in trend.series(bucketDays, days)]
+
+    if len(values) < 2:
+        checkState["returnCode"] = UNKNOWN
+        checkState["returnMessage"] = "[UNKNOWN] - At least two " + bucket + "s of history are needed for a trend"
+        return checkState
+
+    predict = fitTrend(values, model)
+    expected = predict(len(values) - 1)
+    growth = predict(len(values)) - expected
+    daysLeft = forecastDaysLeft(values, predict, float(capacity), bucketDays) if capacity else None
+    deviated = bool(deviation) and expected > 0 and abs(values[-1] - expected) / expected * 100 > float(deviation)
+
+    state = check_threshold(daysLeft, warning=warning, critical=critical) if daysLeft is not None else OK
+    if deviated:
+        state = worstState([state, WARNING])
+    checkState["returnCode"], checkState["returnMessage"] = state, "[" + STATE_NAMES[state] + "]"
+
+    checkState["returnMessage"] += (" - " + str(round(values[-1], 3)) + " " + unit + " in the last " + bucket +
+                                    ", trend " + "{0:+}".format(round(growth, 3)) + " " + unit + " per " + bucket)
+    if capacity:
+        if daysLeft is None:
+            checkState["returnMessage"] += ", capacity of " + str(capacity) + " " + unit + " not reached within " + str(TREND_HORIZON) + " days"
+        else:
+            checkState["returnMessage"] += ", capacity of " + str(capacity) + " " + unit + " reached in " + str(daysLeft) + " days"
+    if deviated:
+        checkState["returnMessage"] += ", last " + bucket + " deviates " + str(round(abs(values[-1] - expected) / expected * 100)) + "% from the trend"
+
+    checkState["performanceData"] = ("bareos.trend.last=" + str(round(values[-1], 3)) +
+                                     " bareos.trend.expected=" + str(round(expected, 3)) +
+                                     " bareos.trend.growth=" + str(round(growth, 3)) +
+                                     " bareos.trend.stored=" + str(round(sum(values), 3)))
+    if daysLeft is not None:
+        checkState["performanceData"] += " bareos.trend.days_left=" + str(daysLeft) + ";" + str(warning) + ";" + str(critical) + ";;"
+
+    for kind, key, limit in (('level', 0, 0), ('client', 1, groupLimit)):
+        groups = [(name, round(series[-1] / factor, 3)) for name, series in trend.series(bucketDays, days, key).items()]
+        checkState["performanceData"] += PerfGroups(kind, limit).performanceData("bareos.trend.last", groups)
+
+    return checkState
+
+
+def checkJobAnomalies(baselines, time, warning, critical):
+    checkState = {}
+
+    result = len(baselines.anomalies)
+
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
+
+    checkState["returnMessage"] += " - " + str(result) + " Jobs deviated from their baseline in the last " + str(time) + " days"
+
+    checkState["performanceData"] = ("bareos.job.anomalies=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;" +
+                                     " bareos.job.baselines=" + str(len(baselines.jobs)))
+
+    if baselines.anomalies:
+        checkState["longOutput"] = "\n".join(anomaly['name'] + " Level: " + anomaly['level'] + " JobId: " + str(anomaly['jobid']) + " " + ", ".join(anomaly['reasons'])
+                                             for anomaly in baselines.anomalies)
+
+    return checkState
+
+
+# Levels whose backup also covers a level, the last backup of at least that level counts
+FRESHNESS_LEVELS = {'F': ('F',), 'D': ('F', 'D'), 'I': ('F', 'D', 'I')}
+
+
+class FreshnessRules:
+    """
+    The thresholds for the hours since the last successful backup per job name, read from a JSON file:
+    [{"name": "backup-db-*", "level": "F", "warning": "192", "critical": "384"}, {"name": "archive-*", "ignore": true}]
+    The name is a shell pattern and the first matching rule per level applies. A rule with a level
+    applies to the last backup of at least that level, one without a level to the last backup of any level.
+    Jobs without a matching rule use the thresholds given on the command line.
+    """
+    def __init__(self, warning, critical, rules=()):
+        self.default = {'name': '*', 'warning': warning, 'critical': critical}
+        self.rules = []
+        for rule in rules:
+            if not isinstance(rule, dict) or 'name' not in rule:
+                raise ValueError('Invalid freshness rule: {0}'.format(rule))
+            self.rules.append(dict(rule,
+                                   warning=Threshold(rule['warning']) if 'warning' in rule else warning,
+                                   critical=Threshold(rule['critical']) if 'critical' in rule else critical))
+
+    @classmethod
+    def load(cls, path, warning, critical):
+        with open(path, encoding='utf-8') as rulesfile:
+            return cls(warning, critical, json.load(rulesfile))
+
+    def match(self, name):
+        """
+        Returns the rules applying to a job name by level, None for any level
+        """
+        matched = {}
+        for rule in self.rules:
+            if fnmatch.fnmatchcase(name, rule['name']):
+                matched.setdefault(rule.get('level'), rule)
+
+        if matched.get(None, {}).get('ignore'):
+            return {}
+        matched.setdefault(None, self.default)
+        return {level: rule for level, rule in matched.items() if not rule.get('ignore')}
+
+    def expected(self):
+        """
+        Returns the job names given without pattern, they are stale if they never succeeded
+        """
+        return [rule['name'] for rule in self.rules if not rule.get('ignore') and not any(c in rule['name'] for c in '*?[')]
+
+
+def checkJobFreshness(cursor, rules):
+    checkState = {}
+
+    # The last successful backup of each job name and level in one query
+    cursor.execute(QUERIES['lastSuccessfulJobs'])
+    ages = {}
+    for name, level, age in cursor.fetchall():
+        ages.setdefault(name, {})[level.strip()] = float(age)
+    for name in rules.expected():
+        ages.setdefault(name, {})
+
+    # The jobs are evaluated in one pass per rule
+    jobs = []
+    byRule = {}
+    for name in sorted(ages):
+        for level, rule in rules.match(name).items():
+            covered = [age for backupLevel, age in ages[name].items() if level is None or backupLevel in FRESHNESS_LEVELS.get(level, (level,))]
+            job = {'name': name, 'level': level, 'age': min(covered) if covered else None, 'state': CRITICAL}
+            jobs.append(job)
+            if job['age'] is not None:
+                byRule.setdefault(id(rule), (rule, []))[1].append(job)
+
+    for rule, ruleJobs in byRule.values():
+        states, _, _ = evaluateThresholds([job['age'] for job in ruleJobs], rule['warning'], rule['critical'])
+        for job, state in zip(ruleJobs, states):
+            job['state'] = int(state)
+
+    stale = sorted((job for job in jobs if job['state'] != OK), key=lambda job: (-job['state'], -(job['age'] if job['age'] is not None else float('inf')), job['name']))
+    state = worstState([job['state'] for job in jobs])
+
+    checkState["returnCode"] = state
+    if stale:
+        checkState["returnMessage"] = "[" + STATE_NAMES[state] + "] - " + str(len(stale)) + " of " + str(len(jobs)) + " Jobs have no recent successful backup"
+    else:
+        checkState["returnMessage"] = "[" + STATE_NAMES[state] + "] - All " + str(len(jobs)) + " Jobs have a recent successful backup"
+
+    oldest = max((job['age'] for job in jobs if job['age'] is not None), default=0)
+    checkState["performanceData"] = ("bareos.freshness.stale=" + str(len(stale)) + ";;;; bareos.freshness.critical=" +
+                                     str(sum(1 for job in stale if job['state'] == CRITICAL)) + " bareos.freshness.jobs=" + str(len(jobs)) +
+                                     " bareos.freshness.oldest_hours=" + str(round(oldest, 1)))
+
+    if stale:
+        checkState["longOutput"] = "\n".join(
+            "[" + STATE_NAMES[job['state']] + "] " + job['name'] + (" Level: " + job['level'] if job['level'] else "") + " " +
+            ("never succeeded" if job['age'] is None else "last successful backup " + str(round(job['age'], 1)) + " hours ago")
+            for job in stale)
+
+    return checkState
+
+
+def expiryHistogramQuery(view=False):
+    """
+    Returns the query counting the expired volumes and the volumes expiring within each bucket.
+    The expiry of every volume is computed once, or read from the materialized view.
     """
+    bounds = ["now()"] + ["now()+'" + str(days) + " days'::INTERVAL" for days in EXPIRY_BUCKETS]
 
-    cursor.execute(query)
+    counts = ["Count(*) FILTER (WHERE Expiry<now())"]
+    for lower, upper in zip(bounds, bounds[1:]):
+        counts.append("Count(*) FILTER (WHERE Expiry>=" + lower + " AND Expiry<" + upper + ")")
+    counts.append("Count(*) FILTER (WHERE Expiry>=" + bounds[-1] + ")")
+
+    if view:
+        source = "check_bareos_media_expiry"
+    else:
+        source = "(SELECT lastwritten+(media.volretention * '1 second'::INTERVAL) AS Expiry FROM Media WHERE volstatus not like 'Error') AS Expiry"
+
+    return "SELECT " + ", ".join(counts) + " FROM " + source + ";"
+
+
+def checkExpiryHistogram(cursor, warning, critical, view=False):
+    checkState = {}
+
+    cursor.execute(expiryHistogramQuery(view))
     results = cursor.fetchone()
     result = float(results[0])
 
-    if check_threshold(result, warning=warning, critical=critical) == CRITICAL:
-        checkState["returnCode"] = CRITICAL
-        checkState["returnMessage"] = "[CRITICAL]"
-    elif check_threshold(result, warning=warning, critical=critical) == WARNING:
-        checkState["returnCode"] = WARNING
-        checkState["returnMessage"] = "[WARNING]"
-    else:
-        checkState["returnCode"] = OK
-        checkState["returnMessage"] = "[OK]"
+    checkState["returnCode"], checkState["returnMessage"] = thresholdState(result, warning, critical)
 
-    checkState["returnMessage"] += " - " + str(result) + " Tapes are empty"
+    checkState["returnMessage"] += " - " + str(result) + " Tapes are expired, " + str(sum(results[1:-1])) + " will expire in " + str(EXPIRY_BUCKETS[-1]) + " days"
 
-    checkState["performanceData"] = "bareos.tape.empty=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    checkState["performanceData"] = "bareos.tape.expired=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;"
+    for days, count in zip(EXPIRY_BUCKETS, results[1:]):
+        checkState["performanceData"] += " bareos.tape.expiry." + str(days) + "d=" + str(count)
+    checkState["performanceData"] += " bareos.tape.expiry.later=" + str(results[-1])
 
     return checkState
 
 
-def connectDB(username, pw, hostname, databasename, port):
+def refreshExpiryView(cursor, maxAge):
+    """
+    Refreshes the materialized view of the volume expiry if it is older than maxAge seconds
+    """
+    cursor.execute(QUERIES['expiryViewAge'])
+    age = cursor.fetchone()[0]
+
+    if age is None or float(age) > maxAge:
+        cursor.execute(QUERIES['refreshExpiryView'])
+        cursor.connection.commit()
+
+
+def positionalParameters(query):
+    # Replaces the %s placeholders of psycopg2 with the $n parameters of PREPARE
+    counter = itertools.count(1)
+    return '%'.join(re.sub('%s', lambda m: '$' + str(next(counter)), part) for part in query.split('%%'))
+
+
+def statementName(query):
+    # Named queries keep their name, generated queries are named after their text
+    for name, text in QUERIES.items():
+        if text == query:
+            return 'check_bareos_' + name.lower()
+    return 'check_bareos_' + hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+
+
+PREPARABLE_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'VALUES', 'WITH')
+
+
+def preparable(query):
+    # PREPARE and EXPLAIN only accept queries, statements like REFRESH or CREATE are executed as they are
+    return query.lstrip().split(None, 1)[0].upper() in PREPARABLE_STATEMENTS
+
+
+class PreparedCursor:
+    """
+    Wraps a cursor and executes every query as a named prepared statement.
+    Each query text is prepared once per connection, so repeated executions on a
+    long-lived connection skip parsing and can reuse the plan cached by PostgreSQL.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+        # Maps the query text to the statement name and the time it took to prepare
+        self._statements = {}
+        self.executions = 0
+        self.reused = 0
+        self.prepareTime = 0.0
+        self.savedTime = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params=None):
+        if not preparable(query):
+            self._cursor.execute(query, params)
+            return
+
+        params = list(params or [])
+
+        if query in self._statements:
+            name, elapsed = self._statements[query]
+            self.reused += 1
+            self.savedTime += elapsed
+        else:
+            name = statementName(query)
+            start = time.monotonic()
+            self._cursor.execute("PREPARE " + name + " AS " + positionalParameters(query))
+            elapsed = time.monotonic() - start
+            self._statements[query] = (name, elapsed)
+            self.prepareTime += elapsed
+
+        self.executions += 1
+
+        if params:
+            self._cursor.execute("EXECUTE " + name + "(" + ", ".join(["%s"] * len(params)) + ");", params)
+        else:
+            self._cursor.execute("EXECUTE " + name + ";")
+
+    def performanceData(self):
+        """
+        Returns the number of prepared statements, their executions and the
+        time spent preparing them and saved by reusing them as perfdata
+        """
+        return ("bareos.plugin.prepared=" + str(len(self._statements)) +
+                " bareos.plugin.executions=" + str(self.executions) +
+                " bareos.plugin.prepare_ms=" + str(round(self.prepareTime * 1000, 3)) +
+                " bareos.plugin.prepare_saved_ms=" + str(round(self.savedTime * 1000, 3)))
+
+
+class ExplainCursor:
+    """
+    Wraps a cursor and runs every query with EXPLAIN (ANALYZE, BUFFERS) before executing it.
+    Keeps the plans to report sequential scans and estimated versus actual rows.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.plans = []
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params=None):
+        if not preparable(query):
+            self._cursor.execute(query, params)
+            return
+
+        self._cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = self._cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        self.plans.append(plan[0])
+
+        self._cursor.execute(query, params)
+
+    @staticmethod
+    def scans(node):
+        """
+        Returns the nodes of a plan that read a table
+        """
+        nodes = [node] if "Relation Name" in node else []
+        for child in node.get("Plans", []):
+            nodes.extend(ExplainCursor.scans(child))
+        return nodes
+
+    def seqScans(self):
+        return sum(1 for plan in self.plans for node in self.scans(plan["Plan"]) if node["Node Type"] == "Seq Scan")
+
+    def longOutput(self):
+        lines = []
+        for number, plan in enumerate(self.plans, 1):
+            root = plan["Plan"]
+            lines.append("Query " + str(number) + ": " + str(plan.get("Execution Time")) + " ms, buffers shared hit=" +
+                         str(root.get("Shared Hit Blocks", 0)) + " read=" + str(root.get("Shared Read Blocks", 0)))
+            for node in self.scans(root):
+                name = node["Node Type"] + (" using " + node["Index Name"] if "Index Name" in node else "") + " on " + node["Relation Name"]
+                actual = node.get("Actual Rows", 0) * node.get("Actual Loops", 1)
+                lines.append("  " + name + ": estimated " + str(node["Plan Rows"]) + " rows, actual " + str(actual) + " rows")
+        return "\n".join(lines)
+
+    def performanceData(self):
+        executionTime = sum(plan.get("Execution Time", 0) for plan in self.plans)
+        return ("bareos.explain.seqscans=" + str(self.seqScans()) +
+                " bareos.explain.execution_ms=" + str(round(executionTime, 3)))
+
+
+# TCP keepalives let dead connections fail fast after a failover of the catalog
+KEEPALIVES = {'keepalives': 1, 'keepalives_idle': 30, 'keepalives_interval': 10, 'keepalives_count': 3}
+
+
+# The phases of an instrumented invocation in the order they run
+PHASES = ['import', 'parse', 'password', 'connect', 'execute', 'fetch', 'threshold', 'output']
+
+
+class Instrumentation:
+    """
+    Times the phases of one invocation of a check and counts the queries and rows,
+    enabled with --instrument or --trace. The import phase is the CPU time of the
+    process before the arguments are parsed.
+    """
+    # Instrumentation of the running invocation, None if it is not instrumented
+    active = None
+
+    def __init__(self):
+        self.phases = {}
+        self.queries = 0
+        self.rows = 0
+        self.returnCode = UNKNOWN
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds * 1000
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    @staticmethod
+    def peakRss():
+        # In kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def performanceData(self):
+        output = "".join(" bareos.plugin." + name + "_ms=" + str(round(self.phases[name], 3)) for name in PHASES if name in self.phases)
+        return (output.strip() + " bareos.plugin.queries=" + str(self.queries) + " bareos.plugin.rows=" + str(self.rows) +
+                " bareos.plugin.peak_rss=" + str(self.peakRss()) + "KB")
+
+    def trace(self, argv):
+        # The password is not written to the trace
+        masked = ["***" if previous in ('-p', '--password') else arg for previous, arg in zip([None] + argv, argv)]
+        masked = ["--password=***" if arg.startswith('--password=') else arg for arg in masked]
+        return {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "argv": masked,
+            "returnCode": self.returnCode,
+            "phases_ms": {name: round(self.phases[name], 3) for name in PHASES if name in self.phases},
+            "queries": self.queries,
+            "rows": self.rows,
+            "peak_rss_kb": self.peakRss(),
+        }
+
+
+@contextlib.contextmanager
+def phase(name):
+    # Times a phase of the invocation if it is instrumented
+    if Instrumentation.active is None:
+        yield
+    else:
+        with Instrumentation.active.phase(name):
+            yield
+
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor and records the time spent in executing the queries and fetching
+    the rows as well as their number in the Instrumentation
+    """
+    def __init__(self, cursor, instrumentation):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def execute(self, query, params=None):
+        with self._instrumentation.phase('execute'):
+            self._cursor.execute(query, params)
+        self._instrumentation.queries += 1
+
+    def fetchone(self):
+        with self._instrumentation.phase('fetch'):
+            row = self._cursor.fetchone()
+        self._instrumentation.rows += 1 if row is not None else 0
+        return row
+
+    def fetchmany(self, size):
+        with self._instrumentation.phase('fetch'):
+            rows = self._cursor.fetchmany(size)
+        self._instrumentation.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        with self._instrumentation.phase('fetch'):
+            rows = self._cursor.fetchall()
+        self._instrumentation.rows += len(rows)
+        return rows
+
+
+def createConnection(username, pw, hostname, databasename, port, timeout=None, pgbouncer=False, staleness=None): # pylint: disable=too-many-arguments
+    """
+    Connects to the catalog. With a comma separated list of hosts the first hot standby lagging
+    at most staleness seconds behind the primary is preferred, otherwise the primary is used.
+    """
+    options = dict(KEEPALIVES)
+    if timeout:
+        # libpq waits at least 2 whole seconds for a connection
+        options['connect_timeout'] = max(2, math.ceil(timeout))
+        if not pgbouncer:
+            # The server stops the query itself if the plugin is killed before it can cancel it,
+            # pgbouncer does not pass startup options to the server
+            options['options'] = '-c statement_timeout=' + str(int(timeout * 1000))
+
+    def connect(host, **extra):
+        # psycopg2 quotes the keyword arguments itself
+        return psycopg2.connect(host=host, port=port, dbname=databasename, user=username, password=pw,
+                                application_name='check_bareos', **options, **extra)
+
+    hosts = [host.strip() for host in hostname.split(',')]
+    if len(hosts) == 1:
+        return connect(hostname)
+
+    primary = None
+    if staleness is not None:
+        for host in hosts:
+            try:
+                connection = connect(host)
+                lag = replicationLag(connection)
+            except psycopg2.OperationalError:
+                continue
+            if lag is not None and lag <= staleness:
+                if primary is not None:
+                    primary.close()
+                return connection
+            if lag is None and primary is None:
+                primary = connection
+            else:
+                connection.close()
+
+    if primary is not None:
+        return primary
+
+    # libpq tries the hosts in order until it finds the primary
+    return connect(','.join(hosts), target_session_attrs='read-write')
+
+
+def replicationLag(connection):
+    """
+    Returns the seconds a hot standby lags behind the primary, None for the primary.
+    A standby streaming from the primary that replayed all WAL it received has no lag, even if the primary
+    was idle since. Otherwise, e.g. if the WAL receiver is disconnected, the lag is the age of the last replayed
+    transaction. The status of the WAL receiver is only visible with pg_read_all_stats.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(QUERIES['replicationLag'])
+        standby, lag = cursor.fetchone()
+    connection.rollback()
+
+    if not standby:
+        return None
+    # Without a replayed transaction the lag is unknown
+    return float('inf') if lag is None else float(lag)
+
+
+def stalenessBudget(args):
+    """
+    Returns the seconds the catalog read by a check may lag behind the primary,
+    None if the check has to run on the primary
+    """
+    staleness = getattr(args, 'staleness', None)
+    # Checks writing to the catalog always run on the primary
+    if staleness is None or getattr(args, 'expiry_max_age', 0):
+        return None
+    maxStaleness = getattr(args, 'max_staleness', None)
+    return maxStaleness if maxStaleness is not None else staleness
+
+
+def batchStaleness(args, subParser, checks):
+    """
+    Returns the staleness budget of a batch, it reads the catalog as fresh as its strictest check needs it.
+    None if one of the checks has to run on the primary.
+    """
+    budgets = [stalenessBudget(checkArgs) for checkArgs, _ in (parseBatchArguments(subParser, check) for _, check in checks)]
+    staleness = None if None in budgets else min(budgets)
+    if staleness is not None and args.max_staleness is not None:
+        staleness = args.max_staleness
+    return staleness
+
+
+def createPool(args, size, prepare=True, staleness=None):
+    """
+    Returns a CursorPool for the connection arguments. Behind pgbouncer in transaction mode
+    consecutive transactions may run on different server connections, so the queries
+    are not prepared there. The pool only uses a standby lagging at most staleness seconds behind, the primary without one.
+    """
+    return CursorPool(lambda: createConnection(args.user, args.password, args.host, args.database, args.port, args.timeout, args.pgbouncer, staleness),
+                      size, prepare and not args.pgbouncer)
+
+
+def connectDB(username, pw, hostname, databasename, port, timeout=None, pgbouncer=False, staleness=None): # pylint: disable=too-many-arguments
+    started = time.monotonic()
     try:
-        connString = "host='" + hostname + "' port=" + str(port) + " dbname='" + databasename + "' user='" + username + "' password='" + pw + "'"
-        conn = psycopg2.connect(connString)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        conn = createConnection(username, pw, hostname, databasename, port, timeout, pgbouncer, staleness)
+        # The rows are only read as tuples
+        cursor = conn.cursor()
         return cursor
     except psycopg2.DatabaseError as e:
+        elapsed = time.monotonic() - started
+        if timeout is not None and elapsed >= timeout:
+            # Reported like a canceled query, with the last cached result
+            raise DeadlineExceeded(timeout, elapsed, "connection attempt given up") from e
         checkState = {}
         checkState["returnCode"] = UNKNOWN
         checkState["returnMessage"] = "[UNKNOWN] - " + str(e)[:-1]
@@ -577,45 +2130,29 @@ def connectDB(username, pw, hostname, databasename, port):
         printNagiosOutput(checkState)
 
 
+def formatNagiosOutput(checkResult):
+    output = checkResult["returnMessage"] + "|" + checkResult.get("performanceData", ";;;;")
+
+    if checkResult.get("longOutput"):
+        output += "\n" + checkResult["longOutput"]
+
+    return output
+
+
 def printNagiosOutput(checkResult):
     if checkResult is not None:
-        print((checkResult["returnMessage"] + "|" + checkResult.get("performanceData", ";;;;")))
+        with phase('output'):
+            print(formatNagiosOutput(checkResult))
         sys.exit(checkResult["returnCode"])
 
     print("[UNKNOWN] - Error in Script")
     sys.exit(3)
 
 
-def commandline(args):
-    """
-    Parse commandline arguments.
-    """
-    def environ_or_required(key):
-        return ({'default': os.environ.get(key)} if os.environ.get(key) else {})
-
-    parser = argparse.ArgumentParser(description='Check Plugin for Bareos Backup Status')
-    group = parser.add_argument_group()
-    group.add_argument('-U', '--user', dest='user', action='store', required=True, help='user name for the database connections')
-
-    password_group = group.add_mutually_exclusive_group()
-
-    password_group.add_argument('-p', '--password', dest='password', action='store',
-                                **environ_or_required('CHECK_BAREOS_DATABASE_PASSWORD'),
-                                help='password for the database connections (CHECK_BAREOS_DATABASE_PASSWORD)')
-    password_group.add_argument('--password-file', dest='password_file', action='store',
-                                default='/etc/bareos/bareos-dir.conf',
-                                help='path to a password file. Can be the bareos-dir.conf')
-
-    group.add_argument('-H', '--Host', dest='host', action='store', help='database host', default="127.0.0.1")
-    group.add_argument('-P', '--port', dest='port', action='store', help='database port', default=5432, type=int)
-    group.add_argument('-d', '--database', dest='database', default='bareos', help='database name')
-    group.add_argument('-v', '--version', action='version', version=f'%(prog)s {__version__}')
-
-    subParser = parser.add_subparsers()
-
+def addJobParser(subParser):
     jobParser = subParser.add_parser('job', help='Subchecks for Bareos Jobs')
     jobGroup = jobParser.add_mutually_exclusive_group(required=True)
-    jobParser.set_defaults(func=checkJob)
+    jobParser.set_defaults(func=checkJob, evaluate=evaluateJob, staleness=10)
     jobGroup.add_argument('-js', '--checkJobs', dest='checkJobs', action='store_true', help='Check how many jobs are in a specific state [default=queued]')
     jobGroup.add_argument('-j', '--checkJob', dest='checkJob', action='store_true', help='Check the state of a specific job [default=queued]')
     jobGroup.add_argument('-rt', '--runTimeJobs', dest='runTimeJobs', action='store_true', help='Check if a backup runs longer then n day')
@@ -628,23 +2165,50 @@ def commandline(args):
     jobParser.add_argument('-f', '--full', dest='full', action='store_true', help='Backup kind full')
     jobParser.add_argument('-i', '--inc', dest='inc', action='store_true', help='Backup kind inc')
     jobParser.add_argument('-d', '--diff', dest='diff', action='store_true', help='Backup kind diff')
+    jobParser.add_argument('--details', dest='details', action='store', type=int, default=0, help='List up to n matching jobs in the long output [used for checkJob]')
+
 
+def addTapeParser(subParser):
     tapeParser = subParser.add_parser('tape', help='Subcheck for Bareos States')
     tapeGroup = tapeParser.add_mutually_exclusive_group(required=True)
-    tapeParser.set_defaults(func=checkTape)
+    tapeParser.set_defaults(func=checkTape, evaluate=evaluateTape, staleness=300)
     tapeGroup.add_argument('-e', '--emptyTapes', dest='emptyTapes', action='store_true', help='Count empty tapes in the storage (Status Purged/Expired)')
     tapeGroup.add_argument('-ts', '--tapesInStorage', dest='tapesInStorage', action='store_true', help='Count how much tapes are in the storage')
     tapeGroup.add_argument('-ex', '--expiredTapes', dest='expiredTapes', action='store_true', help='Count how much tapes are expired')
     tapeGroup.add_argument('-wex', '--willExpire', dest='willExpire', action='store_true', help='Count how much tapes are will expire in n day')
     tapeGroup.add_argument('-r', '--replaceTapes', dest='replaceTapes', action='store_true', help='Count how much tapes should by replaced')
+    tapeGroup.add_argument('-eh', '--expiryHistogram', dest='expiryHistogram', action='store_true',
+                           help='Count how much tapes are expired and will expire in 1, 7, 30, 90 and 365 days [thresholds apply to the expired tapes]')
     tapeParser.add_argument('-w', '--warning', dest='warning', action='store', help='Warning threshold', default=5)
     tapeParser.add_argument('-c', '--critical', dest='critical', action='store', help='Critical threshold', default=10)
     tapeParser.add_argument('-m', '--mounts', dest='mounts', action='store', help='Amout of allowed mounts for a tape [used for replace tapes]', default=200)
     tapeParser.add_argument('-t', '--time', dest='time', action='store', help='Time in days (default=7 days)', default=7)
-
+    tapeParser.add_argument('--inventory', dest='inventory', action='store_true',
+                            help='compute the tape metrics from one query over all volumes and add the counts per pool and storage to the perfdata '
+                                 '[used for emptyTapes, tapesInStorage, expiredTapes, willExpire, replaceTapes]')
+    tapeParser.add_argument('--group-by', dest='group_by', choices=['pool', 'storage'],
+                            help='add the counts per pool or storage to the perfdata, fetched with one GROUP BY query [not used for expiryHistogram]')
+    tapeParser.add_argument('--group-limit', dest='group_limit', action='store', type=int, default=10,
+                            help='number of groups with their own perfdata, the others are summed up as __other__ [default=10, 0 (all)]')
+    tapeParser.add_argument('--expiry-view', dest='expiry_view', action='store_true',
+                            help='read the expiry of the tapes from the materialized view created with expiry-view --create [used for emptyTapes, expiredTapes, willExpire, expiryHistogram]')
+    tapeParser.add_argument('--expiry-max-age', dest='expiry_max_age', action='store', type=int, default=0,
+                            help='refresh the materialized view if it is older than n seconds [default=0 (never)]')
+
+
+def addExpiryViewParser(subParser):
+    expiryParser = subParser.add_parser('expiry-view', help='Manage the materialized view with the precomputed expiry of the tapes')
+    expiryGroup = expiryParser.add_mutually_exclusive_group(required=True)
+    expiryParser.set_defaults(func=checkExpiryView, evaluate=evaluateExpiryView)
+    expiryGroup.add_argument('--create', dest='create', action='store_true', help='Create the materialized view and its indexes')
+    expiryGroup.add_argument('--refresh', dest='refresh', action='store_true', help='Refresh the materialized view')
+    expiryGroup.add_argument('--drop', dest='drop', action='store_true', help='Drop the materialized view')
+
+
+def addStatusParser(subParser):
     statusParser = subParser.add_parser('status', help='Subcheck for various Bareos information')
     statusGroup = statusParser.add_mutually_exclusive_group(required=True)
-    statusParser.set_defaults(func=checkStatus)
+    statusParser.set_defaults(func=checkStatus, evaluate=evaluateStatus, staleness=10)
     statusGroup.add_argument('-b', '--totalBackupsSize', dest='totalBackupsSize', action='store_true', help='the size of all backups in the database [use time and kind for mor restrictions]')
     statusGroup.add_argument('-e', '--emptyBackups', dest='emptyBackups', action='store_true', help='Check if a successful backup have 0 bytes [only wise for full backups]')
     statusGroup.add_argument('-o', '--oversizedBackup', dest='oversizedBackups', action='store_true', help='Check if a backup have more than n TB')
@@ -657,15 +2221,199 @@ def commandline(args):
     statusParser.add_argument('-c', '--critical', dest='critical', action='store', help='Critical threshold [default=10]', default="10")
     statusParser.add_argument('-s', '--size', dest='size', action='store', help='Border value for oversized backups [default=2]', default=2)
     statusParser.add_argument('-u', '--unit', dest='unit', choices=['MB', 'GB', 'TB', 'PB', 'EB'], default='TB', help='display unit [default=TB]')
+    statusParser.add_argument('--incremental', dest='incremental', action='store', metavar='STATEFILE',
+                              help='Only fetch new and unfinished jobs and keep daily aggregates in STATEFILE [used for emptyBackups, oversizedBackup, failedBackups]')
+    statusParser.add_argument('--group-by', dest='group_by', choices=['pool', 'client', 'jobname'],
+                              help='add the values per pool, client or job name to the perfdata, fetched with one GROUP BY query')
+    statusParser.add_argument('--group-limit', dest='group_limit', action='store', type=int, default=10,
+                              help='number of groups with their own perfdata, the others are summed up as __other__ [default=10, 0 (all)]')
+    statusParser.add_argument('--details', dest='details', action='store', type=int, default=0, help='List up to n matching jobs in the long output [not used for totalBackupsSize]')
+
+
+def addTrendParser(subParser):
+    trendParser = subParser.add_parser('trend', help='Forecast the growth of the backup size')
+    trendParser.set_defaults(func=checkTrend, evaluate=evaluateTrend, staleness=3600)
+    trendParser.add_argument('-t', '--time', dest='time', action='store', type=int, default=90,
+                             help='days of history the trend is fitted over, should match the retention of the backups [default=90]')
+    trendParser.add_argument('-b', '--bucket', dest='bucket', choices=TREND_BUCKETS.keys(), default='day', help='length of the buckets of the trend [default=day]')
+    trendParser.add_argument('-m', '--model', dest='model', choices=['linear', 'exponential'], default='linear', help='growth model [default=linear]')
+    trendParser.add_argument('-u', '--unit', dest='unit', choices=['MB', 'GB', 'TB', 'PB', 'EB'], default='TB', help='display unit [default=TB]')
+    trendParser.add_argument('--capacity', dest='capacity', action='store', help='capacity for the backups in the given unit, thresholds apply to the days until it is reached')
+    trendParser.add_argument('--deviation', dest='deviation', action='store', default=0,
+                             help='warn if the last bucket deviates more than n percent from the trend [default=0 (never)]')
+    trendParser.add_argument('--state-file', dest='state_file', action='store', metavar='STATEFILE', help='cache the daily sizes in STATEFILE and only fetch the last days')
+    trendParser.add_argument('--group-limit', dest='group_limit', action='store', type=int, default=10,
+                             help='number of clients with their own perfdata, the others are summed up as __other__ [default=10, 0 (all)]')
+    trendParser.add_argument('-w', '--warning', dest='warning', action='store', help='Warning threshold for the days left [default=30:]', default="30:")
+    trendParser.add_argument('-c', '--critical', dest='critical', action='store', help='Critical threshold for the days left [default=7:]', default="7:")
+
+
+def addAnomalyParser(subParser):
+    anomalyParser = subParser.add_parser('anomaly', help='Check the jobs against a baseline per job name')
+    anomalyParser.set_defaults(func=checkAnomaly, evaluate=evaluateAnomaly, staleness=300)
+    anomalyParser.add_argument('--state-file', dest='state_file', action='store', metavar='STATEFILE', required=True,
+                               help='keep the baselines in STATEFILE, the first run reads the whole job history')
+    anomalyParser.add_argument('-t', '--time', dest='time', action='store', help='report the deviating jobs finished in the last n days [default=1]', default=1)
+    anomalyParser.add_argument('--duration-factor', dest='duration_factor', action='store', type=float, default=3,
+                               help='a job deviates if it runs n times longer than usual [default=3]')
+    anomalyParser.add_argument('--size-factor', dest='size_factor', action='store', type=float, default=10,
+                               help='a job deviates if it writes n times more or less bytes or files than usual [default=10]')
+    anomalyParser.add_argument('--alpha', dest='alpha', action='store', type=float, default=0.2,
+                               help='weight of a new job in the moving average of the baseline [default=0.2]')
+    anomalyParser.add_argument('--min-samples', dest='min_samples', action='store', type=int, default=5,
+                               help='number of jobs needed before a baseline is used [default=5]')
+    anomalyParser.add_argument('-w', '--warning', dest='warning', action='store', help='Warning threshold [default=0]', default="0")
+    anomalyParser.add_argument('-c', '--critical', dest='critical', action='store', help='Critical threshold [default=5]', default="5")
+
+
+def addFreshnessParser(subParser):
+    freshnessParser = subParser.add_parser('freshness', help='Check the age of the last successful backup of every job')
+    freshnessParser.set_defaults(func=checkFreshness, evaluate=evaluateFreshness, staleness=60)
+    freshnessParser.add_argument('--rules', dest='rules', action='store', metavar='FILE',
+                                 help='JSON file with the thresholds per job name and level: [{"name": "backup-db-*", "level": "F", "warning": "192", "critical": "384"}]')
+    freshnessParser.add_argument('-w', '--warning', dest='warning', action='store', help='Warning threshold for the hours since the last successful backup [default=26]', default="26")
+    freshnessParser.add_argument('-c', '--critical', dest='critical', action='store', help='Critical threshold for the hours since the last successful backup [default=50]', default="50")
+
+
+def addReportParser(subParser):
+    reportParser = subParser.add_parser('report', help='Write the matching jobs as NDJSON or CSV')
+    reportParser.set_defaults(func=reportJobs, staleness=300)
+    reportParser.add_argument('-n', '--name', dest='name', action='store', help='Name of the job')
+    reportParser.add_argument('-st', '--state', dest='state', action='append', choices=JOBSTATES.keys(), help='Bareos Job State, can be repeated [default=all]')
+    reportParser.add_argument('-fb', '--failedBackups', dest='failedBackups', action='store_true', help='Only failed/canceled jobs as for status -fb')
+    reportParser.add_argument('-t', '--time', dest='time', action='store', help='Only jobs started in the last n days [default=all]')
+    reportParser.add_argument('-f', '--full', dest='full', action='store_true', help='Backup kind full')
+    reportParser.add_argument('-i', '--inc', dest='inc', action='store_true', help='Backup kind inc')
+    reportParser.add_argument('-d', '--diff', dest='diff', action='store_true', help='Backup kind diff')
+    reportParser.add_argument('--format', dest='format', choices=['ndjson', 'csv'], default='ndjson', help='output format [default=ndjson]')
+    reportParser.add_argument('-o', '--output', dest='output', action='store', help='file to write the report to [default=stdout]')
+    reportParser.add_argument('--itersize', dest='itersize', action='store', type=int, default=1000, help='number of rows fetched from the server at once [default=1000]')
+    reportParser.add_argument('--limit', dest='limit', action='store', type=int, default=0, help='write at most n jobs [default=0 (all)]')
+
+
+def addBatchParser(subParser):
+    batchParser = subParser.add_parser('batch', help='Run multiple subchecks over one database connection')
+    batchParser.set_defaults(func=checkBatch)
+    batchParser.add_argument('-f', '--file', dest='file', action='store', help='JSON file with a list of checks: [{"name": "failed", "check": "status -fb"}]')
+    batchParser.add_argument('-C', '--check', dest='check', action='append', help='Check to run as [NAME=]SUBCOMMAND [OPTIONS], can be repeated')
+    batchParser.add_argument('--format', dest='format', choices=['nagios', 'passive'], default='nagios',
+                             help='Output one line per check (nagios) or Icinga external commands for passive checks (passive) [default=nagios]')
+    batchParser.add_argument('--prepare', dest='prepare', action='store_true', help='Execute the queries as prepared statements and report the time saved')
+    batchParser.add_argument('--concurrency', dest='concurrency', action='store', type=int, default=1,
+                             help='number of checks running at the same time, each on its own database connection [default=1]')
+    batchParser.add_argument('--deadline', dest='deadline', action='store', type=float,
+                             help='seconds each check may take before its query is canceled and it is reported as UNKNOWN')
+    batchParser.add_argument('--hostname', dest='hostname', action='store', help='Host name used for passive check results [default=FQDN of this host]')
+
+
+def addAdviseParser(subParser):
+    adviseParser = subParser.add_parser('advise', help='Recommend indexes for the catalog queries of the checks')
+    adviseParser.set_defaults(func=checkAdvise, evaluate=evaluateAdvise, staleness=3600)
+    adviseParser.add_argument('-C', '--check', dest='check', action='append',
+                              help='Check to advise for as SUBCOMMAND [OPTIONS], can be repeated [default=all checks]')
+
+
+def addServeParser(subParser):
+    serveParser = subParser.add_parser('serve', help='Run as daemon answering checks from check_bareos_client.py on a UNIX socket')
+    serveParser.set_defaults(func=serveChecks)
+    serveParser.add_argument('-s', '--socket', dest='socket', action='store', default=os.environ.get('CHECK_BAREOS_SOCKET', DEFAULT_SOCKET),
+                             help='path of the UNIX socket (CHECK_BAREOS_SOCKET) [default=' + DEFAULT_SOCKET + ']')
+    serveParser.add_argument('--pool-size', dest='pool_size', action='store', type=int, default=4, help='number of database connections kept open [default=4]')
+
+
+def addExportParser(subParser):
+    exportParser = subParser.add_parser('export', help='Run as Prometheus exporter serving the metrics of the checks on /metrics')
+    exportParser.set_defaults(func=exportMetrics)
+    exportParser.add_argument('-l', '--listen', dest='listen', action='store', default=DEFAULT_LISTEN,
+                              help='address and port to serve /metrics on [default=' + DEFAULT_LISTEN + ']')
+    exportParser.add_argument('-i', '--interval', dest='interval', action='store', type=float, default=60,
+                              help='seconds between two refreshes of the metrics [default=60]')
+    exportParser.add_argument('-f', '--file', dest='file', action='store', help='JSON file with the checks to export as for batch [default=all checks]')
+    exportParser.add_argument('-C', '--check', dest='check', action='append', help='Check to export as [NAME=]SUBCOMMAND [OPTIONS], can be repeated')
+
+
+# The subcommands with the functions adding their parsers
+SUBCOMMANDS = {
+    'job': addJobParser,
+    'tape': addTapeParser,
+    'expiry-view': addExpiryViewParser,
+    'status': addStatusParser,
+    'trend': addTrendParser,
+    'anomaly': addAnomalyParser,
+    'freshness': addFreshnessParser,
+    'report': addReportParser,
+    'batch': addBatchParser,
+    'advise': addAdviseParser,
+    'serve': addServeParser,
+    'export': addExportParser,
+}
 
-    parsed = parser.parse_args(args)
 
-    if not hasattr(parsed, 'func'):
-        print("[UNKNOWN] - Error: Object to check is missing")
-        parser.print_help()
-        sys.exit(3)
+def createParser(commands=None):
+    """
+    Create the argument parser, returns the parser and its subcommands.
+    With commands only the parsers of these subcommands are added.
+    """
+    def environ_or_required(key):
+        return ({'default': os.environ.get(key)} if os.environ.get(key) else {})
 
-    return parsed
+    parser = argparse.ArgumentParser(description='Check Plugin for Bareos Backup Status')
+    group = parser.add_argument_group()
+    group.add_argument('-U', '--user', dest='user', action='store', required=True, help='user name for the database connections')
+
+    password_group = group.add_mutually_exclusive_group()
+
+    password_group.add_argument('-p', '--password', dest='password', action='store',
+                                **environ_or_required('CHECK_BAREOS_DATABASE_PASSWORD'),
+                                help='password for the database connections (CHECK_BAREOS_DATABASE_PASSWORD)')
+    password_group.add_argument('--password-file', dest='password_file', action='store',
+                                default='/etc/bareos/bareos-dir.conf',
+                                help='path to a password file. Can be the bareos-dir.conf')
+
+    group.add_argument('-H', '--Host', dest='host', action='store', help='database host, a comma separated list of the primary and its hot standbys', default="127.0.0.1")
+    group.add_argument('-P', '--port', dest='port', action='store', help='database port', default=5432, type=int)
+    group.add_argument('-d', '--database', dest='database', default='bareos', help='database name')
+    group.add_argument('--cache-ttl', dest='cache_ttl', action='store', type=int, default=0,
+                       help='serve results younger than n seconds from a cache shared by all invocations [default=0 (disabled)]')
+    group.add_argument('--cache-stale', dest='cache_stale', action='store', type=int, default=0,
+                       help='serve expired results for n more seconds while one invocation refreshes them [default=0]')
+    group.add_argument('--cache-dir', dest='cache_dir', action='store', default=DEFAULT_CACHE_DIR, help='directory of the result cache [default=' + DEFAULT_CACHE_DIR + ']')
+    group.add_argument('--timeout', dest='timeout', action='store', type=float,
+                       help='seconds the connection and the queries may take, the queries are canceled on the server and the check returns UNKNOWN or the last cached result')
+    group.add_argument('--max-staleness', dest='max_staleness', action='store', type=float,
+                       help='seconds a hot standby of the hosts may lag behind the primary to be used [default=depends on the check]')
+    group.add_argument('--pgbouncer', dest='pgbouncer', action='store_true',
+                       help='the database is reached through pgbouncer in transaction mode, queries are not prepared')
+    group.add_argument('--instrument', dest='instrument', action='store_true',
+                       help='add the time of each phase, the queries, rows fetched and the peak RSS of the invocation to the perfdata')
+    group.add_argument('--trace', dest='trace', action='store', metavar='FILE',
+                       help='append the timings of the instrumented invocation as JSON line to FILE')
+    group.add_argument('--explain', dest='explain', action='store_true',
+                       help='run the queries with EXPLAIN (ANALYZE, BUFFERS) and report the sequential scans and row estimates in the long output')
+    group.add_argument('-v', '--version', action='version', version=f'%(prog)s {__version__}')
+
+    subParser = parser.add_subparsers()
+    for name, addParser in SUBCOMMANDS.items():
+        if commands is None or name in commands:
+            addParser(subParser)
+
+    return parser, subParser
+
+
+def commandline(args):
+    """
+    Parse commandline arguments.
+    """
+    # Only the subcommands named on the command line are built, all of them for the help
+    parser, _ = createParser([arg for arg in args if arg in SUBCOMMANDS] or None)
+    parsed = parser.parse_args(args)
+
+    if not hasattr(parsed, 'func'):
+        print("[UNKNOWN] - Error: Object to check is missing")
+        parser.print_help()
+        sys.exit(3)
+
+    return parsed
 
 
 def checkConnection(cursor):
@@ -678,36 +2426,44 @@ def checkConnection(cursor):
     return True
 
 
-def checkTape(args):
-    cursor = connectDB(args.user, args.password, args.host, args.database, args.port)
-
-    checkConnection(cursor)
-
+def evaluateTape(cursor, args, stats=None):
     warning = Threshold(args.warning)
     critical = Threshold(args.critical)
 
     checkResult = {}
 
+    if args.expiry_view and args.expiry_max_age:
+        refreshExpiryView(cursor, args.expiry_max_age)
+
+    inventory = None
+    # The expiry histogram has its own query and does not read the inventory
+    if args.inventory and not args.expiryHistogram:
+        # Batches share one inventory between their tape checks
+        inventory = stats if isinstance(stats, TapeInventory) else TapeInventory()
+        inventory.load(cursor)
+
+    groups = PerfGroups(args.group_by, args.group_limit, warning, critical) if args.group_by else None
+
     if args.emptyTapes:
-        checkResult = checkEmptyTapes(cursor, warning, critical)
+        checkResult = checkEmptyTapes(cursor, warning, critical, args.expiry_view, inventory, groups, args.group_limit)
     if args.replaceTapes:
-        checkResult = checkReplaceTapes(cursor, args.mounts, warning, critical)
+        checkResult = checkReplaceTapes(cursor, args.mounts, warning, critical, inventory, groups, args.group_limit)
     elif args.tapesInStorage:
-        checkResult = checkTapesInStorage(cursor, warning, critical)
+        checkResult = checkTapesInStorage(cursor, warning, critical, inventory, groups, args.group_limit)
     elif args.expiredTapes:
-        checkResult = checkExpiredTapes(cursor, warning, critical)
+        checkResult = checkExpiredTapes(cursor, warning, critical, args.expiry_view, inventory, groups, args.group_limit)
     elif args.willExpire:
-        checkResult = checkWillExpiredTapes(cursor, args.time, warning, critical)
-
-    printNagiosOutput(checkResult)
-    cursor.close()
+        checkResult = checkWillExpiredTapes(cursor, args.time, warning, critical, args.expiry_view, inventory, groups, args.group_limit)
+    elif args.expiryHistogram:
+        checkResult = checkExpiryHistogram(cursor, warning, critical, args.expiry_view)
 
+    if groups is not None and checkResult:
+        checkResult["returnMessage"] += groups.summary()
 
-def checkJob(args):
-    cursor = connectDB(args.user, args.password, args.host, args.database, args.port)
+    return checkResult
 
-    checkConnection(cursor)
 
+def evaluateJob(cursor, args, stats=None):
     warning = Threshold(args.warning)
     critical = Threshold(args.critical)
 
@@ -715,54 +2471,1173 @@ def checkJob(args):
 
     if args.checkJob:
         kind = createBackupKindString(args.full, args.inc, args.diff)
-        checkResult = checkSingleJob(cursor, args.name, args.state, kind, args.time, warning, critical)
+        checkResult = checkSingleJob(cursor, args.name, args.state, kind, args.time, warning, critical, stats, args.details)
     elif args.checkJobs:
         kind = createBackupKindString(args.full, args.inc, args.diff)
-        checkResult = checkJobs(cursor, args.state, kind, args.time, warning, critical)
+        checkResult = checkJobs(cursor, args.state, kind, args.time, warning, critical, stats)
     elif args.runTimeJobs:
-        checkResult = checkRunTimeJobs(cursor, args.state, args.time, warning, critical)
+        checkResult = checkRunTimeJobs(cursor, args.state, args.time, warning, critical, stats)
 
-    printNagiosOutput(checkResult)
-    cursor.close()
+    return checkResult
 
 
-def checkStatus(args):
-    cursor = connectDB(args.user, args.password, args.host, args.database, args.port)
-    checkConnection(cursor)
-
-    warning = Threshold(args.warning)
-    critical = Threshold(args.critical)
+def evaluateStatus(cursor, args, stats=None):
+    # Sizes are compared in the display unit, the other checks count jobs
+    unit = args.unit if args.totalBackupsSize else None
+    warning = Threshold(args.warning, unit)
+    critical = Threshold(args.critical, unit)
 
     checkResult = {}
 
+    groups = PerfGroups(args.group_by, args.group_limit, warning, critical) if args.group_by else None
+
+    # Fractional windows are not kept in whole-day buckets, they are checked with the regular query
+    if args.incremental and not args.totalBackupsSize and float(args.time or 7).is_integer():
+        if groups is not None:
+            raise ValueError('--group-by is not supported in incremental mode')
+        stats = IncrementalJobState(args.incremental)
+        sizes = [float(args.size) * createFactor(args.unit)] if args.oversizedBackups else []
+        stats.lockedUpdate(cursor, int(float(args.time or 7)), sizes)
+
     if args.emptyBackups:
         kind = createBackupKindString(args.full, args.inc, args.diff)
-        checkResult = checkEmptyBackups(cursor, args.time, kind, warning, critical)
+        checkResult = checkEmptyBackups(cursor, args.time, kind, warning, critical, stats, args.details, groups)
     elif args.totalBackupsSize:
         kind = createBackupKindString(args.full, args.inc, args.diff)
-        checkResult = checkTotalBackupSize(cursor, args.time, kind, args.unit, warning, critical)
+        checkResult = checkTotalBackupSize(cursor, args.time, kind, args.unit, warning, critical, stats, groups)
     elif args.oversizedBackups:
         kind = createBackupKindString(args.full, args.inc, args.diff)
-        checkResult = checkOversizedBackups(cursor, args.time, args.size, kind, args.unit, warning, critical)
+        checkResult = checkOversizedBackups(cursor, args.time, args.size, kind, args.unit, warning, critical, stats, args.details, groups)
     elif args.failedBackups:
-        kind = createBackupKindString(args.full, args.inc, args.diff)
-        checkResult = checkFailedBackups(cursor, args.time, warning, critical)
+        checkResult = checkFailedBackups(cursor, args.time, warning, critical, stats, args.details, groups)
+
+    if groups is not None and checkResult:
+        checkResult["returnMessage"] += groups.summary()
+
+    return checkResult
+
+
+def evaluateTrend(cursor, args, stats=None): # pylint: disable=unused-argument
+    warning = Threshold(args.warning)
+    critical = Threshold(args.critical)
+
+    trend = BackupTrend(args.state_file)
+
+    if args.state_file:
+        trend.lockedUpdate(cursor, args.time)
+    else:
+        trend.update(cursor, args.time)
+
+    return checkBackupTrend(trend, args.time, args.bucket, args.model, args.unit, args.capacity, args.deviation, warning, critical, args.group_limit)
+
+
+def evaluateAnomaly(cursor, args, stats=None): # pylint: disable=unused-argument
+    warning = Threshold(args.warning)
+    critical = Threshold(args.critical)
+
+    baselines = JobBaselines(args.state_file, args.alpha, args.min_samples, args.duration_factor, args.size_factor)
+
+    baselines.lockedUpdate(cursor, args.time)
+
+    return checkJobAnomalies(baselines, args.time, warning, critical)
+
+
+def evaluateFreshness(cursor, args, stats=None): # pylint: disable=unused-argument
+    warning = Threshold(args.warning)
+    critical = Threshold(args.critical)
+
+    if args.rules:
+        rules = FreshnessRules.load(args.rules, warning, critical)
+    else:
+        rules = FreshnessRules(warning, critical)
+
+    return checkJobFreshness(cursor, rules)
+
+
+class ResultCache:
+    """
+    Caches check results on disk, shared between concurrent invocations of the plugin.
+    Fresh results (younger than ttl) are served from the cache. Only one invocation runs the
+    query for a missing result, the others wait for it on a file lock. Results that are
+    stale (older than ttl but younger than ttl + stale) are served while one invocation refreshes them.
+    """
+    def __init__(self, directory, ttl, stale=0, wait=30):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale = stale
+        self.wait = wait
+
+    @staticmethod
+    def key(args):
+        """
+        Returns the cache key of a check: the database connection and the normalized
+        check arguments, without the password, the cache and the instrumentation options
+        """
+        ignored = ('password', 'password_file', 'cache_ttl', 'cache_stale', 'cache_dir', 'instrument', 'trace', 'timeout', 'max_staleness')
+        normalized = {k: str(v) for k, v in vars(args).items() if k not in ignored and not callable(v)}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def trusted(self):
+        """
+        Returns whether the cache directory is private to this user. Other local users
+        could create a shared directory like /var/tmp/check_bareos first and plant results.
+        """
+        try:
+            stat = os.lstat(self.directory)
+        except OSError:
+            return False
+        return (not os.path.islink(self.directory) and os.path.isdir(self.directory) and
+                stat.st_uid == os.geteuid() and stat.st_mode & 0o077 == 0)
+
+    def read(self, key):
+        """
+        Returns the cached entry with the time and the result, None if there is none
+        """
+        if not self.trusted():
+            return None
+        try:
+            with open(self._path(key, '.json'), encoding='utf-8') as cachefile:
+                return json.load(cachefile)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key, result):
+        # Write atomically, readers never see a partial file
+        tmp = self._path(key, '.' + str(os.getpid()) + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as cachefile:
+            json.dump({"time": time.time(), "result": result}, cachefile)
+        os.replace(tmp, self._path(key, '.json'))
+
+    def _lock(self, lockfile, blocking):
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if not blocking or time.monotonic() > deadline:
+                    return False
+                time.sleep(0.05)
+
+    def get(self, key, compute):
+        """
+        Returns the cached result for the key or computes and caches it
+        """
+        entry = self.read(key)
+        if entry and time.time() - entry["time"] < self.ttl:
+            return entry["result"]
+
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not self.trusted():
+            # The cache is bypassed rather than trusting results written by others
+            return compute()
+
+        with open(self._path(key, '.lock'), 'a', encoding='utf-8') as lockfile:
+            if entry and time.time() - entry["time"] < self.ttl + self.stale:
+                # Another invocation is already refreshing the result
+                if not self._lock(lockfile, blocking=False):
+                    return entry["result"]
+            elif self._lock(lockfile, blocking=True):
+                # The invocation holding the lock might have refreshed the result
+                entry = self.read(key)
+                if entry and time.time() - entry["time"] < self.ttl:
+                    return entry["result"]
+
+            result = compute()
+
+            # Errors are not cached, the next invocation tries again
+            if result and result.get("returnCode") != UNKNOWN:
+                self._write(key, result)
+
+        return result
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the queries of a check were canceled at the deadline given with --timeout
+    """
+    def __init__(self, timeout, elapsed, action="query canceled"):
+        super().__init__("Deadline of " + str(timeout) + "s exceeded, " + action + " after " + str(round(elapsed, 2)) + "s")
+        self.timeout = timeout
+        self.elapsed = elapsed
+
+
+@contextlib.contextmanager
+def queryDeadline(connection, timeout):
+    """
+    Cancels the running query of the connection when the timeout has passed
+    """
+    if timeout is None:
+        yield
+        return
+
+    timer = threading.Timer(max(timeout, 0), connection.cancel)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+
+
+def queryCheck(args, evaluate):
+    started = time.monotonic()
+    with phase('connect'):
+        cursor = connectDB(args.user, args.password, args.host, args.database, args.port, args.timeout, args.pgbouncer, stalenessBudget(args))
+    checkConnection(cursor)
+
+    if Instrumentation.active is not None:
+        cursor = InstrumentedCursor(cursor, Instrumentation.active)
+
+    if getattr(args, 'explain', False):
+        cursor = ExplainCursor(cursor)
+
+    try:
+        # The connection counts against the deadline
+        with queryDeadline(cursor.connection, args.timeout - (time.monotonic() - started) if args.timeout else None):
+            checkResult = evaluate(cursor, args)
+    except psycopg2.extensions.QueryCanceledError:
+        cursor.connection.close()
+        raise DeadlineExceeded(args.timeout, time.monotonic() - started) # pylint: disable=raise-missing-from
+
+    if isinstance(cursor, ExplainCursor) and checkResult:
+        checkResult["performanceData"] = checkResult.get("performanceData", "") + " " + cursor.performanceData()
+        checkResult["longOutput"] = "\n".join(filter(None, [checkResult.get("longOutput"), cursor.longOutput()]))
 
-    printNagiosOutput(checkResult)
     cursor.close()
+    cursor.connection.close()
+    return checkResult
 
 
-if __name__ == '__main__': # pragma: no cover
+def runCheck(args, evaluate):
     try:
-        ARGS = commandline(sys.argv[1:])
+        # The plans of --explain are not cached
+        if not args.cache_ttl or args.explain:
+            return queryCheck(args, evaluate)
+
+        cache = ResultCache(args.cache_dir, args.cache_ttl, args.cache_stale)
+        return cache.get(ResultCache.key(args), lambda: queryCheck(args, evaluate))
+    except DeadlineExceeded as e:
+        return deadlineResult(args, e)
+
+
+def deadlineResult(args, exceeded):
+    """
+    Returns the last cached result of a check whose queries were canceled at the deadline, UNKNOWN if there is none.
+    Results older than --cache-ttl and --cache-stale together do not tell the state of the catalog anymore and are not used.
+    """
+    entry = ResultCache(args.cache_dir, args.cache_ttl, args.cache_stale).read(ResultCache.key(args))
+    if not entry or time.time() - entry["time"] >= args.cache_ttl + args.cache_stale:
+        return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(exceeded)}
+
+    checkResult = dict(entry["result"])
+    checkResult["returnMessage"] += " (cached " + str(int(time.time() - entry["time"])) + "s ago, " + str(exceeded) + ")"
+    return checkResult
+
+
+def instrumentCheck(args, evaluate):
+    """
+    Runs a check and adds the timings of its phases to the perfdata with --instrument.
+    The output phase ends after the perfdata is written, it is only part of the trace.
+    """
+    checkResult = runCheck(args, evaluate)
+
+    instrumentation = Instrumentation.active
+    if instrumentation is not None and checkResult:
+        instrumentation.returnCode = checkResult["returnCode"]
+        if args.instrument:
+            checkResult["performanceData"] = (checkResult.get("performanceData", "") + " " + instrumentation.performanceData()).strip()
+
+    return checkResult
+
+
+def checkTape(args):
+    printNagiosOutput(instrumentCheck(args, evaluateTape))
+
+
+def checkJob(args):
+    printNagiosOutput(instrumentCheck(args, evaluateJob))
+
+
+def checkStatus(args):
+    printNagiosOutput(instrumentCheck(args, evaluateStatus))
+
+
+def checkTrend(args):
+    printNagiosOutput(instrumentCheck(args, evaluateTrend))
+
+
+def checkAnomaly(args):
+    printNagiosOutput(instrumentCheck(args, evaluateAnomaly))
+
+
+def checkFreshness(args):
+    printNagiosOutput(instrumentCheck(args, evaluateFreshness))
+
+
+def reportError(args, message):
+    """
+    Reports a failed report as UNKNOWN, the error must not end up as a record in the report streamed to stdout
+    """
+    if args.output:
+        printNagiosOutput({"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + message})
+    print("[UNKNOWN] - " + message, file=sys.stderr)
+    sys.exit(UNKNOWN)
+
+
+def reportJobs(args):
+    states = list(args.state or [])
+    if args.failedBackups:
+        states.extend(['E', 'f'])
+    kind = createBackupKindString(args.full, args.inc, args.diff) if args.full or args.inc or args.diff else None
+    jobFilter = JobFilter(name=args.name, states=states or None, kind=kind, time=args.time, midnight=False)
+
+    try:
+        cursor = connectDB(args.user, args.password, args.host, args.database, args.port, args.timeout, args.pgbouncer, stalenessBudget(args))
+    except DeadlineExceeded as e:
+        reportError(args, str(e))
+    checkConnection(cursor)
+
+    try:
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8', newline='') as out:
+                count = streamJobReport(cursor, jobFilter, out, args.format, args.itersize, args.limit)
+        else:
+            count = streamJobReport(cursor, jobFilter, sys.stdout, args.format, args.itersize, args.limit)
+    except psycopg2.DatabaseError as e:
+        reportError(args, str(e).strip())
+
+    cursor.close()
+    cursor.connection.close()
+
+    # The report itself is written to stdout without a summary
+    if args.output:
+        printNagiosOutput({"returnCode": OK, "returnMessage": "[OK] - " + str(count) + " Jobs written to " + args.output,
+                           "performanceData": "bareos.report.jobs=" + str(count)})
+    sys.exit(OK)
+
+
+def evaluateExpiryView(cursor, args, stats=None): # pylint: disable=unused-argument
+    checkState = {}
+
+    if args.create:
+        cursor.execute(QUERIES['createExpiryView'])
+        checkState["returnMessage"] = "[OK] - Created the materialized view check_bareos_media_expiry"
+    elif args.refresh:
+        cursor.execute(QUERIES['refreshExpiryView'])
+        checkState["returnMessage"] = "[OK] - Refreshed the materialized view check_bareos_media_expiry"
+    elif args.drop:
+        cursor.execute(QUERIES['dropExpiryView'])
+        checkState["returnMessage"] = "[OK] - Dropped the materialized view check_bareos_media_expiry"
+
+    cursor.connection.commit()
+    checkState["returnCode"] = OK
+
+    return checkState
+
+
+def checkExpiryView(args):
+    printNagiosOutput(queryCheck(args, evaluateExpiryView))
+
+
+def adviseIndexes(existing, checks=None):
+    """
+    Returns the recommended indexes for the checks that are missing,
+    with the existing index definitions from pg_indexes and the checks as (subcommand, parsed arguments).
+    Without checks all recommended indexes are considered.
+    """
+    missing = []
+    for index in INDEXES:
+        if checks is not None and not any(option is None or getattr(checkArgs, option, False)
+                                          for subcommand, checkArgs in checks for command, option in index["checks"] if subcommand == command):
+            continue
+        if any(name == index["name"] or re.search(index["pattern"], definition.lower()) for name, definition in existing):
+            continue
+        missing.append(index)
+
+    return missing
+
+
+def evaluateAdvise(cursor, args, stats=None): # pylint: disable=unused-argument
+    _, subParser = createParser()
+
+    checks = None
+    if args.check:
+        checks = []
+        for spec in args.check:
+            _, check = parseBatchCheck(spec)
+            checkArgs, checkResult = parseBatchArguments(subParser, check)
+            if checkArgs is None:
+                return checkResult
+            checks.append((check[0], checkArgs))
+
+    cursor.execute(QUERIES['indexes'])
+    existing = cursor.fetchall()
+
+    missing = adviseIndexes(existing, checks)
+
+    checkState = {}
+    if missing:
+        checkState["returnCode"] = WARNING
+        checkState["returnMessage"] = "[WARNING] - " + str(len(missing)) + " recommended indexes are missing"
+        checkState["longOutput"] = "\n".join("-- " + index["reason"] + "\n" + index["definition"] for index in missing)
+    else:
+        checkState["returnCode"] = OK
+        checkState["returnMessage"] = "[OK] - All recommended indexes exist"
 
-        if ARGS.password_file and not ARGS.password:
-            ARGS.password = read_password_from_file(ARGS.password_file)
+    checkState["performanceData"] = "bareos.indexes.missing=" + str(len(missing)) + ";;;;"
 
-        ARGS.func(ARGS)
+    return checkState
+
+
+def checkAdvise(args):
+    printNagiosOutput(queryCheck(args, evaluateAdvise))
+
+
+def worstState(states):
+    """
+    Returns the most severe of the given Nagios states,
+    CRITICAL outranks UNKNOWN which outranks WARNING
+    """
+    severity = [OK, WARNING, UNKNOWN, CRITICAL]
+    return max(states, key=severity.index, default=OK)
+
+
+def checkName(check):
+    """
+    Returns the default name of a batch check, usable as perfdata label and service name:
+    ['status', '-fb', '-w', '1'] becomes status_fb_w_1
+    """
+    return re.sub(r'[^A-Za-z0-9.:~]+', '_', ' '.join(check)).strip('_')
+
+
+def readBatchFile(fp):
+    """
+    Reads the checks of a batch from a JSON file.
+    The file contains a list of objects with a 'name' and the 'check' to run,
+    either as a string or as a list of arguments:
+    [{"name": "failed", "check": "status -fb -w 1 -c 2"}]
+    """
+    with open(fp, encoding='utf-8') as batchfile:
+        entries = json.load(batchfile)
+
+    checks = []
+    for entry in entries:
+        check = entry['check']
+        if isinstance(check, str):
+            check = shlex.split(check)
+        check = [str(a) for a in check]
+        checks.append((entry.get('name', checkName(check)), check))
+
+    return checks
+
+
+def parseBatchCheck(spec):
+    """
+    Splits a --check specification into a name and its arguments.
+    The name is optional and separated by '=' from the subcommand: 'failed=status -fb -w 1'
+    """
+    check = shlex.split(spec)
+    name = None
+    if check and '=' in check[0] and not check[0].startswith('-'):
+        name, check[0] = check[0].split('=', 1)
+    if not name:
+        name = checkName(check)
+
+    return name, check
+
+
+def batchChecks(args):
+    """
+    Returns the checks given with --file and --check as (name, arguments)
+    """
+    checks = []
+    if args.file:
+        checks.extend(readBatchFile(args.file))
+    for spec in args.check or []:
+        checks.append(parseBatchCheck(spec))
+    return checks
+
+
+def serveUntilStopped(server):
+    """
+    Serves the requests until SIGTERM or an interrupt, the caller cleans up afterwards
+    """
+    # Stop cleanly on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(OK))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def parseBatchArguments(subParser, check):
+    """
+    Parses the arguments of a single check of a batch.
+    Returns the parsed arguments or a checkState with the error.
+    """
+    if not check or check[0] not in subParser.choices or check[0] == 'batch':
+        return None, {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Invalid check: " + " ".join(check)}
+
+    try:
+        checkArgs = subParser.choices[check[0]].parse_args(check[1:])
+    except SystemExit:
+        return None, {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Invalid arguments: " + " ".join(check)}
+
+    # Subcommands like report, serve and export are not checks
+    if not hasattr(checkArgs, 'evaluate'):
+        return None, {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Invalid check: " + " ".join(check)}
+
+    return checkArgs, None
+
+
+def evaluateBatchCheck(cursor, checkArgs, stats=None):
+    """
+    Evaluates a single check of a batch, errors are reported as UNKNOWN
+    """
+    try:
+        checkResult = checkArgs.evaluate(cursor, checkArgs, stats)
+    except psycopg2.DatabaseError as e:
+        # A failed statement aborts the transaction for all following checks
+        cursor.connection.rollback()
+        return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e).strip()}
+    except ValueError as e:
+        return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e)}
+    except Exception as e: # pylint: disable=broad-exception-caught
+        # Reported like main() does for a single check, the other checks of the batch still run
+        return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Error: " + str(e)}
+
+    if not checkResult:
+        return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Object to check is missing"}
+
+    return checkResult
+
+
+def isAggregated(checkArgs):
+    # The job and status checks read their counters from the JobStatistics, grouped checks run their own GROUP BY query
+    return (checkArgs is not None and checkArgs.evaluate in (evaluateJob, evaluateStatus)
+            and not getattr(checkArgs, 'incremental', None) and not getattr(checkArgs, 'group_by', None))
+
+
+def sharedState(checkArgs, stats, inventory):
+    # The job and status checks read their counters from the JobStatistics, the tape checks share the TapeInventory
+    if isAggregated(checkArgs):
+        return stats
+    if checkArgs.evaluate is evaluateTape:
+        return inventory
+    return None
+
+
+def planJobStatistics(parsed):
+    """
+    Registers the counters of all job and status checks of a batch in a JobStatistics
+    """
+    stats = JobStatistics()
+    for _, checkArgs, _ in parsed:
+        if isAggregated(checkArgs):
+            try:
+                # The checks do not use the cursor while planning
+                checkArgs.evaluate(None, checkArgs, stats)
+            except ValueError:
+                # Reported when the check is evaluated
+                pass
+
+    return stats
+
+
+def evaluateBatch(cursor, subParser, checks):
+    """
+    Evaluates all checks of a batch. The job and status checks are planned first
+    so their counters are fetched from the Job table with a single query.
+    """
+    parsed = [(name,) + parseBatchArguments(subParser, check) for name, check in checks]
+
+    stats = planJobStatistics(parsed)
+
+    try:
+        stats.collect(cursor)
+    except psycopg2.DatabaseError:
+        # Fall back to one query per check, errors are then reported by the failing checks
+        cursor.connection.rollback()
+        stats = None
+
+    # The tape checks with --inventory share one TapeInventory
+    inventory = TapeInventory()
+
+    return [(name, evaluateBatchCheck(cursor, checkArgs, sharedState(checkArgs, stats, inventory)) if checkArgs is not None else checkResult)
+            for name, checkArgs, checkResult in parsed]
+
+
+async def evaluateBatchConcurrently(pool, subParser, checks, concurrency, deadline=None):
+    """
+    Evaluates the checks of a batch concurrently over a pool of connections.
+    The query of the JobStatistics and the other checks run at the same time in a thread pool.
+    A check that does not finish within the deadline is reported as UNKNOWN and its query is canceled.
+    """
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    # A check only starts its deadline once a worker is free to run it
+    workers = asyncio.Semaphore(concurrency)
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(workers.release)
+        except RuntimeError:
+            # The batch is already finished
+            pass
+
+    async def run(work):
+        connections = []
+
+        def withCursor():
+            with pool.cursor() as cursor:
+                connections.append(cursor.connection)
+                return work(cursor)
+
+        await workers.acquire()
+        # The worker is free again when the query returns, even after the deadline
+        future = executor.submit(withCursor)
+        future.add_done_callback(release)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), deadline)
+        except asyncio.TimeoutError:
+            # Stop the query on the server, the connection is returned to the pool afterwards
+            for connection in connections:
+                connection.cancel()
+            return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Deadline of " + str(deadline) + "s exceeded"}
+        except psycopg2.Error as e:
+            # The pool could not reconnect, the other checks still get their results
+            return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e).strip()}
+
+    parsed = [(name,) + parseBatchArguments(subParser, check) for name, check in checks]
+    stats = planJobStatistics(parsed)
+
+    def collect(cursor):
+        try:
+            stats.collect(cursor)
+        except psycopg2.DatabaseError as e:
+            cursor.connection.rollback()
+            return {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e).strip()}
+        return None
+
+    collected = asyncio.ensure_future(run(collect))
+
+    # The first tape check with --inventory loads it, the others wait for it
+    inventory = TapeInventory()
+
+    async def evaluate(checkArgs, checkResult):
+        if checkArgs is None:
+            return checkResult
+        if isAggregated(checkArgs):
+            error = await collected
+            if error:
+                return error
+            return await run(lambda cursor: evaluateBatchCheck(cursor, checkArgs, stats))
+        return await run(lambda cursor: evaluateBatchCheck(cursor, checkArgs, sharedState(checkArgs, None, inventory)))
+
+    try:
+        results = await asyncio.gather(*(evaluate(checkArgs, checkResult) for _, checkArgs, checkResult in parsed))
+        await collected
+    finally:
+        executor.shutdown(wait=False)
+
+    return [(name, checkResult) for (name, _, _), checkResult in zip(parsed, results)]
+
+
+def relabel(name, performanceData):
+    """
+    Prefixes every perfdata label with the check name (check_multi style) to keep them unique
+    """
+    def prefix(match):
+        label = match.group(1)
+        if label.startswith("'"):
+            label = label[1:-1].replace("''", "'")
+        return perfLabel(name + "::" + label) + "="
+
+    return re.sub(r"('(?:[^']|'')*'|[^\s=]+)=", prefix, performanceData)
+
+
+def formatBatchOutput(results, outputFormat, hostname):
+    """
+    Formats the results of a batch as Nagios output with one line per check,
+    or as Icinga/Nagios external commands for passive check results
+    """
+    lines = []
+
+    if outputFormat == 'passive':
+        timestamp = int(time.time())
+        for name, checkResult in results:
+            lines.append("[{0}] PROCESS_SERVICE_CHECK_RESULT;{1};{2};{3};{4}".format(
+                timestamp, hostname, name, checkResult["returnCode"], formatNagiosOutput(checkResult).replace("\n", "\\n")))
+        return "\n".join(lines)
+
+    states = [checkResult["returnCode"] for _, checkResult in results]
+    state = worstState(states)
+
+    perfData = []
+    for name, checkResult in results:
+        lines.append(name + ": " + checkResult["returnMessage"])
+        if checkResult.get("longOutput"):
+            lines.extend("    " + line for line in checkResult["longOutput"].split("\n"))
+        perf = checkResult.get("performanceData")
+        if perf:
+            perfData.append(relabel(name, perf))
+
+    summary = "[" + STATE_NAMES[state] + "] - " + str(len(results)) + " checks: " + ", ".join(
+        str(states.count(s)) + " " + STATE_NAMES[s] for s in [CRITICAL, WARNING, UNKNOWN, OK])
+
+    return summary + "|" + " ".join(perfData) + "\n" + "\n".join(lines)
+
+
+def checkBatch(args):
+    checks = batchChecks(args)
+
+    if not checks:
+        printNagiosOutput({"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - No checks given for batch"})
+
+    _, subParser = createParser()
+    staleness = batchStaleness(args, subParser, checks)
+
+    if args.concurrency > 1 or args.deadline:
+        try:
+            pool = createPool(args, args.concurrency, args.prepare, staleness)
+        except psycopg2.DatabaseError as e:
+            printNagiosOutput({"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e).strip()})
+
+        results = asyncio.run(evaluateBatchConcurrently(pool, subParser, checks, args.concurrency, args.deadline))
+        pool.close()
+
+        cursor = None
+    else:
+        try:
+            cursor = connectDB(args.user, args.password, args.host, args.database, args.port, args.timeout, args.pgbouncer, staleness)
+        except DeadlineExceeded as e:
+            printNagiosOutput(deadlineResult(args, e))
+        checkConnection(cursor)
+
+        if args.prepare and not args.pgbouncer:
+            cursor = PreparedCursor(cursor)
+
+        results = evaluateBatch(cursor, subParser, checks)
+
+        cursor.close()
+        cursor.connection.close()
+
+    output = formatBatchOutput(results, args.format, args.hostname or socket.getfqdn())
+    if isinstance(cursor, PreparedCursor) and args.format == 'nagios':
+        summary, _, lines = output.partition("\n")
+        output = summary + " " + cursor.performanceData() + "\n" + lines
+    print(output)
+
+    if args.format == 'passive':
+        sys.exit(OK)
+    sys.exit(worstState([checkResult["returnCode"] for _, checkResult in results]))
+
+
+class CursorPool:
+    """
+    Keeps a fixed number of warm database connections for the daemon and concurrent batches.
+    With prepare every connection is wrapped in a PreparedCursor, so the catalog queries
+    are only prepared once per connection.
+    Connections idle for longer than healthInterval seconds are checked before they are handed out,
+    dead ones are replaced, retrying with exponential backoff while the catalog fails over.
+    """
+    def __init__(self, connect, size, prepare=True, healthInterval=30, retries=3, backoff=0.5): # pylint: disable=too-many-arguments
+        self._connect = connect
+        self._prepare = prepare
+        self._healthInterval = healthInterval
+        self._retries = retries
+        self._backoff = backoff
+        # Idle cursors with the time they were last used
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put((self._open(), time.monotonic()))
+
+    def _open(self):
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            try:
+                cursor = self._connect().cursor()
+                break
+            except psycopg2.OperationalError:
+                if attempt == self._retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+        return PreparedCursor(cursor) if self._prepare else cursor
+
+    def _healthy(self, cursor, lastUsed):
+        if cursor.connection.closed:
+            return False
+        if time.monotonic() - lastUsed < self._healthInterval:
+            return True
+        try:
+            with cursor.connection.cursor() as ping:
+                ping.execute("SELECT 1;")
+            cursor.connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def cursor(self):
+        cursor, lastUsed = self._idle.get()
+        if not self._healthy(cursor, lastUsed):
+            try:
+                cursor.connection.close()
+                cursor = self._open()
+            except psycopg2.Error:
+                # The pool keeps its size, the next checkout tries again
+                self._idle.put((cursor, lastUsed))
+                raise
+        try:
+            yield cursor
+        finally:
+            try:
+                # End the transaction, idle connections must not keep it open
+                cursor.connection.rollback()
+            except psycopg2.Error:
+                pass
+            self._idle.put((cursor, time.monotonic()))
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get()[0].connection.close()
+
+
+# Options of the checks the daemon cannot honour, with their destinations.
+# Any client of the socket could read and write files or change the catalog schema
+# with the rights of the daemon through the file and DDL options.
+DAEMON_UNSUPPORTED_OPTIONS = {
+    '--cache-ttl': 'cache_ttl',
+    '--cache-stale': 'cache_stale',
+    '--max-staleness': 'max_staleness',
+    '--instrument': 'instrument',
+    '--trace': 'trace',
+    '--explain': 'explain',
+    '--incremental': 'incremental',
+    '--state-file': 'state_file',
+    '--rules': 'rules',
+    '--create': 'create',
+    '--drop': 'drop',
+}
+
+
+def catalogOptions(args):
+    # The connection options selecting the catalog a check reads
+    return (args.user, args.host, args.port, args.database)
+
+
+def handleCheckRequest(pool, parser, argv, catalog=None):
+    """
+    Evaluates a check for a client of the daemon, the arguments are the
+    same as for check_bareos.py. Returns the Nagios output and the return code.
+    Checks for another catalog than the one of the daemon given as catalogOptions() are rejected.
+    """
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        return {"output": "[UNKNOWN] - Invalid arguments: " + " ".join(argv), "returnCode": UNKNOWN}
+
+    if catalog is not None and catalogOptions(args) != catalog:
+        return {"output": "[UNKNOWN] - The daemon serves the catalog {1}:{2}/{3} as {0}, not {5}:{6}/{7} as {4}".format(*catalog, *catalogOptions(args)),
+                "returnCode": UNKNOWN}
+
+    evaluate = getattr(args, 'evaluate', None)
+    if evaluate is None:
+        return {"output": "[UNKNOWN] - Check not supported by the daemon", "returnCode": UNKNOWN}
+
+    # The daemon has its own connections, it cannot honour these options instead of silently dropping them
+    unsupported = [option for option, dest in DAEMON_UNSUPPORTED_OPTIONS.items() if getattr(args, dest, None)]
+    if unsupported:
+        return {"output": "[UNKNOWN] - Not supported by the daemon: " + ", ".join(unsupported), "returnCode": UNKNOWN}
+
+    started = time.monotonic()
+    try:
+        with pool.cursor() as cursor:
+            with queryDeadline(cursor.connection, args.timeout):
+                checkResult = evaluate(cursor, args)
+    except psycopg2.extensions.QueryCanceledError:
+        # The pool rolls back the canceled transaction, the connection is used again
+        checkResult = {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(DeadlineExceeded(args.timeout, time.monotonic() - started))}
+    except psycopg2.DatabaseError as e:
+        checkResult = {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e).strip()}
+    except ValueError as e:
+        checkResult = {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - " + str(e)}
+    except Exception as e: # pylint: disable=broad-exception-caught
+        # The client always gets a response
+        checkResult = {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Error: " + str(e)}
+
+    if not checkResult:
+        checkResult = {"returnCode": UNKNOWN, "returnMessage": "[UNKNOWN] - Object to check is missing"}
+
+    return {"output": formatNagiosOutput(checkResult), "returnCode": checkResult["returnCode"]}
+
+
+class CheckRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answers one request per connection: a JSON object with the 'argv' of the check
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [str(a) for a in request['argv']]
+        except (ValueError, KeyError, TypeError):
+            response = {"output": "[UNKNOWN] - Invalid request", "returnCode": UNKNOWN}
+        else:
+            try:
+                response = handleCheckRequest(self.server.pool, self.server.parser, argv, getattr(self.server, 'catalog', None))
+            except Exception as e: # pylint: disable=broad-exception-caught
+                response = {"output": "[UNKNOWN] - Error: " + str(e), "returnCode": UNKNOWN}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+def serveChecks(args):
+    pool = createPool(args, args.pool_size, staleness=args.max_staleness)
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    server = socketserver.ThreadingUnixStreamServer(args.socket, CheckRequestHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    server.parser, _ = createParser()
+    server.catalog = catalogOptions(args)
+    os.chmod(args.socket, 0o660)
+
+    try:
+        serveUntilStopped(server)
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        pool.close()
+
+
+# The checks exported by default, the tape checks share one inventory and
+# the job and status checks are computed with one query over the Job table
+EXPORTED_CHECKS = [
+    ('failed_backups', ['status', '-fb']),
+    ('empty_backups', ['status', '-e']),
+    ('oversized_backups', ['status', '-o']),
+    ('total_backup_size', ['status', '-b']),
+    ('runtime_jobs', ['job', '-rt', '-st', 'R']),
+    ('tapes_in_storage', ['tape', '-ts', '--inventory']),
+    ('expired_tapes', ['tape', '-ex', '--inventory']),
+    ('will_expire_tapes', ['tape', '-wex', '--inventory']),
+    ('replace_tapes', ['tape', '-r', '--inventory']),
+    ('empty_tapes', ['tape', '-e', '--inventory']),
+] + [('jobs_' + state, ['job', '-js', '-st', state]) for state in JOBSTATES]
+
+
+def parsePerformanceData(performanceData):
+    """
+    Returns the labels and values of Nagios perfdata, values that are not numbers are skipped
+    """
+    values = []
+    for label, value in re.findall(r"('(?:[^']|'')*'|[^\s=]+)=(\S+)", performanceData or ""):
+        if label.startswith("'"):
+            label = label[1:-1].replace("''", "'")
+        try:
+            values.append((label, float(value.split(';')[0])))
+        except ValueError:
+            pass
+    return values
+
+
+def metricName(label):
+    """
+    Returns the Prometheus metric name and labels for a perfdata label.
+    The job counts per state become bareos_jobs{state=...}, grouped perfdata
+    like bareos.tape.empty.pool.Full becomes bareos_tape_empty_by_pool{pool="Full"}.
+    """
+    labels = {}
+    states = {description: state for state, description in JOBSTATES.items()}
+
+    if label.startswith("bareos.") and label[len("bareos."):] in states:
+        return "bareos_jobs", {"state": states[label[len("bareos."):]]}
+
+    match = re.match(r"^(.*)\.(pool|storage|client|jobname|level)\.(.+)$", label)
+    if match:
+        label = match.group(1) + "_by_" + match.group(2)
+        labels[match.group(2)] = match.group(3)
+
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", label), labels
+
+
+def formatMetrics(results, refreshed, duration, up=True):
+    """
+    Formats the results of the checks as Prometheus text exposition, one gauge per perfdata label
+    """
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    metrics = {}
+    for name, checkResult in results:
+        metrics.setdefault("bareos_check_state", []).append(({"check": name}, checkResult["returnCode"]))
+        for label, value in parsePerformanceData(checkResult.get("performanceData")):
+            metric, labels = metricName(label)
+            labels["check"] = name
+            metrics.setdefault(metric, []).append((labels, value))
+
+    metrics["bareos_exporter_up"] = [({}, 1 if up else 0)]
+    metrics["bareos_exporter_last_refresh_timestamp_seconds"] = [({}, refreshed)]
+    metrics["bareos_exporter_refresh_duration_seconds"] = [({}, round(duration, 6))]
+
+    lines = []
+    for metric, samples in metrics.items():
+        lines.append("# TYPE " + metric + " gauge")
+        for labels, value in samples:
+            labelText = ",".join(key + '="' + escape(labelValue) + '"' for key, labelValue in sorted(labels.items()))
+            lines.append(metric + ("{" + labelText + "}" if labelText else "") + " " + str(value))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter: # pylint: disable=too-many-instance-attributes
+    """
+    Refreshes the metrics of the checks in the background on one pooled connection.
+    Scrapes are answered with the metrics of the last refresh and never query the catalog.
+    """
+    def __init__(self, pool, subParser, checks, interval):
+        self.pool = pool
+        self.subParser = subParser
+        self.checks = checks
+        self.interval = interval
+        self._results = []
+        self._text = formatMetrics([], 0, 0, up=False)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def refresh(self):
+        start = time.monotonic()
+        try:
+            with self.pool.cursor() as cursor:
+                results = evaluateBatch(cursor, self.subParser, self.checks)
+            # The checks report database errors as UNKNOWN, the refresh failed if none got a result
+            up = not results or any(checkResult["returnCode"] != UNKNOWN for _, checkResult in results)
+            if up:
+                self._results = results
+        except psycopg2.Error:
+            # Keep the last results, the connection is replaced by the pool
+            up = False
+
+        self._publish(time.monotonic() - start, up)
+
+    def _publish(self, duration, up):
+        text = formatMetrics(self._results, time.time(), duration, up)
+        with self._lock:
+            self._text = text
+
+    def metrics(self):
+        with self._lock:
+            return self._text
+
+    def run(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.refresh()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                # The refresher keeps running, the scrapes report the exporter as down
+                print("[UNKNOWN] - Refresh of the metrics failed: " + repr(e), file=sys.stderr)
+                self._publish(time.monotonic() - start, False)
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+@functools.lru_cache(maxsize=None)
+def metricsRequestHandler():
+    """
+    Returns the handler serving the metrics of the exporter on /metrics.
+    It is defined on first use, http.server is slow to import and only needed by the exporter.
+    """
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self): # pylint: disable=invalid-name
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = self.server.exporter.metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            # Scrapes are not logged
+            pass
+
+    return MetricsRequestHandler
+
+
+def exportMetrics(args):
+    checks = batchChecks(args) or EXPORTED_CHECKS
+
+    _, subParser = createParser()
+    # Checks writing to the catalog keep the exporter on the primary
+    pool = createPool(args, 1, staleness=batchStaleness(args, subParser, checks) if args.max_staleness is not None else None)
+    exporter = MetricsExporter(pool, subParser, checks, args.interval)
+
+    host, _, port = args.listen.rpartition(':')
+    server = http.server.ThreadingHTTPServer((host.strip('[]') or '127.0.0.1', int(port)), metricsRequestHandler())
+    server.daemon_threads = True
+    server.exporter = exporter
+
+    refresher = threading.Thread(target=exporter.run, daemon=True)
+    refresher.start()
+
+    try:
+        serveUntilStopped(server)
+    finally:
+        exporter.stop()
+        server.server_close()
+        refresher.join()
+        pool.close()
+
+
+def writeTrace(path, argv, instrumentation):
+    """
+    Appends the trace of an instrumented invocation as JSON line to the file
+    """
+    with open(path, 'a', encoding='utf-8') as trace:
+        trace.write(json.dumps(instrumentation.trace(argv)) + "\n")
+
+
+def main(argv):
+    try:
+        # The CPU time until here is spent starting the interpreter and importing the plugin
+        imported = time.process_time()
+        started = time.perf_counter()
+        args = commandline(argv)
+
+        Instrumentation.active = Instrumentation() if args.instrument or args.trace else None
+        if Instrumentation.active is not None:
+            Instrumentation.active.add('import', imported)
+            Instrumentation.active.add('parse', time.perf_counter() - started)
+            if args.trace:
+                atexit.register(writeTrace, args.trace, argv, Instrumentation.active)
+
+        if args.password_file and not args.password:
+            with phase('password'):
+                args.password = read_password_from_file(args.password_file)
+
+        args.func(args)
     except SystemExit:
         # Re-throw the exception
         raise sys.exc_info()[1].with_traceback(sys.exc_info()[2]) # pylint: disable=raise-missing-from
     except: # pylint: disable=bare-except
         print("[UNKNOWN] - Error: %s" % (str(sys.exc_info()[1])))
         sys.exit(3)
+
+
+if __name__ == '__main__': # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Client for the check_bareos.py daemon (check_bareos.py serve)
+#
+# Takes the same arguments as check_bareos.py, forwards them to the daemon
+# and prints the Nagios output and exits with the return code it gets back.
+# Avoids starting the interpreter with psycopg2 and connecting to the database for every check.
+#
+# This program is free software; you can redistribute it or modify
+# it under the terms of the GNU General Public License version 3.0
+
+import json
+import os
+import socket
+import sys
+
+
+DEFAULT_SOCKET = '/run/check_bareos/check_bareos.sock'
+DEFAULT_TIMEOUT = 60
+
+UNKNOWN = 3
+
+
+def stripPassword(argv):
+    """
+    Removes the database password from the arguments, the daemon uses its own connections
+    and the password is not sent over the socket in clear text
+    """
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ('-p', '--password'):
+            skip = True
+        elif not arg.startswith('--password=') and not (arg.startswith('-p') and not arg.startswith('--')):
+            stripped.append(arg)
+    return stripped
+
+
+def requestCheck(path, argv, timeout=DEFAULT_TIMEOUT):
+    """
+    Sends the arguments to the daemon and returns its response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps({"argv": argv}).encode('utf-8') + b"\n")
+
+        response = b""
+        while not response.endswith(b"\n"):
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+
+    return json.loads(response)
+
+
+def main(argv):
+    path = os.environ.get('CHECK_BAREOS_SOCKET', DEFAULT_SOCKET)
+
+    try:
+        response = requestCheck(path, stripPassword(argv))
+    except (OSError, ValueError) as e:
+        print("[UNKNOWN] - Error: check_bareos daemon not reachable on " + path + ": " + str(e))
+        return UNKNOWN
+
+    # Truncated or malformed responses must not end up as a traceback in the plugin output
+    if not isinstance(response, dict) or not isinstance(response.get("output"), str) \
+       or not isinstance(response.get("returnCode"), int) or response["returnCode"] not in range(UNKNOWN + 1):
+        print("[UNKNOWN] - Error: invalid response of the check_bareos daemon on " + path)
+        return UNKNOWN
+
+    print(response["output"])
+    return response["returnCode"]
+
+
+if __name__ == '__main__': # pragma: no cover
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+
+# Fast-start entry point for check_bareos.py
+#
+# Takes the same arguments as check_bareos.py. Python caches the bytecode of imported
+# modules, but compiles a script it runs on every start. Importing check_bareos from
+# this small script saves compiling the whole plugin for every check.
+#
+# This program is free software; you can redistribute it or modify
+# it under the terms of the GNU General Public License version 3.0
+
+import sys
+
+import check_bareos
+
+
+if __name__ == '__main__': # pragma: no cover
+    check_bareos.main(sys.argv[1:])
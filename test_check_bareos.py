@@ -2,8 +2,23 @@
 
 import unittest
 import unittest.mock as mock
+import asyncio
+import contextlib
+import datetime
+import fcntl
+import http.server
+import io
+import json
 import os
+import socketserver
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import psycopg2
 
 sys.path.append('..')
 
@@ -17,11 +32,78 @@ from check_bareos import checkConnection
 from check_bareos import connectDB
 from check_bareos import Threshold
 from check_bareos import check_threshold
+from check_bareos import compileRange
+from check_bareos import thresholdState
+from check_bareos import evaluateThresholds
+from check_bareos import NUMPY_MIN_VALUES
+from check_bareos import createParser
+from check_bareos import LazyModule
+from check_bareos import main
+from check_bareos import queryDeadline
+from check_bareos import replicationLag
+from check_bareos import stalenessBudget
+from check_bareos import DeadlineExceeded
+from check_bareos import Instrumentation
+from check_bareos import InstrumentedCursor
+from check_bareos import writeTrace
+from check_bareos import worstState
+from check_bareos import readBatchFile
+from check_bareos import parseBatchCheck
+from check_bareos import parseBatchArguments
+from check_bareos import evaluateBatchCheck
+from check_bareos import evaluateBatch
+from check_bareos import planJobStatistics
+from check_bareos import filterAggregate
+from check_bareos import JobFilter
+from check_bareos import BackupTrend
+from check_bareos import fitTrend
+from check_bareos import forecastDaysLeft
+from check_bareos import checkBackupTrend
+from check_bareos import JobBaselines
+from check_bareos import JobStatistics
+from check_bareos import fetchJobDetails
+from check_bareos import formatNagiosOutput
+from check_bareos import positionalParameters
+from check_bareos import statementName
+from check_bareos import PreparedCursor
+from check_bareos import refreshExpiryView
+from check_bareos import QUERIES
+from check_bareos import CursorPool
+from check_bareos import createConnection
+from check_bareos import createPool
+from check_bareos import handleCheckRequest
+from check_bareos import CheckRequestHandler
+from check_bareos import ResultCache
+from check_bareos import IncrementalJobState
+from check_bareos import evaluateBatchConcurrently
+from check_bareos import runCheck
+from check_bareos import queryCheck
+from check_bareos import ExplainCursor
+from check_bareos import adviseIndexes
+from check_bareos import INDEXES
+from check_bareos import TapeInventory
+from check_bareos import PerfGroups
+from check_bareos import parsePerformanceData
+from check_bareos import metricName
+from check_bareos import formatMetrics
+from check_bareos import MetricsExporter
+from check_bareos import metricsRequestHandler
+from check_bareos import EXPORTED_CHECKS
+from check_bareos import streamJobReport
+from check_bareos import reportJobs
+
+import check_bareos_client
+import benchmark_check_bareos
+from check_bareos import formatBatchOutput
+from check_bareos import FreshnessRules
+from check_bareos import checkJobFreshness
 
 from check_bareos import checkBackupSize
 from check_bareos import checkEmptyBackups
 from check_bareos import checkEmptyTapes
 from check_bareos import checkExpiredTapes
+from check_bareos import checkExpiryHistogram
+from check_bareos import expiryHistogramQuery
 from check_bareos import checkFailedBackups
 from check_bareos import checkJobs
 from check_bareos import checkOversizedBackups
@@ -55,6 +137,40 @@ class CLITesting(unittest.TestCase):
 
         os.unsetenv('CHECK_BAREOS_DATABASE_PASSWORD')
 
+    def test_commandline_builds_selected_subcommand(self):
+        parser, subParser = createParser(['tape'])
+        self.assertEqual(list(subParser.choices), ['tape'])
+
+        _, subParser = createParser()
+        self.assertIn('export', subParser.choices)
+
+        # A value of a global option named like a subcommand adds its parser as well
+        actual = commandline(['-U', 'job', 'tape', '-ex'])
+        self.assertEqual(actual.user, 'job')
+        self.assertTrue(actual.expiredTapes)
+
+    def test_LazyModule(self):
+        module = LazyModule('email')
+        self.assertEqual(module.utils.quote('a"b'), 'a\\"b')
+        self.assertEqual(repr(module), 'LazyModule(email)')
+        self.assertFalse(hasattr(module, 'no_such_module'))
+
+    @mock.patch('check_bareos.connectDB')
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_main(self, mock_out, mock_connect):
+        mock_connect.return_value.fetchone.return_value = [2]
+
+        with self.assertRaises(SystemExit) as sysexit:
+            main(['-U', 'bareos', '-p', 'secret', 'tape', '-ex', '-w', '3', '-c', '5'])
+        self.assertEqual(sysexit.exception.code, 0)
+        self.assertEqual(mock_out.getvalue(), '[OK] - 2.0 Tapes are expired|bareos.tape.expired=2.0;3;5;;\n')
+
+        mock_connect.return_value.fetchone.side_effect = RuntimeError("broken")
+        with self.assertRaises(SystemExit) as sysexit:
+            main(['-U', 'bareos', '-p', 'secret', 'tape', '-ex'])
+        self.assertEqual(sysexit.exception.code, 3)
+        self.assertTrue(mock_out.getvalue().endswith('[UNKNOWN] - Error: broken\n'))
+
 class ThresholdTesting(unittest.TestCase):
 
     def test_thresholds(self):
@@ -77,6 +193,108 @@ class ThresholdTesting(unittest.TestCase):
         with self.assertRaises(ValueError):
             Threshold("()*!#$209810")
 
+    def test_thresholds_range_syntax(self):
+        self.assertEqual(check_threshold(0.4, Threshold("0.5"), Threshold("1.5")), 0)
+        self.assertEqual(check_threshold(0.6, Threshold("0.5"), Threshold("1.5")), 1)
+        self.assertEqual(check_threshold(-3, Threshold("-5:-1"), Threshold("~:")), 0)
+        self.assertEqual(check_threshold(-6, Threshold("-5:-1"), Threshold("~:")), 1)
+        self.assertEqual(check_threshold(-60, Threshold("~:-1"), Threshold("@-100:-50.5")), 2)
+        self.assertEqual(check_threshold(5, Threshold(".5:"), Threshold("")), 0)
+
+        with self.assertRaises(ValueError):
+            Threshold("5:1")
+        with self.assertRaises(ValueError):
+            Threshold("1.2.3")
+        with self.assertRaises(ValueError):
+            Threshold("GB")
+
+    def test_thresholds_units(self):
+        self.assertEqual(Threshold("500GB", "TB").check(0.48), True)
+        self.assertEqual(Threshold("500GB", "TB").check(0.5), False)
+        self.assertEqual(str(Threshold("500GB", "TB")), "0.48828125")
+        self.assertEqual(str(Threshold("@10GB:20GB", "TB")), "@0.009765625:0.01953125")
+        self.assertEqual(str(Threshold("@1TB:2TB", "GB")), "@1024:2048")
+        self.assertEqual(str(Threshold("1GB:", "MB")), "1024:")
+        self.assertEqual(str(Threshold("~:1PB", "TB")), "~:1024")
+
+        # The converted range reads back as the same range
+        for threshold, unit in [("500GB", "TB"), ("@10GB:20GB", "TB"), ("1MB:", "PB"), ("1PB", "MB")]:
+            self.assertEqual(compileRange(str(Threshold(threshold, unit)))[:3], compileRange(threshold, unit)[:3])
+        self.assertEqual(str(Threshold("0.5")), "0.5")
+
+        # In bytes without a unit
+        self.assertEqual(str(Threshold("2KB")), "2048")
+
+        args = commandline(['-U', 'bareos', 'status', '-b', '-u', 'GB', '-w', '1TB', '-c', '2TB'])
+        c = mock.MagicMock()
+        c.fetchone.return_value = [1500]
+        actual = args.evaluate(c, args)
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['performanceData'], 'bareos.backup.size=1500;1024;2048;;')
+
+    def test_compileRange_cached(self):
+        compileRange.cache_clear()
+        Threshold("10:20")
+        Threshold("10:20")
+        Threshold("10:20", "GB")
+        self.assertEqual(compileRange.cache_info().hits, 1)
+        self.assertEqual(compileRange("@~:3"), (float('-inf'), 3.0, True, False))
+
+    def test_thresholdState(self):
+        self.assertEqual(thresholdState(4, Threshold("20"), Threshold("25")), (0, "[OK]"))
+        self.assertEqual(thresholdState(21, Threshold("20"), Threshold("25")), (1, "[WARNING]"))
+        self.assertEqual(thresholdState(26, Threshold("20"), Threshold("25")), (2, "[CRITICAL]"))
+
+    def test_violated(self):
+        values = [0, 5, 10, 15, 20, 25]
+        self.assertEqual(list(Threshold("20").violated(values)), [False] * 5 + [True])
+        self.assertEqual(list(Threshold("10:").violated(values)), [True, True] + [False] * 4)
+        self.assertEqual(list(Threshold("@10:20").violated(values)), [False, False, True, True, True, False])
+
+        # Violated wherever check() fails
+        for threshold in [Threshold("20"), Threshold("10:"), Threshold("10:20"), Threshold("@10:20")]:
+            self.assertEqual([bool(v) for v in threshold.violated(values)], [not threshold.check(v) for v in values])
+
+    def test_evaluateThresholds(self):
+        states, worst, counts = evaluateThresholds([0, 21, 26, 3], Threshold("20"), Threshold("25"))
+        self.assertEqual(list(states), [0, 1, 2, 0])
+        self.assertEqual(worst, 2)
+        self.assertEqual(counts, {0: 2, 1: 1, 2: 1})
+
+        states, worst, counts = evaluateThresholds([], Threshold("20"), Threshold("25"))
+        self.assertEqual(list(states), [])
+        self.assertEqual(worst, 0)
+
+        _, worst, counts = evaluateThresholds([0, 21], Threshold("20"), None)
+        self.assertEqual((worst, counts), (1, {0: 1, 1: 1, 2: 0}))
+
+    def test_evaluateThresholds_without_numpy(self):
+        with mock.patch('check_bareos.loadNumpy', return_value=None):
+            self.assertEqual(list(Threshold("@10:20").violated([5, 15])), [0, 1])
+
+            states, worst, counts = evaluateThresholds([0, 21, 26, 3], Threshold("20"), Threshold("25"))
+            self.assertEqual(list(states), [0, 1, 2, 0])
+            self.assertEqual(worst, 2)
+            self.assertEqual(counts, {0: 2, 1: 1, 2: 1})
+
+            _, worst, _ = evaluateThresholds([21], None, Threshold("25"))
+            self.assertEqual(worst, 0)
+
+    def test_evaluateThresholds_bulk(self):
+        # NumPy is only loaded for many values
+        with mock.patch('check_bareos.loadNumpy', return_value=None) as mock_numpy:
+            evaluateThresholds(list(range(10)), Threshold("5"), Threshold("8"))
+            mock_numpy.assert_not_called()
+
+            states, worst, counts = evaluateThresholds(list(range(NUMPY_MIN_VALUES)), Threshold("5"), Threshold("8"))
+            mock_numpy.assert_called()
+        self.assertEqual(list(states[:10]), [0] * 6 + [1] * 3 + [2])
+        self.assertEqual((worst, counts[1]), (2, 3))
+
+        states, _, counts = evaluateThresholds(list(range(NUMPY_MIN_VALUES)), Threshold("5"), Threshold("8"))
+        self.assertEqual(list(states[:10]), [0] * 6 + [1] * 3 + [2])
+        self.assertEqual(counts, {0: 6, 1: 3, 2: NUMPY_MIN_VALUES - 9})
+
 class UtilTesting(unittest.TestCase):
 
     # TODO checkConnection(cursor)
@@ -106,6 +324,7 @@ class UtilTesting(unittest.TestCase):
         actual = createFactor('PB')
         expected = 1125899906842624
         self.assertEqual(actual, expected)
+        self.assertEqual(createFactor('MB'), 1048576)
 
     @mock.patch('builtins.print')
     def test_printNagiosOutput(self, mock_print):
@@ -117,6 +336,13 @@ class UtilTesting(unittest.TestCase):
             actual = printNagiosOutput({'returnCode': 1, 'returnMessage': "bar", 'performanceData': 'foo'})
         self.assertEqual(sysexit.exception.code, 1)
 
+    def test_formatNagiosOutput(self):
+        actual = formatNagiosOutput({'returnCode': 1, 'returnMessage': "bar", 'performanceData': 'foo'})
+        self.assertEqual(actual, "bar|foo")
+
+        actual = formatNagiosOutput({'returnCode': 1, 'returnMessage': "bar", 'performanceData': 'foo', 'longOutput': 'job1\njob2'})
+        self.assertEqual(actual, "bar|foo\njob1\njob2")
+
     def test_read_password_from_file(self):
         actual = read_password_from_file('contrib/bareos-dir.conf')
         expected = 'secretpassword'
@@ -187,6 +413,54 @@ class SQLTesting(unittest.TestCase):
         expected = {'returnCode': 2, 'returnMessage': '[CRITICAL] - 10.0 Tapes are expired', 'performanceData': 'bareos.tape.expired=10.0;3;5;;'}
         self.assertEqual(actual, expected)
 
+    def test_checkExpiredTapes_view(self):
+
+        c = mock.MagicMock()
+
+        c.fetchone.return_value = [4]
+        actual = checkExpiredTapes(c, Threshold(3), Threshold(5), view=True)
+        expected = {'returnCode': 1, 'returnMessage': '[WARNING] - 4.0 Tapes are expired', 'performanceData': 'bareos.tape.expired=4.0;3;5;;'}
+        self.assertEqual(actual, expected)
+        c.execute.assert_called_with(QUERIES['expiredTapesView'])
+
+        checkWillExpiredTapes(c, 7, Threshold(3), Threshold(5), view=True)
+        c.execute.assert_called_with(QUERIES['willExpireTapesView'], (7,))
+
+        checkEmptyTapes(c, Threshold(3), Threshold(5), view=True)
+        c.execute.assert_called_with(QUERIES['emptyTapesView'])
+
+    def test_checkExpiryHistogram(self):
+
+        c = mock.MagicMock()
+
+        c.fetchone.return_value = [2, 1, 0, 3, 4, 5, 6]
+        actual = checkExpiryHistogram(c, Threshold(3), Threshold(5))
+        expected = {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are expired, 13 will expire in 365 days',
+                    'performanceData': 'bareos.tape.expired=2.0;3;5;; bareos.tape.expiry.1d=1 bareos.tape.expiry.7d=0 bareos.tape.expiry.30d=3 '
+                                       'bareos.tape.expiry.90d=4 bareos.tape.expiry.365d=5 bareos.tape.expiry.later=6'}
+        self.assertEqual(actual, expected)
+        self.assertIn("FROM (SELECT lastwritten+(media.volretention * '1 second'::INTERVAL) AS Expiry FROM Media", c.execute.call_args[0][0])
+        self.assertIn("Count(*) FILTER (WHERE Expiry>=now()+'1 days'::INTERVAL AND Expiry<now()+'7 days'::INTERVAL)", c.execute.call_args[0][0])
+
+        checkExpiryHistogram(c, Threshold(3), Threshold(5), view=True)
+        self.assertTrue(c.execute.call_args[0][0].endswith("FROM check_bareos_media_expiry;"))
+
+    def test_evaluateTape_expiryView(self):
+
+        c = mock.MagicMock()
+        c.fetchone.side_effect = [[3600.0], [1]]
+
+        args = commandline(['-U', 'bareos', 'tape', '-ex', '--expiry-view', '--expiry-max-age', '600'])
+        args.evaluate(c, args)
+
+        c.execute.assert_has_calls([mock.call(QUERIES['expiryViewAge']), mock.call(QUERIES['refreshExpiryView']), mock.call(QUERIES['expiredTapesView'])])
+        c.connection.commit.assert_called_once()
+
+        args = commandline(['-U', 'bareos', 'expiry-view', '--create'])
+        actual = args.evaluate(c, args)
+        c.execute.assert_called_with(QUERIES['createExpiryView'])
+        self.assertEqual(actual['returnCode'], 0)
+
     def test_checkTapesInStorage(self):
 
         c = mock.MagicMock()
@@ -220,14 +494,14 @@ class SQLTesting(unittest.TestCase):
     def test_checkEmptyBackups(self):
 
         c = mock.MagicMock()
-        c.fetchall.return_value = []
+        c.fetchone.return_value = [0]
 
         actual = checkEmptyBackups(c, 1, "'F','I','D'", Threshold(1), Threshold(2))
         expected = {'returnCode': 0, 'returnMessage': "[OK] - All 'F','I','D' Backups are fine", 'performanceData': 'bareos.backup.empty=0;1;2;;'}
 
         self.assertEqual(actual, expected)
 
-        c.execute.assert_called_with("\n    SELECT Job.Name,Level,starttime\n    FROM Job\n    WHERE Level in ('F','I','D') AND JobBytes=0 AND starttime > (now()::date-1 * '1 day'::INTERVAL) AND JobStatus in ('T');\n    ")
+        c.execute.assert_called_with("SELECT COUNT(*) FROM Job WHERE JobStatus = ANY(%s::bpchar[]) AND starttime > (now()::date-%s * '1 day'::INTERVAL) AND Level = ANY(%s::bpchar[]) AND JobBytes=0;", [['T'], 1.0, ['F', 'I', 'D']])
 
     def test_checkJobs(self):
 
@@ -240,7 +514,7 @@ class SQLTesting(unittest.TestCase):
 
         self.assertEqual(actual, expected)
 
-        c.execute.assert_called_with("\n    SELECT count(Job.Name)\n    FROM Job\n    WHERE Job.JobStatus like 'E' AND (starttime > (now()::date-1 * '1 day'::INTERVAL) OR starttime IS NULL) AND Job.Level in ('F','I','D');\n    ")
+        c.execute.assert_called_with("SELECT COUNT(*) FROM Job WHERE JobStatus = ANY(%s::bpchar[]) AND (starttime > (now()::date-%s * '1 day'::INTERVAL) OR starttime IS NULL) AND Level = ANY(%s::bpchar[]);", [['E'], 1.0, ['F', 'I', 'D']])
 
         c.fetchone.return_value = [4]
 
@@ -259,15 +533,15 @@ class SQLTesting(unittest.TestCase):
     def test_checkFailedBackups(self):
 
         c = mock.MagicMock()
-        c.fetchall.return_value = []
+        c.fetchone.return_value = [0]
 
         actual = checkFailedBackups(c, 1, Threshold("1"), Threshold("2"))
         expected = {'returnCode': 0, 'returnMessage': '[OK] - 0 Backups failed/canceled in the last 1 days', 'performanceData': 'bareos.backup.failed=0;1;2;;'}
         self.assertEqual(actual, expected)
 
-        c.execute.assert_called_with("\n    SELECT Job.Name,Level,starttime, JobStatus\n    FROM Job\n    WHERE JobStatus in ('E','f') AND starttime > (now()::date-1 * '1 day'::INTERVAL);\n    ")
+        c.execute.assert_called_with("SELECT COUNT(*) FROM Job WHERE JobStatus = ANY(%s::bpchar[]) AND starttime > (now()::date-%s * '1 day'::INTERVAL);", [['E', 'f'], 1.0])
 
-        c.fetchall.return_value = [1,2,3]
+        c.fetchone.return_value = [3]
 
         actual = checkFailedBackups(c, 1, Threshold("1"), Threshold("2"))
         expected = {'performanceData': 'bareos.backup.failed=3;1;2;;', 'returnCode': 2, 'returnMessage': '[CRITICAL] - 3 Backups failed/canceled in the last 1 days'}
@@ -309,20 +583,28 @@ class SQLTesting(unittest.TestCase):
 
         self.assertEqual(actual, expected)
 
+        # No jobs in the window
+        mock_size.return_value = None
+
+        actual = checkTotalBackupSize(c, 1, "'F','I','D'", "PB", Threshold(100), Threshold(200))
+        expected = {'performanceData': 'bareos.backup.size=0;100;200;;', 'returnCode': 0, 'returnMessage': "[OK] - 0 PB Kind:'F','I','D' Days: 1"}
+
+        self.assertEqual(actual, expected)
+
 
     def test_checkOversizedBackups(self):
 
         c = mock.MagicMock()
-        c.fetchall.return_value = []
+        c.fetchone.return_value = [0]
 
         actual = checkOversizedBackups(c, 1, 100, "'F','I','D'", "PB", Threshold(1), Threshold(2))
         expected = {'returnCode': 0, 'returnMessage': "[OK] - 0 'F','I','D' Backups larger than 100 PB in the last 1 days", 'performanceData': 'bareos.backup.oversized=0;1;2;;'}
 
         self.assertEqual(actual, expected)
 
-        c.execute.assert_called_with("\n    SELECT Job.Name,Level,starttime, JobBytes/1125899906842624.0\n    FROM Job\n    WHERE Level in ('F','I','D') AND starttime > (now()::date-1 * '1 day'::INTERVAL) AND JobBytes/1125899906842624.0>100;\n    ")
+        c.execute.assert_called_with("SELECT COUNT(*) FROM Job WHERE starttime > (now()::date-%s * '1 day'::INTERVAL) AND Level = ANY(%s::bpchar[]) AND JobBytes>%s;", [1.0, ['F', 'I', 'D'], 1.125899906842624e+17])
 
-        c.fetchall.return_value = [1,2,3]
+        c.fetchone.return_value = [3]
         actual = checkOversizedBackups(c, 1, 100, "'F','I','D'", "PB", Threshold(1), Threshold(2))
         expected = {'performanceData': 'bareos.backup.oversized=3;1;2;;', 'returnCode': 2, 'returnMessage': "[CRITICAL] - 3 'F','I','D' Backups larger than 100 PB in the last 1 days"}
         self.assertEqual(actual, expected)
@@ -333,12 +615,12 @@ class SQLTesting(unittest.TestCase):
         c = mock.MagicMock()
 
         # Nothing returned from DB
-        c.fetchall.return_value = []
+        c.fetchone.return_value = [0]
         actual = checkSingleJob(c, "Jobby", "E", "'F','I','D'", 1, Threshold(1), Threshold(2))
         expected = {'performanceData': "'bareos.Job terminated in error'=0;1;2;;", 'returnCode': 0, 'returnMessage': '[OK] - 0 Jobs are in the state: Job terminated in error'}
         self.assertEqual(actual, expected)
 
-        c.execute.assert_called_with("\n    SELECT Job.Name,Job.JobStatus, Job.Starttime\n    FROM Job\n    WHERE Job.Name like '%Jobby%' AND Job.JobStatus like 'E' AND (starttime > (now()::date-1 * '1 day'::INTERVAL) OR starttime IS NULL) AND Job.Level in ('F','I','D');\n    ")
+        c.execute.assert_called_with("SELECT COUNT(*) FROM Job WHERE Job.Name like %s AND JobStatus = ANY(%s::bpchar[]) AND (starttime > (now()::date-%s * '1 day'::INTERVAL) OR starttime IS NULL) AND Level = ANY(%s::bpchar[]);", ['%Jobby%', ['E'], 1.0, ['F', 'I', 'D']])
 
         # Missing Name
         actual = checkSingleJob(c, None, "T", "'F','I','D'", 1, Threshold(1), Threshold(2))
@@ -346,35 +628,1741 @@ class SQLTesting(unittest.TestCase):
         self.assertEqual(actual, expected)
 
         # Returns Warning
-        c.fetchall.return_value = [1,2,3,4]
+        c.fetchone.return_value = [4]
         actual = checkSingleJob(c, "Jobby", "E", "'F','I','D'", 1, Threshold(3), Threshold(5))
         expected = {'performanceData': "'bareos.Job terminated in error'=4;3;5;;", 'returnCode': 1, 'returnMessage': '[WARNING] - 4 Jobs are in the state: Job terminated in error'}
         self.assertEqual(actual, expected)
 
         # Returns Critical
-        c.fetchall.return_value = [1,2,3,4,5,6]
+        c.fetchone.return_value = [6]
         actual = checkSingleJob(c, "Jobby", "E", "'F','I','D'", 1, Threshold(3), Threshold(5))
         expected = {'performanceData': "'bareos.Job terminated in error'=6;3;5;;", 'returnCode': 2, 'returnMessage': '[CRITICAL] - 6 Jobs are in the state: Job terminated in error'}
         self.assertEqual(actual, expected)
 
+    def test_checkFailedBackups_with_details(self):
+
+        c = mock.MagicMock()
+        c.fetchone.return_value = [2]
+        details = c.connection.cursor.return_value
+        details.__iter__.return_value = iter([('backup-fs1', 'F', 'E', '2023-11-02 22:00:00', 0),
+                                              ('backup-fs2', 'I', 'f', '2023-11-01 22:00:00', 1024)])
+
+        actual = checkFailedBackups(c, 1, Threshold("1"), Threshold("2"), details=5)
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['longOutput'], "backup-fs1 Level: F State: Job terminated in error Start: 2023-11-02 22:00:00 Bytes: 0\n"
+                                               "backup-fs2 Level: I State: Fatal error Start: 2023-11-01 22:00:00 Bytes: 1024")
+
+        c.connection.cursor.assert_called_with(name='check_bareos_details')
+        details.execute.assert_called_with("SELECT Job.Name, Level, JobStatus, starttime, JobBytes FROM Job WHERE JobStatus = ANY(%s::bpchar[]) AND starttime > (now()::date-%s * '1 day'::INTERVAL) ORDER BY starttime DESC LIMIT %s;", [['E', 'f'], 1.0, 5])
+        details.close.assert_called_once()
+
+        # No rows are fetched if nothing matched
+        c.reset_mock()
+        c.fetchone.return_value = [0]
+        actual = checkFailedBackups(c, 1, Threshold("1"), Threshold("2"), details=5)
+        self.assertNotIn('longOutput', actual)
+        c.connection.cursor.assert_not_called()
+
     def test_checkSingleJob_WithThreshold(self):
 
         c = mock.MagicMock()
 
         # With Threshold, more than 5 T jobs are OK
-        c.fetchall.return_value = [1,2,3,4,5,6]
+        c.fetchone.return_value = [6]
         actual = checkSingleJob(c, "Jobby", "T", "'F','I','D'", 1, Threshold("5:"), Threshold("3:"))
         expected = {'returnCode': 0, 'returnMessage': '[OK] - 6 Jobs are in the state: Job terminated normally', 'performanceData': "'bareos.Job terminated normally'=6;5:;3:;;"}
         self.assertEqual(actual, expected)
 
         # With Threshold, less than 5 T jobs are warning
-        c.fetchall.return_value = [1,2,3]
+        c.fetchone.return_value = [3]
         actual = checkSingleJob(c, "Jobby", "T", "'F','I','D'", 1, Threshold("5:"), Threshold("3:"))
         expected = {'returnCode': 1, 'returnMessage': '[WARNING] - 3 Jobs are in the state: Job terminated normally', 'performanceData': "'bareos.Job terminated normally'=3;5:;3:;;"}
         self.assertEqual(actual, expected)
 
         # With Threshold, less than 3 T jobs are critical
-        c.fetchall.return_value = [1,2]
+        c.fetchone.return_value = [2]
         actual = checkSingleJob(c, "Jobby", "T", "'F','I','D'", 1, Threshold("5:"), Threshold("3:"))
         expected = {'returnCode': 2, 'returnMessage': '[CRITICAL] - 2 Jobs are in the state: Job terminated normally', 'performanceData': "'bareos.Job terminated normally'=2;5:;3:;;"}
         self.assertEqual(actual, expected)
+
+class BatchTesting(unittest.TestCase):
+
+    def test_worstState(self):
+        self.assertEqual(worstState([0, 1, 0]), 1)
+        self.assertEqual(worstState([3, 1, 0]), 3)
+        self.assertEqual(worstState([3, 2, 1]), 2)
+        self.assertEqual(worstState([]), 0)
+
+    def test_readBatchFile(self):
+        actual = readBatchFile('contrib/batch-example.json')
+        self.assertEqual(actual[0], ('bareos-failed-backups', ['status', '-fb', '-w', '1', '-c', '5']))
+        self.assertEqual(actual[1], ('bareos-empty-backups', ['status', '-e', '-f', '-w', '~:0', '-c', '10']))
+        self.assertEqual(actual[2], ('bareos-empty-tapes', ['tape', '-e', '-w', '15:', '-c', '10:']))
+
+    def test_parseBatchCheck(self):
+        self.assertEqual(parseBatchCheck('failed=status -fb -w 1'), ('failed', ['status', '-fb', '-w', '1']))
+        self.assertEqual(parseBatchCheck('tape -e -w 10:'), ('tape_e_w_10:', ['tape', '-e', '-w', '10:']))
+        self.assertEqual(parseBatchCheck('status -fb -w ~:1'), ('status_fb_w_~:1', ['status', '-fb', '-w', '~:1']))
+
+    def test_parseBatchArguments(self):
+        _, subParser = createParser()
+
+        actual, error = parseBatchArguments(subParser, ['tape', '-ex', '-w', '3', '-c', '5'])
+        self.assertTrue(actual.expiredTapes)
+        self.assertIsNone(error)
+
+        actual, error = parseBatchArguments(subParser, ['batch', '-C', 'tape -e'])
+        self.assertIsNone(actual)
+        self.assertEqual(error['returnCode'], 3)
+
+        actual, error = parseBatchArguments(subParser, ['report', '-fb'])
+        self.assertIsNone(actual)
+        self.assertEqual(error['returnCode'], 3)
+
+        with mock.patch('sys.stderr'):
+            actual, error = parseBatchArguments(subParser, ['tape', '--nosuchoption'])
+        self.assertEqual(error['returnCode'], 3)
+
+    def test_evaluateBatchCheck(self):
+        _, subParser = createParser()
+        c = mock.MagicMock()
+
+        c.fetchone.return_value = [2]
+        checkArgs, _ = parseBatchArguments(subParser, ['tape', '-ex', '-w', '3', '-c', '5'])
+        actual = evaluateBatchCheck(c, checkArgs)
+        expected = {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are expired', 'performanceData': 'bareos.tape.expired=2.0;3;5;;'}
+        self.assertEqual(actual, expected)
+
+        checkArgs, _ = parseBatchArguments(subParser, ['tape', '-ex', '-w', 'foo'])
+        actual = evaluateBatchCheck(c, checkArgs)
+        self.assertEqual(actual, {'returnCode': 3, 'returnMessage': '[UNKNOWN] - Error parsing Threshold: foo'})
+
+        # Unexpected errors only fail their own check
+        with tempfile.TemporaryDirectory() as tmp:
+            checkArgs, _ = parseBatchArguments(subParser, ['freshness', '--rules', os.path.join(tmp, 'missing.json')])
+            actual = evaluateBatchCheck(c, checkArgs)
+        self.assertEqual(actual['returnCode'], 3)
+        self.assertTrue(actual['returnMessage'].startswith('[UNKNOWN] - Error: [Errno 2] No such file or directory'))
+
+    def test_evaluateBatch(self):
+        _, subParser = createParser()
+        c = mock.MagicMock()
+
+        # One query for both status checks, one for the tape check
+        c.fetchone.side_effect = [[3, 1], [2]]
+        checks = [('failed', ['status', '-fb', '-w', '1', '-c', '5']),
+                  ('empty', ['status', '-e', '-f', '-w', '2', '-c', '3']),
+                  ('expired', ['tape', '-ex', '-w', '3', '-c', '5'])]
+
+        actual = evaluateBatch(c, subParser, checks)
+
+        self.assertEqual(c.execute.call_count, 2)
+        self.assertEqual(actual[0], ('failed', {'returnCode': 1, 'returnMessage': '[WARNING] - 3 Backups failed/canceled in the last 7 days', 'performanceData': 'bareos.backup.failed=3;1;5;;'}))
+        self.assertEqual(actual[1], ('empty', {'returnCode': 0, 'returnMessage': "[OK] - All 'F' Backups are fine", 'performanceData': 'bareos.backup.empty=1;2;3;;'}))
+        self.assertEqual(actual[2], ('expired', {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are expired', 'performanceData': 'bareos.tape.expired=2.0;3;5;;'}))
+
+    def test_evaluateBatchConcurrently(self):
+        _, subParser = createParser()
+
+        class FakePool:
+            def __init__(self):
+                self.connections = []
+
+            @contextlib.contextmanager
+            def cursor(self):
+                c = mock.MagicMock()
+                self.connections.append(c.connection)
+
+                def execute(query, params=None):
+                    if 'VolMounts' in query:
+                        time.sleep(0.5)
+                    c.fetchone.return_value = [3, 1] if 'FILTER' in query else [2]
+                c.execute.side_effect = execute
+                yield c
+
+        pool = FakePool()
+        checks = [('failed', ['status', '-fb', '-w', '1', '-c', '5']),
+                  ('empty', ['status', '-e', '-f', '-w', '2', '-c', '3']),
+                  ('expired', ['tape', '-ex', '-w', '3', '-c', '5']),
+                  ('replace', ['tape', '-r', '-w', '3', '-c', '5']),
+                  ('invalid', ['nosuchcheck'])]
+
+        actual = asyncio.run(evaluateBatchConcurrently(pool, subParser, checks, 3, deadline=0.2))
+
+        self.assertEqual(actual[0], ('failed', {'returnCode': 1, 'returnMessage': '[WARNING] - 3 Backups failed/canceled in the last 7 days', 'performanceData': 'bareos.backup.failed=3;1;5;;'}))
+        self.assertEqual(actual[1], ('empty', {'returnCode': 0, 'returnMessage': "[OK] - All 'F' Backups are fine", 'performanceData': 'bareos.backup.empty=1;2;3;;'}))
+        self.assertEqual(actual[2], ('expired', {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are expired', 'performanceData': 'bareos.tape.expired=2.0;3;5;;'}))
+        self.assertEqual(actual[3], ('replace', {'returnCode': 3, 'returnMessage': '[UNKNOWN] - Deadline of 0.2s exceeded'}))
+        self.assertEqual(actual[4][1]['returnCode'], 3)
+
+        # The query of the slow check was canceled
+        self.assertEqual(sum(c.cancel.call_count for c in pool.connections), 1)
+
+    def test_evaluateBatchConcurrently_queued(self):
+        _, subParser = createParser()
+
+        @contextlib.contextmanager
+        def cursor():
+            c = mock.MagicMock()
+            c.execute.side_effect = lambda query, params=None: time.sleep(0.15)
+            c.fetchone.return_value = [2]
+            yield c
+        pool = mock.MagicMock()
+        pool.cursor.side_effect = cursor
+
+        # The time waiting for a worker does not count against the deadline
+        checks = [('expired' + str(i), ['tape', '-ex', '-w', '3', '-c', '5']) for i in range(4)]
+        actual = asyncio.run(evaluateBatchConcurrently(pool, subParser, checks, 1, deadline=0.5))
+        self.assertEqual([checkResult['returnCode'] for _, checkResult in actual], [0] * 4)
+
+    def test_evaluateBatchConcurrently_reconnect_failed(self):
+        _, subParser = createParser()
+        failures = [psycopg2.OperationalError("could not connect to server\n")]
+
+        @contextlib.contextmanager
+        def cursor():
+            # The first checkout for the query of the job statistics fails
+            if failures:
+                raise failures.pop()
+            c = mock.MagicMock()
+            c.fetchone.return_value = [2]
+            yield c
+        pool = mock.MagicMock()
+        pool.cursor.side_effect = cursor
+
+        # Only the checks without a connection fail
+        checks = [('failed', ['status', '-fb', '-w', '1', '-c', '5']), ('expired', ['tape', '-ex', '-w', '3', '-c', '5'])]
+        actual = asyncio.run(evaluateBatchConcurrently(pool, subParser, checks, 1))
+        self.assertEqual(actual[0], ('failed', {'returnCode': 3, 'returnMessage': '[UNKNOWN] - could not connect to server'}))
+        self.assertEqual(actual[1][1]['returnCode'], 0)
+
+    def test_formatBatchOutput(self):
+        results = [
+            ('expired', {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are expired', 'performanceData': 'bareos.tape.expired=2.0;3;5;;'}),
+            ('errors', {'returnCode': 2, 'returnMessage': '[CRITICAL] - 9.0 Jobs are in the state: Job terminated in error', 'performanceData': "'bareos.Job terminated in error'=9.0;3;5;;"}),
+        ]
+
+        actual = formatBatchOutput(results, 'nagios', 'director')
+        expected = ("[CRITICAL] - 2 checks: 1 CRITICAL, 0 WARNING, 0 UNKNOWN, 1 OK|expired::bareos.tape.expired=2.0;3;5;; 'errors::bareos.Job terminated in error'=9.0;3;5;;\n"
+                    "expired: [OK] - 2.0 Tapes are expired\n"
+                    "errors: [CRITICAL] - 9.0 Jobs are in the state: Job terminated in error")
+        self.assertEqual(actual, expected)
+
+        with mock.patch('check_bareos.time.time', return_value=1700000000):
+            actual = formatBatchOutput(results[:1], 'passive', 'director')
+        expected = "[1700000000] PROCESS_SERVICE_CHECK_RESULT;director;expired;0;[OK] - 2.0 Tapes are expired|bareos.tape.expired=2.0;3;5;;"
+        self.assertEqual(actual, expected)
+
+        # Every label is prefixed and stays parseable
+        name, _ = parseBatchCheck('status -fb -w 1')
+        results = [(name, {'returnCode': 0, 'returnMessage': '[OK]', 'performanceData': "bareos.backup.failed=0;1;;; 'bareos.a b'=1"})]
+        actual = formatBatchOutput(results, 'nagios', 'director')
+        self.assertIn("|status_fb_w_1::bareos.backup.failed=0;1;;; 'status_fb_w_1::bareos.a b'=1\n", actual)
+        self.assertEqual(parsePerformanceData(actual.split('|')[1].split('\n')[0]), [('status_fb_w_1::bareos.backup.failed', 0.0), ('status_fb_w_1::bareos.a b', 1.0)])
+
+class JobStatisticsTesting(unittest.TestCase):
+
+    def test_JobFilter(self):
+        actual = JobFilter().condition()
+        self.assertEqual(actual, ("TRUE", []))
+
+        actual = JobFilter(states=['R'], time=3, before=True).condition()
+        self.assertEqual(actual, ("JobStatus = ANY(%s::bpchar[]) AND starttime < (now()::date-%s * '1 day'::INTERVAL)", [['R'], 3.0]))
+
+        actual = JobFilter(kind="'F'", time="3", midnight=False).condition()
+        self.assertEqual(actual, ("starttime > (now()-%s * '1 day'::INTERVAL) AND Level = ANY(%s::bpchar[])", [3.0, ['F']]))
+
+    def test_JobStatistics(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [3, 2]
+        stats = JobStatistics()
+
+        # Planning, every aggregate is only fetched once
+        failed = JobFilter(states=['E', 'f'], time=7)
+        self.assertEqual(stats.value("COUNT(*)", failed), 0)
+        self.assertEqual(stats.value("COUNT(*)", failed), 0)
+        self.assertEqual(stats.value("COUNT(*)", JobFilter(states=['R'])), 0)
+
+        stats.collect(c)
+        c.execute.assert_called_once_with("SELECT COUNT(*) FILTER (WHERE JobStatus = ANY(%s::bpchar[]) AND starttime > (now()::date-%s * '1 day'::INTERVAL)), "
+                                          "COUNT(*) FILTER (WHERE JobStatus = ANY(%s::bpchar[])) FROM Job "
+                                          "WHERE (JobStatus = ANY(%s::bpchar[]) AND starttime > (now()::date-%s * '1 day'::INTERVAL)) OR (JobStatus = ANY(%s::bpchar[]));",
+                                          [['E', 'f'], 7.0, ['R'], ['E', 'f'], 7.0, ['R']])
+
+        self.assertEqual(stats.value("COUNT(*)", failed), 3)
+        self.assertEqual(stats.value("COUNT(*)", JobFilter(states=['R'])), 2)
+
+    def test_JobStatistics_with_checks(self):
+        c = mock.MagicMock()
+        stats = JobStatistics()
+
+        checkFailedBackups(c, 1, Threshold(1), Threshold(2), stats)
+        checkJobs(c, 'R', "'F','I','D'", 1, Threshold(3), Threshold(5), stats)
+        c.fetchone.return_value = [2, 4]
+        stats.collect(c)
+
+        actual = checkFailedBackups(c, 1, Threshold(1), Threshold(2), stats)
+        self.assertEqual(actual['performanceData'], 'bareos.backup.failed=2;1;2;;')
+
+        actual = checkJobs(c, 'R', "'F','I','D'", 1, Threshold(3), Threshold(5), stats)
+        self.assertEqual(actual['performanceData'], "'bareos.Job running'=4.0;3;5;;")
+        self.assertEqual(c.execute.call_count, 1)
+
+    def test_planJobStatistics_size(self):
+        _, subParser = createParser()
+        parsed = [(name,) + parseBatchArguments(subParser, check) for name, check in [('size', ['status', '-b']), ('failed', ['status', '-fb'])]]
+        query, params = planJobStatistics(parsed).query()
+
+        # The filter belongs to the aggregate function, not to the ROUND() around it
+        self.assertTrue(query.startswith("SELECT ROUND(SUM(JobBytes/1099511627776.0) FILTER (WHERE Level = ANY(%s::bpchar[])),3), "
+                                         "COUNT(*) FILTER (WHERE "), query)
+
+        self.assertEqual(filterAggregate("COUNT(*)", "TRUE"), "COUNT(*) FILTER (WHERE TRUE)")
+        with self.assertRaises(ValueError):
+            filterAggregate("JobBytes", "TRUE")
+
+class PreparedCursorTesting(unittest.TestCase):
+
+    def test_positionalParameters(self):
+        actual = positionalParameters("SELECT 1 FROM Job WHERE Name like %s AND JobBytes>%s AND Name like 'a%%';")
+        self.assertEqual(actual, "SELECT 1 FROM Job WHERE Name like $1 AND JobBytes>$2 AND Name like 'a%';")
+
+    def test_statementName(self):
+        self.assertEqual(statementName(QUERIES['expiredTapes']), 'check_bareos_expiredtapes')
+        self.assertRegex(statementName("SELECT 1;"), '^check_bareos_[0-9a-f]{16}$')
+        self.assertNotEqual(statementName("SELECT 1;"), statementName("SELECT 2;"))
+
+    def test_PreparedCursor(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [2]
+        prepared = PreparedCursor(c)
+
+        checkWillExpiredTapes(prepared, 7, Threshold(3), Threshold(5))
+        checkWillExpiredTapes(prepared, 14, Threshold(3), Threshold(5))
+
+        self.assertEqual(c.execute.call_count, 3)
+        self.assertTrue(c.execute.call_args_list[0][0][0].startswith("PREPARE check_bareos_willexpiretapes AS \n    SELECT Count(MediaId)"))
+        self.assertIn("<now()+($1 * '1 day'::INTERVAL)", c.execute.call_args_list[0][0][0])
+        c.execute.assert_called_with("EXECUTE check_bareos_willexpiretapes(%s);", [14])
+
+        self.assertEqual(prepared.executions, 2)
+        self.assertEqual(prepared.reused, 1)
+        self.assertTrue(prepared.performanceData().startswith("bareos.plugin.prepared=1 bareos.plugin.executions=2 bareos.plugin.prepare_ms="))
+
+        prepared.execute("SELECT 1;")
+        c.execute.assert_called_with("EXECUTE " + statementName("SELECT 1;") + ";")
+
+    def test_PreparedCursor_statements(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [7200]
+        prepared = PreparedCursor(c)
+
+        # REFRESH, CREATE and DROP cannot be prepared
+        refreshExpiryView(prepared, 3600)
+        c.execute.assert_called_with(QUERIES['refreshExpiryView'], None)
+        self.assertEqual(prepared.executions, 1)
+
+        for option in ['--create', '--refresh', '--drop']:
+            args = commandline(['-U', 'bareos', 'expiry-view', option])
+            self.assertEqual(args.evaluate(prepared, args)['returnCode'], 0)
+            self.assertFalse(c.execute.call_args[0][0].startswith("PREPARE"))
+        self.assertEqual(prepared.executions, 1)
+
+class DaemonTesting(unittest.TestCase):
+
+    def test_CursorPool(self):
+        connect = mock.MagicMock()
+        connect.return_value.closed = 0
+        connect.return_value.cursor.return_value.connection = connect.return_value
+        pool = CursorPool(connect, 2)
+        self.assertEqual(connect.call_count, 2)
+
+        with pool.cursor() as cursor:
+            self.assertIsInstance(cursor, PreparedCursor)
+        connect.return_value.rollback.assert_called_once()
+
+        # Closed connections are replaced
+        connect.return_value.closed = 1
+        with pool.cursor() as cursor:
+            pass
+        self.assertEqual(connect.call_count, 3)
+
+    @mock.patch('check_bareos.time.sleep')
+    def test_CursorPool_reconnect(self, mock_sleep):
+        connection = mock.MagicMock()
+        connection.closed = 0
+        connection.cursor.return_value.connection = connection
+        connect = mock.MagicMock(side_effect=[connection, psycopg2.OperationalError("down"), psycopg2.OperationalError("down"), connection])
+        pool = CursorPool(connect, 1, prepare=False, healthInterval=0)
+
+        # The idle connection fails its health check and is replaced with backoff
+        connection.cursor.return_value.__enter__.return_value.execute.side_effect = [psycopg2.OperationalError("gone"), None]
+        with pool.cursor() as cursor:
+            self.assertIs(cursor, connection.cursor.return_value)
+        self.assertEqual(connect.call_count, 4)
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [0.5, 1.0])
+
+        # Healthy connections are kept
+        with pool.cursor() as cursor:
+            pass
+        self.assertEqual(connect.call_count, 4)
+
+    @mock.patch('check_bareos.time.sleep')
+    def test_CursorPool_unavailable(self, mock_sleep):
+        connection = mock.MagicMock()
+        connection.cursor.return_value.connection = connection
+        connect = mock.MagicMock(side_effect=[connection] + [psycopg2.OperationalError("down")] * 4)
+        pool = CursorPool(connect, 1, prepare=False, retries=3)
+
+        connection.closed = 1
+        parser, _ = createParser()
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', 'tape', '-ex'])
+        self.assertEqual(actual, {'output': '[UNKNOWN] - down|;;;;', 'returnCode': 3})
+        self.assertEqual(mock_sleep.call_count, 3)
+
+        # The pool keeps its size
+        self.assertEqual(pool._idle.qsize(), 1)
+
+    @mock.patch('check_bareos.psycopg2.connect')
+    def test_createConnection(self, mock_connect):
+        createConnection("bareos", "pass'word", "db.example.com", "bareos", 5432)
+        mock_connect.assert_called_once_with(host="db.example.com", port=5432, dbname="bareos", user="bareos", password="pass'word",
+                                             application_name='check_bareos', keepalives=1, keepalives_idle=30,
+                                             keepalives_interval=10, keepalives_count=3)
+
+    @mock.patch('check_bareos.CursorPool')
+    def test_createPool(self, mock_pool):
+        args = commandline(['-U', 'bareos', '--pgbouncer', 'serve'])
+        createPool(args, 4)
+        self.assertEqual(mock_pool.call_args[0][1:], (4, False))
+
+        args = commandline(['-U', 'bareos', 'serve'])
+        createPool(args, 2)
+        self.assertEqual(mock_pool.call_args[0][1:], (2, True))
+
+    def test_handleCheckRequest(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [2]
+        pool = mock.MagicMock()
+        pool.cursor.return_value.__enter__.return_value = c
+        parser, _ = createParser()
+
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', 'tape', '-ex', '-w', '3', '-c', '5'])
+        self.assertEqual(actual, {'output': '[OK] - 2.0 Tapes are expired|bareos.tape.expired=2.0;3;5;;', 'returnCode': 0})
+
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', 'serve'])
+        self.assertEqual(actual, {'output': '[UNKNOWN] - Check not supported by the daemon', 'returnCode': 3})
+
+        with mock.patch('sys.stderr'):
+            actual = handleCheckRequest(pool, parser, ['-U', 'bareos', 'tape'])
+        self.assertEqual(actual['returnCode'], 3)
+
+        # Checks for another catalog are rejected
+        catalog = ('bareos', '127.0.0.1', 5432, 'bareos')
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', 'tape', '-ex'], catalog)
+        self.assertEqual(actual['returnCode'], 0)
+
+        c.reset_mock()
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', '-H', 'db2', '-d', 'bareos2', 'tape', '-ex'], catalog)
+        self.assertEqual(actual, {'output': '[UNKNOWN] - The daemon serves the catalog 127.0.0.1:5432/bareos as bareos, not db2:5432/bareos2 as bareos',
+                                  'returnCode': 3})
+        c.execute.assert_not_called()
+
+        # Options the daemon cannot honour are not silently dropped
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', '--cache-ttl', '60', '--explain', 'tape', '-ex'])
+        self.assertEqual(actual, {'output': '[UNKNOWN] - Not supported by the daemon: --cache-ttl, --explain', 'returnCode': 3})
+        c.execute.assert_not_called()
+
+        # Files and the catalog schema are not changed with the rights of the daemon
+        for argv in (['status', '-fb', '--incremental', '/tmp/state.json'], ['trend', '--state-file', '/tmp/state.json'],
+                     ['freshness', '--rules', '/etc/shadow'], ['expiry-view', '--drop']):
+            actual = handleCheckRequest(pool, parser, ['-U', 'bareos'] + argv)
+            self.assertEqual(actual['returnCode'], 3)
+            self.assertTrue(actual['output'].startswith('[UNKNOWN] - Not supported by the daemon: --'))
+        c.execute.assert_not_called()
+
+        # Unexpected errors are answered as well
+        c.execute.side_effect = OSError("No space left on device")
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', 'tape', '-ex'])
+        self.assertEqual(actual, {'output': '[UNKNOWN] - Error: No space left on device|;;;;', 'returnCode': 3})
+
+    @mock.patch('check_bareos.queryDeadline')
+    def test_handleCheckRequest_timeout(self, mock_deadline):
+        c = mock.MagicMock()
+        c.execute.side_effect = psycopg2.extensions.QueryCanceledError("canceling statement due to user request")
+        pool = mock.MagicMock()
+        pool.cursor.return_value.__enter__.return_value = c
+        parser, _ = createParser()
+
+        actual = handleCheckRequest(pool, parser, ['-U', 'bareos', '--timeout', '0.5', 'tape', '-ex'])
+        mock_deadline.assert_called_once_with(c.connection, 0.5)
+        self.assertEqual(actual['returnCode'], 3)
+        self.assertTrue(actual['output'].startswith('[UNKNOWN] - Deadline of 0.5s exceeded, query canceled after '))
+
+    def test_client_stripPassword(self):
+        actual = check_bareos_client.stripPassword(['-U', 'bareos', '-p', 'secret', '--password=secret', '-psecret',
+                                                    '--password', 'secret', 'tape', '-ex'])
+        self.assertEqual(actual, ['-U', 'bareos', 'tape', '-ex'])
+
+    @mock.patch('check_bareos_client.requestCheck')
+    def test_client_invalid_response(self, mock_request):
+        for response in [{'output': '[OK] - truncated'}, {'returnCode': 0}, [], {'output': None, 'returnCode': 0}, {'output': 'x', 'returnCode': '0'}]:
+            mock_request.return_value = response
+            with mock.patch('builtins.print') as mock_print:
+                self.assertEqual(check_bareos_client.main(['-U', 'bareos', 'tape', '-ex']), 3)
+            self.assertTrue(mock_print.call_args[0][0].startswith('[UNKNOWN] - Error: invalid response'))
+
+    def test_client_and_server(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [10]
+        pool = mock.MagicMock()
+        pool.cursor.return_value.__enter__.return_value = c
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'check_bareos.sock')
+            server = socketserver.ThreadingUnixStreamServer(path, CheckRequestHandler)
+            server.pool = pool
+            server.parser, _ = createParser()
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            try:
+                actual = check_bareos_client.requestCheck(path, ['-U', 'bareos', 'tape', '-e', '-w', '3', '-c', '5'])
+                self.assertEqual(actual, {'output': '[CRITICAL] - 10.0 Tapes are empty|bareos.tape.empty=10.0;3;5;;', 'returnCode': 2})
+
+                with mock.patch.dict('os.environ', {'CHECK_BAREOS_SOCKET': path}), mock.patch('builtins.print') as mock_print:
+                    self.assertEqual(check_bareos_client.main(['-U', 'bareos', 'tape', '-e', '-w', '3', '-c', '5']), 2)
+                mock_print.assert_called_with('[CRITICAL] - 10.0 Tapes are empty|bareos.tape.empty=10.0;3;5;;')
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    @mock.patch('builtins.print')
+    def test_client_without_daemon(self, mock_print):
+        with mock.patch.dict('os.environ', {'CHECK_BAREOS_SOCKET': '/nonexistent/check_bareos.sock'}):
+            self.assertEqual(check_bareos_client.main(['-U', 'bareos', 'tape', '-e']), 3)
+
+class ResultCacheTesting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(os.path.join(self.tmp.name, 'cache'), ttl=60, stale=60, wait=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_key(self):
+        args = commandline(['-U', 'bareos', '-p', 'secret', 'tape', '-e'])
+        other = commandline(['-U', 'bareos', '-p', 'other', '--cache-ttl', '60', 'tape', '-e'])
+        self.assertEqual(ResultCache.key(args), ResultCache.key(other))
+
+        other = commandline(['-U', 'bareos', '-H', 'otherhost', 'tape', '-e'])
+        self.assertNotEqual(ResultCache.key(args), ResultCache.key(other))
+
+        other = commandline(['-U', 'bareos', 'tape', '-e', '-w', '1'])
+        self.assertNotEqual(ResultCache.key(args), ResultCache.key(other))
+
+    def test_get(self):
+        result = {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are empty', 'performanceData': 'bareos.tape.empty=2.0;3;5;;'}
+        compute = mock.MagicMock(return_value=result)
+
+        self.assertEqual(self.cache.get('key', compute), result)
+        self.assertEqual(self.cache.get('key', compute), result)
+        self.assertEqual(compute.call_count, 1)
+
+    def test_get_expired(self):
+        compute = mock.MagicMock(return_value={'returnCode': 0, 'returnMessage': 'new'})
+        self.cache.get('key', lambda: {'returnCode': 0, 'returnMessage': 'old'})
+
+        # Stale results are refreshed by the invocation getting the lock
+        with mock.patch('check_bareos.time.time', return_value=time.time() + 90):
+            self.assertEqual(self.cache.get('key', compute)['returnMessage'], 'new')
+
+        # Stale results are served while another invocation refreshes them
+        with open(os.path.join(self.cache.directory, 'key.lock'), 'a', encoding='utf-8') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            with mock.patch('check_bareos.time.time', return_value=time.time() + 90):
+                self.assertEqual(self.cache.get('key', lambda: None)['returnMessage'], 'new')
+
+        # Too old results are not served
+        with mock.patch('check_bareos.time.time', return_value=time.time() + 150):
+            self.assertEqual(self.cache.get('key', lambda: {'returnCode': 1, 'returnMessage': 'newer'})['returnMessage'], 'newer')
+
+    def test_get_untrusted(self):
+        result = {'returnCode': 0, 'returnMessage': '[OK] - 2.0 Tapes are empty'}
+        compute = mock.MagicMock(return_value=result)
+        self.cache.get('key', compute)
+        self.assertTrue(self.cache.trusted())
+
+        # A directory others can write to is bypassed
+        os.chmod(self.cache.directory, 0o777)
+        self.assertIsNone(self.cache.read('key'))
+        self.assertEqual(self.cache.get('key', compute), result)
+        self.assertEqual(compute.call_count, 2)
+
+        # As is a directory owned by another user
+        os.chmod(self.cache.directory, 0o700)
+        with mock.patch('check_bareos.os.geteuid', return_value=os.geteuid() + 1):
+            self.assertIsNone(self.cache.read('key'))
+            self.cache.get('key', compute)
+        self.assertEqual(compute.call_count, 3)
+
+    def test_get_unknown(self):
+        compute = mock.MagicMock(return_value={'returnCode': 3, 'returnMessage': '[UNKNOWN] - timeout'})
+        self.cache.get('key', compute)
+        self.cache.get('key', compute)
+        self.assertEqual(compute.call_count, 2)
+
+    @mock.patch('check_bareos.queryCheck')
+    def test_runCheck(self, mock_query):
+        mock_query.return_value = {'returnCode': 0, 'returnMessage': '[OK]'}
+        args = commandline(['-U', 'bareos', '--cache-ttl', '60', '--cache-dir', self.cache.directory, 'tape', '-e'])
+
+        runCheck(args, args.evaluate)
+        runCheck(args, args.evaluate)
+        self.assertEqual(mock_query.call_count, 1)
+
+class IncrementalTesting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'state.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_update(self):
+        today = datetime.date(2023, 11, 10)
+        c = mock.MagicMock()
+        c.fetchone.return_value = [today]
+        rows = [
+            (1, datetime.date(2023, 11, 9), 'F', 'E', 0),
+            (2, datetime.date(2023, 11, 9), 'I', 'T', 0),
+            (3, datetime.date(2023, 11, 1), 'F', 'T', 5 * 2 ** 40),
+            (4, datetime.date(2023, 11, 10), 'F', 'R', 1024),
+            (5, None, 'F', 'C', 0),
+        ]
+        c.fetchall.return_value = rows
+
+        state = IncrementalJobState(self.path)
+        state.load()
+        state.update(c, 7, [2 ** 41])
+        state.save()
+
+        c.execute.assert_any_call(QUERIES['incrementalJobs'], (0, 7, []))
+        self.assertEqual(state.watermark, 5)
+        self.assertEqual(state.pending, [4, 5])
+        # Day 2023-11-01 is older than the window
+        self.assertEqual(sorted(state.days), ['2023-11-09'])
+
+        self.assertEqual(state.value("COUNT(*)", JobFilter(states=['E', 'f'], time=7)), 1)
+        self.assertEqual(state.value("COUNT(*)", JobFilter(states=['T'], kind="'F','I','D'", time=7, empty=True)), 1)
+        self.assertEqual(state.value("COUNT(*)", JobFilter(states=['T'], kind="'F'", time=7, empty=True)), 0)
+
+        with self.assertRaises(ValueError):
+            state.value("COUNT(*)", JobFilter(states=['R'], time=7))
+
+        # Only new, pending and the last JobIds are fetched, finished pending jobs are counted
+        # and jobs fetched again are not counted twice
+        c.fetchall.return_value = rows[:3] + [(4, datetime.date(2023, 11, 10), 'F', 'T', 3 * 2 ** 40)]
+        state = IncrementalJobState(self.path)
+        state.load()
+        state.update(c, 7, [2 ** 41])
+        state.save()
+
+        c.execute.assert_any_call(QUERIES['incrementalJobs'], (0, 7, [4, 5]))
+        self.assertEqual(state.pending, [])
+        self.assertEqual(state.value("COUNT(*)", JobFilter(states=['E', 'f'], time=7)), 1)
+        self.assertEqual(state.value("COUNT(*)", JobFilter(kind="'F'", time=7, size=2 ** 41)), 1)
+        self.assertEqual(state.value("COUNT(*)", JobFilter(kind="'F'", time=0, size=2 ** 41)), 1)
+
+        # Only the counts over the sizes are kept, not the size of every job
+        with open(self.path, encoding='utf-8') as statefile:
+            self.assertEqual(json.load(statefile)['days']['2023-11-10'], {'F': {'T': [1, 0, [1]]}})
+        with self.assertRaises(ValueError):
+            state.value("COUNT(*)", JobFilter(kind="'F'", time=7, size=2 ** 40))
+
+        # Other sizes rebuild the state
+        state.update(c, 7, [2 ** 40])
+        c.execute.assert_any_call(QUERIES['incrementalJobs'], (0, 7, []))
+        self.assertEqual(state.sizes, [2.0 ** 40, 2.0 ** 41])
+
+        # Larger windows rebuild the state
+        state.update(c, 14)
+        c.execute.assert_any_call(QUERIES['incrementalJobs'], (0, 14, []))
+
+        # Checks with a smaller window sharing the state keep the larger one
+        state.update(c, 7, [2 ** 39])
+        self.assertEqual(state.retention, 14)
+
+    def test_update_late_jobs(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [datetime.date(2023, 11, 10)]
+        c.fetchall.return_value = [(200, datetime.date(2023, 11, 9), 'F', 'E', 0)]
+
+        state = IncrementalJobState(self.path)
+        state.update(c, 7)
+
+        # A job committed after a job with a higher JobId is still counted
+        c.fetchall.return_value = [(150, datetime.date(2023, 11, 9), 'F', 'f', 0), (200, datetime.date(2023, 11, 9), 'F', 'E', 0)]
+        state.update(c, 7)
+        c.execute.assert_any_call(QUERIES['incrementalJobs'], (200 - IncrementalJobState.JOBID_OVERLAP, 7, []))
+        self.assertEqual(state.value("COUNT(*)", JobFilter(states=['E', 'f'], time=7)), 2)
+        self.assertEqual(state.counted, [150, 200])
+
+    def test_evaluateStatus_incremental(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [datetime.date(2023, 11, 10)]
+        c.fetchall.return_value = [(1, datetime.date(2023, 11, 9), 'F', 'E', 0),
+                                   (2, datetime.date(2023, 11, 8), 'F', 'f', 0)]
+
+        args = commandline(['-U', 'bareos', 'status', '-fb', '-w', '1', '-c', '5', '--incremental', self.path])
+        actual = args.evaluate(c, args)
+        expected = {'returnCode': 1, 'returnMessage': '[WARNING] - 2 Backups failed/canceled in the last 7 days', 'performanceData': 'bareos.backup.failed=2;1;5;;'}
+        self.assertEqual(actual, expected)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_evaluateStatus_incremental_fractional(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [6]
+
+        # Whole-day buckets cannot represent half days, the regular query is used instead
+        args = commandline(['-U', 'bareos', 'status', '-fb', '-t', '0.5', '-w', '5', '-c', '10', '--incremental', self.path])
+        actual = args.evaluate(c, args)
+
+        c = mock.MagicMock()
+        c.fetchone.return_value = [6]
+        args = commandline(['-U', 'bareos', 'status', '-fb', '-t', '0.5', '-w', '5', '-c', '10'])
+        expected = args.evaluate(c, args)
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(IncrementalJobState(self.path).supports("COUNT(*)", JobFilter(states=['E'], time='1.5')))
+
+
+class ExplainTesting(unittest.TestCase):
+
+    PLAN = [{"Plan": {"Node Type": "Aggregate", "Plan Rows": 1, "Actual Rows": 1, "Actual Loops": 1,
+                      "Shared Hit Blocks": 10, "Shared Read Blocks": 2,
+                      "Plans": [{"Node Type": "Seq Scan", "Relation Name": "media", "Plan Rows": 1000, "Actual Rows": 12, "Actual Loops": 1},
+                                {"Node Type": "Index Scan", "Relation Name": "pool", "Index Name": "pool_pkey", "Plan Rows": 1, "Actual Rows": 1, "Actual Loops": 12}]},
+             "Planning Time": 0.1, "Execution Time": 1.5}]
+
+    def test_ExplainCursor(self):
+        c = mock.MagicMock()
+        c.fetchone.side_effect = [[self.PLAN], [3]]
+
+        explain = ExplainCursor(c)
+        explain.execute(QUERIES['willExpireTapes'], (7,))
+
+        c.execute.assert_has_calls([mock.call("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + QUERIES['willExpireTapes'], (7,)),
+                                    mock.call(QUERIES['willExpireTapes'], (7,))])
+        self.assertEqual(explain.fetchone(), [3])
+        self.assertEqual(explain.seqScans(), 1)
+        self.assertEqual(explain.longOutput(), "Query 1: 1.5 ms, buffers shared hit=10 read=2\n"
+                                               "  Seq Scan on media: estimated 1000 rows, actual 12 rows\n"
+                                               "  Index Scan using pool_pkey on pool: estimated 1 rows, actual 12 rows")
+        self.assertEqual(explain.performanceData(), "bareos.explain.seqscans=1 bareos.explain.execution_ms=1.5")
+
+    @mock.patch('check_bareos.connectDB')
+    def test_queryCheck_explain(self, mock_connect):
+        c = mock.MagicMock()
+        c.fetchone.side_effect = [[self.PLAN], [3]]
+        mock_connect.return_value = c
+
+        args = commandline(['-U', 'bareos', '--explain', 'tape', '-ex', '-w', '5', '-c', '10'])
+        actual = queryCheck(args, args.evaluate)
+
+        self.assertEqual(actual['returnCode'], 0)
+        self.assertEqual(actual['performanceData'], "bareos.tape.expired=3.0;5;10;; bareos.explain.seqscans=1 bareos.explain.execution_ms=1.5")
+        self.assertTrue(actual['longOutput'].startswith("Query 1: 1.5 ms"))
+
+    def test_adviseIndexes(self):
+        existing = [('job_name_idx', 'CREATE INDEX job_name_idx ON public.job USING btree (name)'),
+                    ('failed', "CREATE INDEX failed ON public.job USING btree (starttime) WHERE (jobstatus = ANY (ARRAY['E'::bpchar, 'f'::bpchar]))")]
+
+        missing = [index["name"] for index in adviseIndexes(existing)]
+        self.assertEqual(len(missing), len(INDEXES) - 1)
+        self.assertNotIn('check_bareos_job_failed_idx', missing)
+
+        _, subParser = createParser()
+        checks = [('tape', subParser.choices['tape'].parse_args(['-ex'])),
+                  ('status', subParser.choices['status'].parse_args(['-fb']))]
+        missing = [index["name"] for index in adviseIndexes(existing, checks)]
+        self.assertEqual(missing, ['check_bareos_media_expiry_idx'])
+
+    def test_evaluateAdvise(self):
+        c = mock.MagicMock()
+        c.fetchall.return_value = []
+
+        args = commandline(['-U', 'bareos', 'advise', '-C', 'status -fb'])
+        actual = args.evaluate(c, args)
+
+        c.execute.assert_called_with(QUERIES['indexes'])
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['performanceData'], "bareos.indexes.missing=1;;;;")
+        self.assertIn("CREATE INDEX check_bareos_job_failed_idx ON Job (StartTime) WHERE JobStatus IN ('E', 'f');", actual['longOutput'])
+
+        args = commandline(['-U', 'bareos', 'advise', '-C', 'status -x'])
+        self.assertEqual(args.evaluate(c, args)['returnCode'], 3)
+
+
+class TapeInventoryTesting(unittest.TestCase):
+
+    ROWS = [
+        (1, 'Append', True, 0, 10, 86400.0 * 100, 'Full', 'Tape'),
+        (2, 'Purged', True, 0, 250, -60.0, 'Full', 'Tape'),
+        (3, 'Full', True, 0, 5, -3600.0, 'Incremental', 'Tape'),
+        (4, 'Error', False, 3, 5, -3600.0, 'Incremental', 'Tape'),
+        (5, 'Full', False, 0, 5, 86400.0 * 2, 'Full', None),
+        (6, 'Disabled', False, 0, 5, None, 'Scratch Pool', 'Tape'),
+    ]
+
+    def inventory(self):
+        c = mock.MagicMock()
+        c.fetchmany.side_effect = [self.ROWS[:4], self.ROWS[4:], []]
+        inventory = TapeInventory()
+        inventory.load(c)
+        inventory.load(c)
+        c.execute.assert_called_once_with(QUERIES['tapeInventory'])
+        return inventory
+
+    def test_metrics(self):
+        inventory = self.inventory()
+
+        self.assertEqual(list(inventory.mediaIds), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(inventory.tapesInStorage(), [0, 1, 2])
+        self.assertEqual(inventory.expiredTapes(), [1, 2])
+        self.assertEqual(inventory.willExpireTapes(7), [4])
+        self.assertEqual(inventory.replaceTapes('200'), [1, 3, 5])
+        self.assertEqual(inventory.emptyTapes(), [1, 2])
+        self.assertEqual(inventory.performanceData("bareos.tape.empty", [1, 2]),
+                         " bareos.tape.empty.pool.Full=1 bareos.tape.empty.pool.Incremental=1 bareos.tape.empty.storage.Tape=2")
+        # The pools and storages beyond the limit are summed up
+        self.assertEqual(inventory.performanceData("bareos.tape.expired", [1, 3, 4], 1),
+                         " bareos.tape.expired.pool.Full=2 bareos.tape.expired.pool.__other__=1"
+                         " bareos.tape.expired.storage.Tape=2 bareos.tape.expired.storage.__other__=1")
+
+    def test_evaluateTape_inventory(self):
+        inventory = self.inventory()
+        c = mock.MagicMock()
+
+        args = commandline(['-U', 'bareos', 'tape', '-r', '--inventory', '-w', '2', '-c', '5'])
+        actual = args.evaluate(c, args, inventory)
+
+        c.execute.assert_not_called()
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['returnMessage'], '[WARNING] - 3.0 Tapes might need replacement')
+        self.assertTrue(actual['performanceData'].startswith('bareos.tape.replace=3.0;2;5;; bareos.tape.replace.pool.Full=1 '))
+
+    def test_evaluateTape_histogram_inventory(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [1, 0, 2, 0, 0, 0, 3]
+
+        # The expiry histogram runs its own query without loading the inventory
+        args = commandline(['-U', 'bareos', 'tape', '-eh', '--inventory'])
+        actual = args.evaluate(c, args)
+        c.execute.assert_called_once_with(expiryHistogramQuery())
+        self.assertEqual(actual['returnCode'], 0)
+
+    def test_evaluateBatch_inventory(self):
+        c = mock.MagicMock()
+        c.fetchmany.side_effect = [self.ROWS, []]
+        _, subParser = createParser()
+
+        results = evaluateBatch(c, subParser, [('expired', ['tape', '-ex', '--inventory']), ('empty', ['tape', '-e', '--inventory'])])
+
+        c.execute.assert_called_once_with(QUERIES['tapeInventory'])
+        self.assertEqual([r['returnMessage'] for _, r in results], ['[OK] - 2.0 Tapes are expired', '[OK] - 2.0 Tapes are empty'])
+
+
+class ReportTesting(unittest.TestCase):
+
+    ROWS = [
+        (1, 'backup-client-1', 'client-1', 'F', 'T', datetime.datetime(2023, 11, 9, 22, 0), datetime.datetime(2023, 11, 9, 23, 0), 10, 1024),
+        (2, 'backup-client-2', None, 'I', 'E', datetime.datetime(2023, 11, 10, 22, 0), None, 0, 0),
+    ]
+
+    def cursor(self):
+        c = mock.MagicMock()
+        c.connection.cursor.return_value.__iter__.return_value = iter(self.ROWS)
+        return c
+
+    def test_streamJobReport_ndjson(self):
+        c = self.cursor()
+        out = io.StringIO()
+
+        count = streamJobReport(c, JobFilter(states=['E', 'f'], time=7, midnight=False), out, itersize=500, limit=10)
+
+        self.assertEqual(count, 2)
+        report = c.connection.cursor.return_value
+        c.connection.cursor.assert_called_once_with(name='check_bareos_report')
+        self.assertEqual(report.itersize, 500)
+        query, params = report.execute.call_args[0]
+        self.assertIn("FROM Job LEFT JOIN Client ON Job.ClientId=Client.ClientId WHERE JobStatus = ANY(%s::bpchar[])", query)
+        self.assertTrue(query.endswith("ORDER BY JobId LIMIT %s;"))
+        self.assertEqual(params, [['E', 'f'], 7.0, 10])
+        report.close.assert_called_once()
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[0]), {'jobid': 1, 'name': 'backup-client-1', 'client': 'client-1', 'level': 'F', 'status': 'T',
+                                                'starttime': '2023-11-09 22:00:00', 'endtime': '2023-11-09 23:00:00', 'jobfiles': 10, 'jobbytes': 1024})
+        self.assertIsNone(json.loads(lines[1])['endtime'])
+
+    def test_streamJobReport_csv(self):
+        out = io.StringIO()
+
+        streamJobReport(self.cursor(), JobFilter(), out, 'csv')
+
+        self.assertEqual(out.getvalue().splitlines(), [
+            'jobid,name,client,level,status,starttime,endtime,jobfiles,jobbytes',
+            '1,backup-client-1,client-1,F,T,2023-11-09 22:00:00,2023-11-09 23:00:00,10,1024',
+            '2,backup-client-2,,I,E,2023-11-10 22:00:00,,0,0'])
+
+    @mock.patch('builtins.print')
+    @mock.patch('check_bareos.connectDB')
+    def test_reportJobs(self, mock_connect, mock_print):
+        mock_connect.return_value = self.cursor()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'jobs.csv')
+            args = commandline(['-U', 'bareos', 'report', '-fb', '-f', '--format', 'csv', '-o', path])
+            with self.assertRaises(SystemExit) as context:
+                reportJobs(args)
+
+            with open(path, encoding='utf-8') as report:
+                self.assertEqual(len(report.readlines()), 3)
+
+        self.assertEqual(context.exception.code, 0)
+        mock_print.assert_called_with('[OK] - 2 Jobs written to ' + path + '|bareos.report.jobs=2')
+        _, params = mock_connect.return_value.connection.cursor.return_value.execute.call_args[0]
+        self.assertEqual(params, [['E', 'f'], ['F']])
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    @mock.patch('check_bareos.connectDB')
+    def test_reportJobs_error(self, mock_connect, mock_out, mock_err):
+        mock_connect.return_value = self.cursor()
+        mock_connect.return_value.connection.cursor.return_value.execute.side_effect = psycopg2.DatabaseError("relation job does not exist\n")
+
+        # The error is not written into the report on stdout
+        args = commandline(['-U', 'bareos', 'report', '-fb'])
+        with self.assertRaises(SystemExit) as context:
+            reportJobs(args)
+        self.assertEqual(context.exception.code, 3)
+        self.assertEqual(mock_out.getvalue(), "")
+        self.assertEqual(mock_err.getvalue(), "[UNKNOWN] - relation job does not exist\n")
+
+
+class TrendTesting(unittest.TestCase):
+
+    TODAY = datetime.date(2023, 11, 10)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'trend.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rows(self, days):
+        # One full backup of client-1 per day growing by 1 TB per day, a small incremental of client-2
+        rows = []
+        for n in range(1, days + 1):
+            day = self.TODAY - datetime.timedelta(days=n)
+            rows.append((day, 'F', 'client-1', (100 - n) * 2 ** 40))
+            rows.append((day, 'I', 'client-2', 2 ** 40))
+        return rows
+
+    def test_fitTrend(self):
+        predict = fitTrend([1.0, 2.0, 3.0, 4.0])
+        self.assertAlmostEqual(predict(4), 5.0)
+
+        predict = fitTrend([1.0, 2.0, 4.0, 8.0], 'exponential')
+        self.assertAlmostEqual(predict(4), 16.0)
+
+        self.assertEqual(fitTrend([5.0])(3), 5.0)
+
+    def test_forecastDaysLeft(self):
+        predict = fitTrend([1.0, 2.0, 3.0])
+        # The window of 3 days holds 6, then 9, 12, 15
+        self.assertEqual(forecastDaysLeft([1.0, 2.0, 3.0], predict, 12, 1), 2)
+        self.assertEqual(forecastDaysLeft([1.0, 2.0, 3.0], predict, 5, 1), 0)
+        self.assertIsNone(forecastDaysLeft([1.0, 1.0, 1.0], fitTrend([1.0, 1.0, 1.0]), 100, 1))
+
+    def test_update(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [self.TODAY]
+        c.fetchall.return_value = self.rows(30)
+
+        trend = BackupTrend(self.path)
+        trend.load()
+        trend.update(c, 30)
+        trend.save()
+        c.execute.assert_called_with(QUERIES['trendJobs'], ('2023-10-11',))
+        self.assertEqual(trend.series(1, 30)[-1], 100 * 2 ** 40)
+        self.assertEqual(trend.series(7, 30, 1)['client-2'], [7 * 2 ** 40] * 4)
+
+        # Only the last days are fetched again
+        c.fetchall.return_value = self.rows(2)
+        trend = BackupTrend(self.path)
+        trend.load()
+        trend.update(c, 30)
+        c.execute.assert_called_with(QUERIES['trendJobs'], ('2023-11-08',))
+        self.assertEqual(len(trend.days), 30)
+        trend.save()
+
+        # After a pause longer than the refreshed days the days since the last update are fetched
+        c.fetchone.return_value = [self.TODAY + datetime.timedelta(days=10)]
+        c.fetchall.return_value = [(self.TODAY + datetime.timedelta(days=n), 'F', 'client-1', 2 ** 40) for n in range(-2, 10)]
+        trend = BackupTrend(self.path)
+        trend.load()
+        trend.update(c, 30)
+        c.execute.assert_called_with(QUERIES['trendJobs'], ('2023-11-08',))
+        self.assertNotIn(0.0, trend.series(1, 30))
+
+    def test_checkBackupTrend(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [self.TODAY]
+        c.fetchall.return_value = self.rows(30)
+        trend = BackupTrend()
+        trend.update(c, 30)
+
+        actual = checkBackupTrend(trend, 30, 'day', 'linear', 'TB', 3000, 50, Threshold('30:'), Threshold('7:'))
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['returnMessage'], '[WARNING] - 100.0 TB in the last day, trend +1.0 TB per day, capacity of 3000 TB reached in 15 days')
+        self.assertEqual(actual['performanceData'], 'bareos.trend.last=100.0 bareos.trend.expected=100.0 bareos.trend.growth=1.0 bareos.trend.stored=2565.0 '
+                                                    'bareos.trend.days_left=15;30:;7:;; bareos.trend.last.level.F=99.0 bareos.trend.last.level.I=1.0 '
+                                                    'bareos.trend.last.client.client-1=99.0 bareos.trend.last.client.client-2=1.0')
+
+        actual = checkBackupTrend(trend, 30, 'week', 'linear', 'TB', None, 50, Threshold('30:'), Threshold('7:'))
+        self.assertEqual(actual['returnCode'], 0)
+        self.assertEqual(actual['returnMessage'], '[OK] - 679.0 TB in the last week, trend +49.0 TB per week')
+
+        actual = checkBackupTrend(trend, 10, 'week', 'linear', 'TB', None, 50, Threshold('30:'), Threshold('7:'))
+        self.assertEqual(actual['returnCode'], 3)
+
+    def test_evaluateTrend_deviation(self):
+        rows = self.rows(14)
+        rows[0] = (rows[0][0], 'F', 'client-1', 0)
+        c = mock.MagicMock()
+        c.fetchone.return_value = [self.TODAY]
+        c.fetchall.return_value = rows
+
+        # Disabled by default
+        args = commandline(['-U', 'bareos', 'trend', '-t', '14'])
+        self.assertEqual(args.evaluate(c, args)['returnCode'], 0)
+
+        args = commandline(['-U', 'bareos', 'trend', '-t', '14', '--deviation', '50', '--state-file', self.path])
+        actual = args.evaluate(c, args)
+
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertTrue(actual['returnMessage'].endswith('deviates 99% from the trend'))
+        self.assertTrue(os.path.exists(self.path))
+
+
+class AnomalyTesting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'baselines.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def cursor(self, rows):
+        c = mock.MagicMock()
+        c.connection.cursor.return_value.__iter__.return_value = iter(rows)
+        return c
+
+    def test_update(self):
+        # Five old jobs build the baseline, the recent ones are compared with it
+        rows = [(n, 'backup-client-1', 'F', 'T', 1000, 100, 3600, 86400 * 10) for n in range(1, 6)]
+        rows += [(6, 'backup-client-1', 'F', 'T', 50, 100, 3600 * 4, 3600),
+                 (7, 'backup-client-1', 'I', 'T', 10, 1, 60, 3600),
+                 (8, 'backup-client-1', 'F', 'R', 0, 0, None, None),
+                 (9, 'backup-client-2', 'F', 'E', 0, 0, 10, 3600)]
+        c = self.cursor(rows)
+
+        baselines = JobBaselines(self.path, alpha=0.5, minSamples=5)
+        baselines.update(c, 1, itersize=500)
+
+        jobs = c.connection.cursor.return_value
+        jobs.execute.assert_called_once_with(QUERIES['baselineJobs'], (0, []))
+        self.assertEqual(jobs.itersize, 500)
+        self.assertEqual(baselines.watermark, 9)
+        self.assertEqual(baselines.pending, [8])
+        self.assertEqual(baselines.jobs['backup-client-1/F'], [6, 525.0, 100.0, 9000.0])
+        self.assertEqual(len(baselines.anomalies), 1)
+        self.assertEqual(baselines.anomalies[0]['jobid'], 6)
+        self.assertEqual(baselines.anomalies[0]['reasons'], ['runtime 4.0x the usual 1:00:00', 'bytes 50 instead of about 1000'])
+
+    def test_evaluateAnomaly(self):
+        rows = [(n, 'backup-client-1', 'F', 'T', 1000, 100, 3600, 3600) for n in range(1, 7)]
+        rows.append((7, 'backup-client-1', 'F', 'T', 1000, 100, 3600 * 3, 3600))
+
+        args = commandline(['-U', 'bareos', 'anomaly', '--state-file', self.path])
+        actual = args.evaluate(self.cursor(rows), args)
+
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['returnMessage'], '[WARNING] - 1 Jobs deviated from their baseline in the last 1 days')
+        self.assertEqual(actual['performanceData'], 'bareos.job.anomalies=1;0;5;; bareos.job.baselines=1')
+        self.assertEqual(actual['longOutput'], 'backup-client-1 Level: F JobId: 7 runtime 3.0x the usual 1:00:00')
+
+        # The next run only reads the new jobs and still reports the deviating job
+        c = self.cursor([])
+        actual = args.evaluate(c, args)
+        c.connection.cursor.return_value.execute.assert_called_once_with(QUERIES['baselineJobs'], (7, []))
+        self.assertEqual(actual['returnCode'], 1)
+
+
+class PerfGroupsTesting(unittest.TestCase):
+
+    def test_performanceData(self):
+        groups = PerfGroups('pool', 2)
+        actual = groups.performanceData("bareos.tape.empty", [('Full', 3), ('Scratch Pool', 5), ('Incremental', 1), ('Diff', 1)])
+        self.assertEqual(actual, " 'bareos.tape.empty.pool.Scratch Pool'=5 bareos.tape.empty.pool.Full=3 bareos.tape.empty.pool.__other__=2")
+
+        # A pool named other keeps its own series
+        actual = PerfGroups('pool', 1).performanceData("bareos.tape.empty", [('other', 3), ('Full', 1), ('Diff', 1)])
+        self.assertEqual(actual, " bareos.tape.empty.pool.other=3 bareos.tape.empty.pool.__other__=2")
+
+        groups = PerfGroups('pool', 0)
+        actual = groups.performanceData("bareos.tape.empty", [('Full', 3), ('Incremental', 1)])
+        self.assertEqual(actual, " bareos.tape.empty.pool.Full=3 bareos.tape.empty.pool.Incremental=1")
+        self.assertEqual(groups.summary(), "")
+
+    def test_summary(self):
+        groups = PerfGroups('pool', 1, Threshold("2"), Threshold("4"))
+        groups.performanceData("bareos.tape.empty", [('Full', 5), ('Scratch', 3), ('Diff', 3), ('Incremental', 1)])
+        # Groups in the other bucket are evaluated as well
+        self.assertEqual(groups.summary(), " (pool: 1 CRITICAL, 2 WARNING)")
+
+    def test_evaluateTape_groupBy(self):
+        c = mock.MagicMock()
+        c.fetchall.return_value = [('Tape', 4), ('none', 1)]
+
+        args = commandline(['-U', 'bareos', 'tape', '-wex', '-t', '3', '--group-by', 'storage'])
+        actual = args.evaluate(c, args)
+
+        self.assertEqual(actual['returnMessage'], '[OK] - 5.0 Tapes will expire in 3 days')
+        self.assertEqual(actual['performanceData'], 'bareos.tape.willexpire=5.0;5;10;; bareos.tape.willexpire.storage.Tape=4 bareos.tape.willexpire.storage.none=1')
+        query, params = c.execute.call_args[0]
+        self.assertIn("SELECT COALESCE(Storage.Name, 'none'), Count(MediaId) FROM Media LEFT JOIN Pool", query)
+        self.assertTrue(query.endswith("GROUP BY 1;"))
+        self.assertEqual(params, ['3'])
+
+    def test_evaluateTape_groupBy_inventory(self):
+        c = mock.MagicMock()
+        c.fetchmany.side_effect = [TapeInventoryTesting.ROWS, []]
+
+        args = commandline(['-U', 'bareos', 'tape', '-ts', '--inventory', '--group-by', 'pool', '--group-limit', '1'])
+        actual = args.evaluate(c, args)
+
+        c.execute.assert_called_once_with(QUERIES['tapeInventory'])
+        self.assertEqual(actual['performanceData'], 'bareos.tape.instorage=3.0;5;10;; bareos.tape.instorage.pool.Full=2 bareos.tape.instorage.pool.__other__=1')
+
+    def test_evaluateStatus_groupBy(self):
+        c = mock.MagicMock()
+        c.fetchall.return_value = [('client-1', 2), ('client-2', 1)]
+
+        args = commandline(['-U', 'bareos', 'status', '-fb', '-w', '1', '-c', '5', '--group-by', 'client'])
+        actual = args.evaluate(c, args)
+
+        self.assertEqual(actual['returnCode'], 1)
+        self.assertEqual(actual['returnMessage'], '[WARNING] - 3 Backups failed/canceled in the last 7 days (client: 1 WARNING)')
+        self.assertEqual(actual['performanceData'], 'bareos.backup.failed=3;1;5;; bareos.backup.failed.client.client-1=2 bareos.backup.failed.client.client-2=1')
+        self.assertIn("FROM Job LEFT JOIN Client ON Job.ClientId=Client.ClientId WHERE JobStatus", c.execute.call_args[0][0])
+
+        args = commandline(['-U', 'bareos', 'status', '-fb', '--group-by', 'pool', '--incremental', '/tmp/state.json'])
+        with self.assertRaises(ValueError):
+            args.evaluate(c, args)
+
+    def test_evaluateBatch_groupBy(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [1]
+        c.fetchall.return_value = [('Full', 2)]
+        _, subParser = createParser()
+
+        results = evaluateBatch(c, subParser, [('failed', ['status', '-fb']), ('size', ['status', '-b', '--group-by', 'pool'])])
+
+        # The grouped check runs its own query next to the one of the JobStatistics
+        self.assertEqual(c.execute.call_count, 2)
+        self.assertEqual(results[1][1]['performanceData'], 'bareos.backup.size=2;5;10;; bareos.backup.size.pool.Full=2')
+
+
+class ExporterTesting(unittest.TestCase):
+
+    def test_parsePerformanceData(self):
+        actual = parsePerformanceData("bareos.tape.expired=2.0;3;5;; 'bareos.Job terminated in error'=9;3;5;; 'a''b'=1 bareos.backup.size=None;1;2;;")
+        self.assertEqual(actual, [('bareos.tape.expired', 2.0), ('bareos.Job terminated in error', 9.0), ("a'b", 1.0)])
+
+    def test_metricName(self):
+        self.assertEqual(metricName('bareos.backup.failed'), ('bareos_backup_failed', {}))
+        self.assertEqual(metricName('bareos.Job terminated in error'), ('bareos_jobs', {'state': 'E'}))
+        self.assertEqual(metricName('bareos.tape.empty.pool.Scratch Pool'), ('bareos_tape_empty_by_pool', {'pool': 'Scratch Pool'}))
+
+    def test_formatMetrics(self):
+        results = [('expired', {'returnCode': 0, 'returnMessage': '[OK]', 'performanceData': 'bareos.tape.expired=2.0;3;5;; bareos.tape.expired.pool.Full=2'}),
+                   ('errors', {'returnCode': 2, 'returnMessage': '[CRITICAL]', 'performanceData': "'bareos.Job terminated in error'=9.0;3;5;;"})]
+
+        actual = formatMetrics(results, 1700000000, 0.25)
+        expected = ('# TYPE bareos_check_state gauge\n'
+                    'bareos_check_state{check="expired"} 0\n'
+                    'bareos_check_state{check="errors"} 2\n'
+                    '# TYPE bareos_tape_expired gauge\n'
+                    'bareos_tape_expired{check="expired"} 2.0\n'
+                    '# TYPE bareos_tape_expired_by_pool gauge\n'
+                    'bareos_tape_expired_by_pool{check="expired",pool="Full"} 2.0\n'
+                    '# TYPE bareos_jobs gauge\n'
+                    'bareos_jobs{check="errors",state="E"} 9.0\n'
+                    '# TYPE bareos_exporter_up gauge\n'
+                    'bareos_exporter_up 1\n'
+                    '# TYPE bareos_exporter_last_refresh_timestamp_seconds gauge\n'
+                    'bareos_exporter_last_refresh_timestamp_seconds 1700000000\n'
+                    '# TYPE bareos_exporter_refresh_duration_seconds gauge\n'
+                    'bareos_exporter_refresh_duration_seconds 0.25\n')
+        self.assertEqual(actual, expected)
+
+    def test_exporter(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [1] * 40
+        c.fetchmany.return_value = []
+        pool = mock.MagicMock()
+        pool.cursor.return_value.__enter__.return_value = c
+        _, subParser = createParser()
+
+        exporter = MetricsExporter(pool, subParser, EXPORTED_CHECKS, 60)
+        self.assertIn('bareos_exporter_up 0', exporter.metrics())
+
+        exporter.refresh()
+        # One query over the Job table and one for the tape inventory
+        self.assertEqual(c.execute.call_count, 2)
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), metricsRequestHandler())
+        server.exporter = exporter
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:' + str(server.server_address[1]) + '/metrics') as response:
+                body = response.read().decode('utf-8')
+            self.assertIn('bareos_backup_failed{check="failed_backups"} 1.0', body)
+            self.assertIn('bareos_jobs{check="jobs_C",state="C"} 1.0', body)
+            self.assertIn('bareos_tape_expired{check="expired_tapes"} 0.0', body)
+            self.assertIn('bareos_exporter_up 1', body)
+
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen('http://127.0.0.1:' + str(server.server_address[1]) + '/')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # Scrapes do not query the catalog
+        self.assertEqual(c.execute.call_count, 2)
+
+        # A refresh where every check failed is reported and the last metrics are kept
+        c.execute.side_effect = psycopg2.OperationalError("server closed the connection unexpectedly")
+        exporter.refresh()
+        self.assertIn('bareos_exporter_up 0', exporter.metrics())
+        self.assertIn('bareos_backup_failed{check="failed_backups"} 1.0', exporter.metrics())
+
+    def test_exporter_run_error(self):
+        exporter = MetricsExporter(mock.MagicMock(), None, [], 60)
+        exporter._results = [('failed_backups', {'returnCode': 0, 'returnMessage': '[OK]', 'performanceData': 'bareos.backup.failed=1;;;;'})]
+        exporter._publish(0.1, True)
+
+        def refresh():
+            exporter.stop()
+            raise TypeError("'>' not supported between instances of 'NoneType' and 'float'")
+
+        # An unexpected error does not end the refresher and is reported as down
+        with mock.patch.object(exporter, 'refresh', side_effect=refresh), mock.patch('sys.stderr', new_callable=io.StringIO) as mock_err:
+            exporter.run()
+        self.assertIn('bareos_exporter_up 0', exporter.metrics())
+        self.assertIn("Refresh of the metrics failed: TypeError", mock_err.getvalue())
+
+
+class BenchmarkTesting(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3, 6, 7, 8, 9, 10]
+        self.assertEqual(benchmark_check_bareos.percentile(values, 50), 5)
+        self.assertEqual(benchmark_check_bareos.percentile(values, 95), 10)
+        self.assertEqual(benchmark_check_bareos.percentile([3], 95), 3)
+
+    def test_TimingCursor(self):
+        c = mock.MagicMock()
+        c.fetchone.side_effect = [[1], None]
+        c.fetchall.return_value = [(1,), (2,)]
+
+        timing = benchmark_check_bareos.TimingCursor(c)
+        timing.execute("SELECT 1;", [])
+        timing.fetchone()
+        timing.fetchone()
+        timing.fetchall()
+
+        c.execute.assert_called_with("SELECT 1;", [])
+        self.assertEqual(timing.queries, 1)
+        self.assertEqual(timing.rows, 3)
+        self.assertIs(timing.connection, c.connection)
+
+    def test_runBenchmark(self):
+        c = mock.MagicMock()
+        c.fetchone.return_value = [0] * 20
+        c.fetchmany.return_value = []
+
+        results = benchmark_check_bareos.runBenchmark(c, benchmark_check_bareos.benchmarkChecks(), 3)
+        names = [r['check'] for r in results]
+
+        self.assertEqual(names, [name for name, _ in benchmark_check_bareos.CHECKS] + ['batch', 'tape-inventory'])
+        self.assertEqual(results[0]['runs'], 3)
+        self.assertEqual(results[0]['queries'], 1)
+        self.assertEqual(results[0]['rows'], 1)
+        # The job and status checks of the batch share one query
+        self.assertEqual(results[-2]['queries'], 6)
+        # The tape checks of the inventory share one query
+        self.assertEqual(results[-1]['queries'], 1)
+        self.assertEqual(c.connection.rollback.call_count, 3 * len(results))
+
+    @mock.patch('benchmark_check_bareos.subprocess.run')
+    def test_runStartupBenchmark(self, mock_run):
+        mock_run.return_value.stdout = '{"import_ms": 40.0, "parse_ms": 2.0}'
+
+        results = benchmark_check_bareos.runStartupBenchmark([('expired-tapes', 'tape -ex')], 3)
+
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertEqual(mock_run.call_args[0][0][-4:], ['-U', 'bareos', 'tape', '-ex'])
+        self.assertEqual(results[0]['import_p95_ms'], 40.0)
+        self.assertEqual(results[0]['parse_p50_ms'], 2.0)
+        self.assertIn('expired-tapes', benchmark_check_bareos.formatStartupResults(results))
+
+        args = benchmark_check_bareos.commandline(['--startup', '--repeat', '1', '--budget', '41'])
+        with mock.patch('sys.stdout'), mock.patch('sys.stderr'), self.assertRaises(SystemExit) as sysexit:
+            benchmark_check_bareos.startup(args)
+        self.assertEqual(sysexit.exception.code, 1)
+
+        args = benchmark_check_bareos.commandline(['--startup', '--repeat', '1', '--budget', '50', '--json'])
+        with mock.patch('sys.stdout'):
+            benchmark_check_bareos.startup(args)
+
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            benchmark_check_bareos.commandline(['--jobs', '10'])
+
+    def test_measureStartup(self):
+        # Runs the plugin in a fresh interpreter
+        samples = benchmark_check_bareos.measureStartup('tape -ex', 1)
+        self.assertGreater(samples[0]['process_ms'], samples[0]['import_ms'])
+
+
+class InstrumentationTesting(unittest.TestCase):
+
+    def tearDown(self):
+        Instrumentation.active = None
+
+    def test_InstrumentedCursor(self):
+        instrumentation = Instrumentation()
+        c = mock.MagicMock()
+        c.fetchone.side_effect = [[1], None]
+        c.fetchmany.return_value = [(1,), (2,)]
+        c.fetchall.return_value = [(1,), (2,), (3,)]
+
+        cursor = InstrumentedCursor(c, instrumentation)
+        cursor.execute("SELECT 1;", [])
+        cursor.fetchone()
+        cursor.fetchone()
+        cursor.fetchmany(10)
+        self.assertEqual(list(cursor), [(1,), (2,), (3,)])
+
+        c.execute.assert_called_once_with("SELECT 1;", [])
+        self.assertEqual(instrumentation.queries, 1)
+        self.assertEqual(instrumentation.rows, 6)
+        self.assertEqual(sorted(instrumentation.phases), ['execute', 'fetch'])
+        self.assertIs(cursor.connection, c.connection)
+
+    def test_performanceData(self):
+        instrumentation = Instrumentation()
+        instrumentation.add('connect', 0.0125)
+        instrumentation.add('parse', 0.002)
+        instrumentation.add('parse', 0.001)
+        instrumentation.rows = 3
+
+        with mock.patch.object(Instrumentation, 'peakRss', return_value=20480):
+            self.assertEqual(instrumentation.performanceData(),
+                             'bareos.plugin.parse_ms=3.0 bareos.plugin.connect_ms=12.5 bareos.plugin.queries=0 bareos.plugin.rows=3 bareos.plugin.peak_rss=20480KB')
+
+        trace = instrumentation.trace(['-U', 'bareos', '-p', 'secret', '--password=secret', 'tape', '-ex'])
+        self.assertEqual(trace['argv'], ['-U', 'bareos', '-p', '***', '--password=***', 'tape', '-ex'])
+        self.assertEqual(trace['phases_ms'], {'parse': 3.0, 'connect': 12.5})
+        self.assertEqual(trace['returnCode'], 3)
+
+    @mock.patch('check_bareos.atexit.register')
+    @mock.patch('check_bareos.connectDB')
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_main_instrumented(self, mock_out, mock_connect, mock_register):
+        mock_connect.return_value.fetchone.return_value = [2]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.json')
+            with self.assertRaises(SystemExit):
+                main(['-U', 'bareos', '-p', 'secret', '--instrument', '--trace', path, 'tape', '-ex', '-w', '3', '-c', '5'])
+
+            output = mock_out.getvalue()
+            self.assertTrue(output.startswith('[OK] - 2.0 Tapes are expired|bareos.tape.expired=2.0;3;5;; bareos.plugin.import_ms='))
+
+            # The import time is read before the arguments are parsed
+            mock_out.truncate(0)
+            mock_out.seek(0)
+            clock = [0.05]
+
+            def parse(argv):
+                # Parsing takes 30 ms of CPU time
+                clock[0] += 0.03
+                return commandline(argv)
+            with mock.patch('check_bareos.time.process_time', side_effect=lambda: clock[0]), mock.patch('check_bareos.commandline', side_effect=parse):
+                with self.assertRaises(SystemExit):
+                    main(['-U', 'bareos', '--instrument', 'tape', '-ex', '-w', '3', '-c', '5'])
+            self.assertIn('bareos.plugin.import_ms=50.0 ', mock_out.getvalue())
+            for perfdata in ['bareos.plugin.connect_ms=', 'bareos.plugin.execute_ms=', 'bareos.plugin.fetch_ms=',
+                             'bareos.plugin.threshold_ms=', 'bareos.plugin.queries=1 bareos.plugin.rows=1 bareos.plugin.peak_rss=']:
+                self.assertIn(perfdata, output)
+
+            # The trace is written when the plugin exits
+            trace, *arguments = mock_register.call_args[0]
+            trace(*arguments)
+            with open(path, encoding='utf-8') as f:
+                actual = json.loads(f.readline())
+            self.assertEqual(actual['returnCode'], 0)
+            self.assertIn('output', actual['phases_ms'])
+            self.assertEqual(actual['argv'][3], '***')
+
+        # Invocations without the options are not instrumented
+        with self.assertRaises(SystemExit):
+            main(['-U', 'bareos', '-p', 'secret', 'tape', '-ex'])
+        self.assertIsNone(Instrumentation.active)
+        self.assertNotIn('bareos.plugin', mock_out.getvalue().splitlines()[-1])
+
+
+class DeadlineTesting(unittest.TestCase):
+
+    @mock.patch('check_bareos.psycopg2.connect')
+    def test_createConnection_timeout(self, mock_connect):
+        createConnection("bareos", "secret", "localhost", "bareos", 5432, 1.5)
+        self.assertEqual(mock_connect.call_args[1]['connect_timeout'], 2)
+        self.assertEqual(mock_connect.call_args[1]['options'], '-c statement_timeout=1500')
+
+        createConnection("bareos", "secret", "localhost", "bareos", 5432, 10, pgbouncer=True)
+        self.assertEqual(mock_connect.call_args[1]['connect_timeout'], 10)
+        self.assertNotIn('options', mock_connect.call_args[1])
+
+    def test_queryDeadline(self):
+        connection = mock.MagicMock()
+        canceled = threading.Event()
+        connection.cancel.side_effect = canceled.set
+
+        with queryDeadline(connection, 0.01):
+            self.assertTrue(canceled.wait(5))
+
+        connection.reset_mock()
+        with queryDeadline(connection, 5):
+            pass
+        with queryDeadline(connection, None):
+            pass
+        time.sleep(0.05)
+        connection.cancel.assert_not_called()
+
+    @mock.patch('check_bareos.connectDB')
+    def test_runCheck_deadline(self, mock_connect):
+        c = mock_connect.return_value
+        c.execute.side_effect = psycopg2.extensions.QueryCanceledError("canceling statement due to user request")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            args = commandline(['-U', 'bareos', '--timeout', '2', '--cache-dir', tmp, 'tape', '-ex'])
+            actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 3)
+            self.assertRegex(actual['returnMessage'], r'^\[UNKNOWN\] - Deadline of 2.0s exceeded, query canceled after 0.\d+s$')
+            c.connection.close.assert_called()
+            self.assertEqual(mock_connect.call_args[0][5:], (2.0, False, 300))
+
+            # Only a cached result within --cache-stale is returned instead
+            ResultCache(tmp, 60)._write(ResultCache.key(args), {"returnCode": 1, "returnMessage": "[WARNING] - 6.0 Tapes are expired"})
+            actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 3)
+
+            args = commandline(['-U', 'bareos', '--timeout', '2', '--cache-dir', tmp, '--cache-stale', '60', 'tape', '-ex'])
+            ResultCache(tmp, 60)._write(ResultCache.key(args), {"returnCode": 1, "returnMessage": "[WARNING] - 6.0 Tapes are expired"})
+            actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 1)
+            self.assertRegex(actual['returnMessage'], r'^\[WARNING\] - 6.0 Tapes are expired \(cached 0s ago, Deadline of 2.0s exceeded')
+
+            # An older result does not tell the state anymore
+            with mock.patch('check_bareos.time.time', return_value=time.time() + 3600):
+                actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 3)
+
+            # With the result cache the result of the deadline is not cached
+            args = commandline(['-U', 'bareos', '--timeout', '2', '--cache-dir', tmp, '--cache-ttl', '60', 'tape', '-ex', '-w', '1'])
+            actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 3)
+            self.assertIsNone(ResultCache(tmp, 60).read(ResultCache.key(args)))
+
+    @mock.patch('check_bareos.createConnection')
+    def test_runCheck_connect_deadline(self, mock_connect):
+        def connect(*args):
+            time.sleep(0.05)
+            raise psycopg2.OperationalError("timeout expired\n")
+        mock_connect.side_effect = connect
+
+        with tempfile.TemporaryDirectory() as tmp:
+            args = commandline(['-U', 'bareos', '--timeout', '0.01', '--cache-dir', tmp, '--cache-stale', '60', 'tape', '-ex'])
+            actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 3)
+            self.assertRegex(actual['returnMessage'], r'^\[UNKNOWN\] - Deadline of 0.01s exceeded, connection attempt given up after 0.\d+s$')
+
+            ResultCache(tmp, 60)._write(ResultCache.key(args), {"returnCode": 1, "returnMessage": "[WARNING] - 6.0 Tapes are expired"})
+            actual = runCheck(args, args.evaluate)
+            self.assertEqual(actual['returnCode'], 1)
+
+        # Connection errors before the deadline are reported as they are
+        mock_connect.side_effect = psycopg2.OperationalError("connection refused\n")
+        args = commandline(['-U', 'bareos', '--timeout', '10', 'tape', '-ex'])
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as mock_out, self.assertRaises(SystemExit):
+            runCheck(args, args.evaluate)
+        self.assertEqual(mock_out.getvalue(), "[UNKNOWN] - connection refused|;;;;\n")
+
+    @mock.patch('check_bareos.connectDB')
+    def test_connect_deadline_report_and_batch(self, mock_connect):
+        mock_connect.side_effect = DeadlineExceeded(1.0, 1.02, "connection attempt given up")
+
+        # Nothing but the report is written to stdout
+        args = commandline(['-U', 'bareos', '--timeout', '1', 'report', '-fb'])
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as mock_out, mock.patch('sys.stderr', new_callable=io.StringIO) as mock_err:
+            with self.assertRaises(SystemExit) as exited:
+                args.func(args)
+        self.assertEqual(exited.exception.code, 3)
+        self.assertEqual(mock_out.getvalue(), "")
+        self.assertEqual(mock_err.getvalue(), "[UNKNOWN] - Deadline of 1.0s exceeded, connection attempt given up after 1.02s\n")
+
+        args = commandline(['-U', 'bareos', '--timeout', '1', 'batch', '-C', 'tape -ex'])
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as mock_out, self.assertRaises(SystemExit) as exited:
+            args.func(args)
+        self.assertEqual(exited.exception.code, 3)
+        self.assertEqual(mock_out.getvalue(), "[UNKNOWN] - Deadline of 1.0s exceeded, connection attempt given up after 1.02s|;;;;\n")
+
+    def test_DeadlineExceeded(self):
+        e = DeadlineExceeded(5, 5.0123)
+        self.assertEqual(str(e), "Deadline of 5s exceeded, query canceled after 5.01s")
+
+
+class ReplicaTesting(unittest.TestCase):
+
+    @staticmethod
+    def server(standby, lag=0):
+        connection = mock.MagicMock()
+        connection.cursor.return_value.__enter__.return_value.fetchone.return_value = (standby, lag)
+        return connection
+
+    def test_replicationLag(self):
+        self.assertIsNone(replicationLag(self.server(False, None)))
+        self.assertEqual(replicationLag(self.server(True, 12.5)), 12.5)
+        self.assertEqual(replicationLag(self.server(True, None)), float('inf'))
+
+        connection = self.server(True, 0)
+        replicationLag(connection)
+        connection.cursor.return_value.__enter__.return_value.execute.assert_called_once_with(QUERIES['replicationLag'])
+        # A standby with a disconnected WAL receiver has replayed all it received but is not current
+        self.assertIn("pg_stat_wal_receiver WHERE status = 'streaming'", QUERIES['replicationLag'])
+        connection.rollback.assert_called_once()
+
+    @mock.patch('check_bareos.psycopg2.connect')
+    def test_createConnection_prefers_standby(self, mock_connect):
+        primary = self.server(False, None)
+        lagging = self.server(True, 600)
+        standby = self.server(True, 20)
+        servers = {'db1': primary, 'db2': lagging, 'db3': standby}
+        mock_connect.side_effect = lambda host, **kwargs: servers[host]
+
+        # The first standby within the budget is used
+        actual = createConnection("bareos", "secret", "db1,db2,db3", "bareos", 5432, staleness=300)
+        self.assertIs(actual, standby)
+        primary.close.assert_called_once()
+        lagging.close.assert_called_once()
+
+        # Falls back to the primary if no standby is fresh enough
+        primary.reset_mock()
+        actual = createConnection("bareos", "secret", "db1, db2, db3", "bareos", 5432, staleness=10)
+        self.assertIs(actual, primary)
+        primary.close.assert_not_called()
+
+        # Without a budget libpq connects to the primary
+        mock_connect.side_effect = None
+        mock_connect.reset_mock()
+        createConnection("bareos", "secret", "db1,db2", "bareos", 5432)
+        mock_connect.assert_called_once()
+        self.assertEqual(mock_connect.call_args[1]['host'], 'db1,db2')
+        self.assertEqual(mock_connect.call_args[1]['target_session_attrs'], 'read-write')
+
+        # A single host is used as it is
+        mock_connect.reset_mock()
+        createConnection("bareos", "secret", "db1", "bareos", 5432, staleness=300)
+        self.assertNotIn('target_session_attrs', mock_connect.call_args[1])
+
+    @mock.patch('check_bareos.psycopg2.connect')
+    def test_createConnection_unreachable_standby(self, mock_connect):
+        standby = self.server(True, 0)
+        primary = mock.MagicMock()
+
+        def connect(host, **kwargs):
+            if host == 'db2':
+                raise psycopg2.OperationalError("down")
+            return primary if 'target_session_attrs' in kwargs else standby
+        mock_connect.side_effect = connect
+
+        # The standby within the budget is used even if another host is down
+        self.assertIs(createConnection("bareos", "secret", "db2,db3", "bareos", 5432, staleness=0), standby)
+
+        standby.cursor.return_value.__enter__.return_value.fetchone.return_value = (True, 30)
+        self.assertIs(createConnection("bareos", "secret", "db2,db3", "bareos", 5432, staleness=0), primary)
+
+    def test_stalenessBudget(self):
+        self.assertEqual(stalenessBudget(commandline(['-U', 'bareos', 'tape', '-ex'])), 300)
+        self.assertEqual(stalenessBudget(commandline(['-U', 'bareos', 'status', '-fb'])), 10)
+        self.assertEqual(stalenessBudget(commandline(['-U', 'bareos', '--max-staleness', '60', 'status', '-fb'])), 60)
+
+        # Checks writing to the catalog run on the primary
+        self.assertIsNone(stalenessBudget(commandline(['-U', 'bareos', 'tape', '-ex', '--expiry-view', '--expiry-max-age', '60'])))
+        self.assertIsNone(stalenessBudget(commandline(['-U', 'bareos', '--max-staleness', '60', 'expiry-view', '--refresh'])))
+
+    @mock.patch('check_bareos.connectDB')
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_checkBatch_staleness(self, mock_out, mock_connect):
+        mock_connect.return_value.fetchone.return_value = [0] * 20
+
+        args = commandline(['-U', 'bareos', 'batch', '-C', 'tape -ex', '-C', 'status -fb'])
+        with self.assertRaises(SystemExit):
+            args.func(args)
+        # The strictest budget of the checks
+        self.assertEqual(mock_connect.call_args[0][7], 10)
+
+        args = commandline(['-U', 'bareos', 'batch', '-C', 'tape -ex', '-C', 'expiry-view --refresh'])
+        with self.assertRaises(SystemExit):
+            args.func(args)
+        self.assertIsNone(mock_connect.call_args[0][7])
+
+    @mock.patch('check_bareos.evaluateBatchConcurrently', new_callable=mock.MagicMock)
+    @mock.patch('check_bareos.asyncio.run')
+    @mock.patch('check_bareos.createPool')
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_checkBatch_staleness_concurrent(self, mock_out, mock_pool, mock_run, mock_evaluate): # pylint: disable=unused-argument
+        mock_run.return_value = [('tape', {'returnCode': 0, 'returnMessage': '[OK] - 0 Tapes are expired'})]
+
+        # The concurrent batch routes its checks like the sequential one
+        args = commandline(['-U', 'bareos', 'batch', '--concurrency', '2', '-C', 'tape -ex', '-C', 'status -fb'])
+        with self.assertRaises(SystemExit):
+            args.func(args)
+        self.assertEqual(mock_pool.call_args[0][3], 10)
+
+        args = commandline(['-U', 'bareos', '--max-staleness', '60', 'batch', '--concurrency', '2',
+                            '-C', 'tape -ex', '-C', 'tape -ex --expiry-view --expiry-max-age 60'])
+        with self.assertRaises(SystemExit):
+            args.func(args)
+        self.assertIsNone(mock_pool.call_args[0][3])
+
+
+class FreshnessTesting(unittest.TestCase):
+
+    ROWS = [
+        ('backup-web', 'F', 100.0),
+        ('backup-web', 'I ', 10.0),
+        ('backup-db', 'F', 200.0),
+        ('backup-db', 'I', 30.0),
+        ('backup-mail', 'F', 60.0),
+        ('archive-2020', 'F', 9000.0),
+    ]
+
+    def rules(self, rules=()):
+        return FreshnessRules(Threshold("26"), Threshold("50"), rules)
+
+    def cursor(self, rows=None):
+        c = mock.MagicMock()
+        c.fetchall.return_value = self.ROWS if rows is None else rows
+        return c
+
+    def test_match(self):
+        rules = self.rules([{"name": "backup-db", "level": "F", "warning": "192", "critical": "384"},
+                            {"name": "backup-*", "level": "F", "warning": "1"},
+                            {"name": "archive-*", "ignore": True}])
+
+        self.assertEqual(rules.match('archive-2020'), {})
+        self.assertEqual(rules.match('backup-db')['F']['warning']._threshold, "192")
+        self.assertEqual(rules.match('backup-db')[None], rules.default)
+        # Missing thresholds fall back to the command line
+        self.assertIs(rules.match('backup-web')['F']['critical'], rules.default['critical'])
+        self.assertEqual(rules.expected(), ['backup-db'])
+
+        with self.assertRaises(ValueError):
+            self.rules([{"level": "F"}])
+
+    def test_checkJobFreshness(self):
+        c = self.cursor()
+        actual = checkJobFreshness(c, self.rules([{"name": "archive-*", "ignore": True}]))
+
+        c.execute.assert_called_once_with(QUERIES['lastSuccessfulJobs'])
+        self.assertEqual(actual['returnCode'], 2)
+        self.assertEqual(actual['returnMessage'], "[CRITICAL] - 2 of 3 Jobs have no recent successful backup")
+        self.assertEqual(actual['performanceData'], "bareos.freshness.stale=2;;;; bareos.freshness.critical=1 bareos.freshness.jobs=3 bareos.freshness.oldest_hours=60.0")
+        self.assertEqual(actual['longOutput'], "[CRITICAL] backup-mail last successful backup 60.0 hours ago\n"
+                                               "[WARNING] backup-db last successful backup 30.0 hours ago")
+
+    def test_checkJobFreshness_levels(self):
+        rules = self.rules([{"name": "backup-db", "level": "F", "warning": "192", "critical": "384"},
+                            {"name": "backup-web", "level": "D", "warning": "120", "critical": "240"},
+                            {"name": "backup-new", "level": "F"},
+                            {"name": "backup-*", "warning": "72", "critical": "96"},
+                            {"name": "archive-*", "ignore": True}])
+        actual = checkJobFreshness(self.cursor(), rules)
+
+        # A full backup also counts as a differential one, the job never run is critical
+        self.assertEqual(actual['returnCode'], 2)
+        self.assertEqual(actual['returnMessage'], "[CRITICAL] - 3 of 7 Jobs have no recent successful backup")
+        self.assertEqual(actual['longOutput'], "[CRITICAL] backup-new Level: F never succeeded\n"
+                                               "[CRITICAL] backup-new never succeeded\n"
+                                               "[WARNING] backup-db Level: F last successful backup 200.0 hours ago")
+
+        actual = checkJobFreshness(self.cursor([('backup-web', 'I', 1.0)]), self.rules())
+        self.assertEqual(actual['returnMessage'], "[OK] - All 1 Jobs have a recent successful backup")
+        self.assertNotIn('longOutput', actual)
+
+    def test_checkJobFreshness_clock_skew(self):
+        # An EndTime ahead of the clock of the database counts as a backup just finished
+        self.assertIn("GREATEST(EXTRACT(EPOCH FROM now() - EndTime) / 3600, 0)", QUERIES['lastSuccessfulJobs'])
+
+        actual = checkJobFreshness(self.cursor([('backup-client-1', 'F', 0)]), self.rules())
+        self.assertEqual(actual['returnCode'], 0)
+        self.assertEqual(actual['returnMessage'], "[OK] - All 1 Jobs have a recent successful backup")
+
+    def test_evaluateFreshness(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as rulesfile:
+            json.dump([{"name": "backup-*", "warning": "72", "critical": "96"}, {"name": "archive-*", "ignore": True}], rulesfile)
+            rulesfile.flush()
+
+            args = commandline(['-U', 'bareos', 'freshness', '--rules', rulesfile.name])
+            actual = args.evaluate(self.cursor(), args)
+        self.assertEqual(actual['returnCode'], 0)
+        self.assertEqual(args.staleness, 60)
+
+        args = commandline(['-U', 'bareos', 'freshness', '-w', '5', '-c', '20'])
+        actual = args.evaluate(self.cursor(), args)
+        self.assertEqual(actual['returnMessage'], "[CRITICAL] - 4 of 4 Jobs have no recent successful backup")
+
+    def test_adviseIndexes(self):
+        _, subParser = createParser()
+        checks = [('freshness', subParser.choices['freshness'].parse_args([]))]
+        missing = [index["name"] for index in adviseIndexes([], checks)]
+        self.assertEqual(missing, ['check_bareos_job_freshness_idx'])
+
+        existing = [('idx', "CREATE INDEX idx ON public.job USING btree (name, level, endtime DESC) WHERE (type = 'B'::bpchar)")]
+        self.assertEqual(adviseIndexes(existing, checks), [])